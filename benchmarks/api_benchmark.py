@@ -0,0 +1,442 @@
+#!/usr/bin/python3
+"""Load test the orchestrator API and record throughput, latency and memory.
+
+Starts a Server in its own process against a temporary database seeded with
+N clients and M images, then sends a mix of requests from concurrent
+connections:
+
+    login      POST /login
+    heartbeat  PUT /clients
+    vms        GET /clients/<mac>/vms
+    client     GET /clients/<mac>
+    download   GET /images/<id>/download
+
+The mix is either synthetic (--mix, weights per operation) or replayed from
+a recorded jsonl trace (--trace) with one request per line, either
+{"op": "vms", "mac_address": "..."} or {"method": "GET", "path": "/..."}.
+
+Results (throughput, p50/p90/p99 latency per operation, peak and final RSS
+of the server processes) are printed and, with --output, written as JSON.
+With --baseline the run fails when throughput drops or p99 latency grows by
+more than --max-regression percent compared to an earlier result file.
+
+    python3 benchmarks/api_benchmark.py --clients 1000 --requests 20000 --concurrency 32 \\
+        --mode gunicorn --workers 2 --threads 8 --output results.json
+"""
+import argparse
+import http.client
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+USERNAME = "benchmark"
+PASSWORD = "benchmark-password"
+OPERATIONS = ["login", "heartbeat", "vms", "client", "download"]
+DEFAULT_MIX = "login=1,heartbeat=50,vms=35,client=10,download=4"
+
+
+def run_server(work_directory: str, port: int, mode: str, workers: int, threads: int, ready):
+    from network.communication import Server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    logging.getLogger("gunicorn.error").setLevel(logging.ERROR)
+
+    server = Server(
+        host="127.0.0.1",
+        port=port,
+        name="api-benchmark",
+        access_password=PASSWORD,
+        access_username=USERNAME,
+        jwt_secret="api-benchmark-secret",
+        version="benchmark",
+        database_file_path=os.path.join(work_directory, "database.db"),
+        logging_level="ERROR",
+        image_directory=os.path.join(work_directory, "images"),
+        delta_directory=os.path.join(work_directory, "deltas"),
+    )
+    if mode == "dev":
+        from werkzeug.serving import make_server
+        server.prepare()
+        http_server = make_server("127.0.0.1", port, server.flask_app, threaded=True)
+        ready.set()
+        http_server.serve_forever()
+    else:
+        # gunicorn and aiohttp report readiness by accepting connections
+        ready.set()
+        server.run(workers=workers, threads=threads, async_mode=mode == "async")
+
+
+def seed_database(work_directory: str, client_count: int, image_count: int, image_size: int,
+                  images_per_client: int, seed: int):
+    from utils.database.database import Database
+    from utils.models.models import VMImage, client_image_table
+
+    generator = random.Random(seed)
+    database = Database(os.path.join(work_directory, "database.db"), "ERROR")
+    image_ids = []
+    for image_index in range(image_count):
+        image_file = os.path.join(work_directory, f"image-{image_index}.qcow2")
+        with open(image_file, "wb") as stream:
+            stream.write(generator.randbytes(image_size))
+        image = VMImage(
+            image_name=f"benchmark-{image_index}",
+            image_file=image_file,
+            image_version="1",
+            image_hash=f"benchmark-{image_index}",
+            image_name_version_combo=f"benchmark-{image_index}@1",
+        )
+        database.add_image(image)
+        image_ids.append(image.image_id)
+    mac_addresses = [f"bench-{client_index:06d}" for client_index in range(client_count)]
+    for offset in range(0, client_count, 1000):
+        database.upsert_clients([
+            {
+                "mac_address": mac_address,
+                "ip_address": "127.0.0.1",
+                "hostname": mac_address,
+                "client_version": "benchmark",
+            }
+            for mac_address in mac_addresses[offset:offset + 1000]
+        ])
+    assignments = [
+        {"client_mac": mac_address, "image_id": image_id}
+        for mac_address in mac_addresses
+        for image_id in generator.sample(image_ids, min(images_per_client, len(image_ids)))
+    ]
+    if assignments:
+        with database.session_scope(write=True) as session:
+            session.execute(client_image_table.insert(), assignments)
+    return mac_addresses, image_ids
+
+
+def synthetic_requests(mix: dict, count: int, mac_addresses: list, image_ids: list, seed: int):
+    generator = random.Random(seed)
+    operations = list(mix)
+    weights = [mix[operation] for operation in operations]
+    for _ in range(count):
+        yield {
+            "op": generator.choices(operations, weights)[0],
+            "mac_address": generator.choice(mac_addresses),
+            "image_id": generator.choice(image_ids),
+        }
+
+
+def trace_requests(trace_file: str, count: int, mac_addresses: list, image_ids: list, seed: int):
+    """Requests of a recorded trace, repeated until count requests were sent."""
+    generator = random.Random(seed)
+    with open(trace_file) as stream:
+        trace = [json.loads(line) for line in stream if line.strip()]
+    if not trace:
+        raise ValueError(f"{trace_file} contains no requests")
+    for request_index in range(count):
+        entry = dict(trace[request_index % len(trace)])
+        # recorded clients and images don't exist in the seeded database
+        entry.setdefault("mac_address", generator.choice(mac_addresses))
+        entry.setdefault("image_id", generator.choice(image_ids))
+        yield entry
+
+
+def build_request(entry: dict, token: str):
+    """(operation, method, path, body) of a request of the traffic mix."""
+    operation = entry.get("op")
+    mac_address = entry["mac_address"]
+    if operation == "login":
+        return operation, "POST", "/login", {"username": USERNAME, "password": PASSWORD}
+    if operation == "heartbeat":
+        return operation, "PUT", "/clients", {
+            "mac_address": mac_address,
+            "ip_address": entry.get("ip_address", "127.0.0.1"),
+            "hostname": entry.get("hostname", mac_address),
+            "client_version": entry.get("client_version", "benchmark"),
+        }
+    if operation == "vms":
+        return operation, "GET", f"/clients/{mac_address}/vms", None
+    if operation == "client":
+        return operation, "GET", f"/clients/{mac_address}", None
+    if operation == "download":
+        return operation, "GET", f"/images/{entry['image_id']}/download", None
+    return entry.get("name", entry["path"]), entry["method"], entry["path"], entry.get("body")
+
+
+class Connection:
+    """Keep-alive HTTP connection that reconnects when the server closes it."""
+
+    def __init__(self, port: int):
+        self.port = port
+        self.connection = None
+
+    def request(self, method: str, path: str, token: str = None, body=None):
+        headers = {}
+        if token:
+            headers["Authorization"] = f"Bearer {token}"
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection("127.0.0.1", self.port, timeout=60)
+            try:
+                self.connection.request(method, path, body=data, headers=headers)
+                response = self.connection.getresponse()
+                payload = response.read()
+            except (http.client.HTTPException, ConnectionError):
+                self.connection.close()
+                self.connection = None
+                if attempt:
+                    raise
+                continue
+            if response.will_close:
+                self.connection.close()
+                self.connection = None
+            return response.status, payload
+
+
+def login(port: int) -> str:
+    status, payload = Connection(port).request("POST", "/login", body={"username": USERNAME, "password": PASSWORD})
+    if status >= 300:
+        raise RuntimeError(f"login failed with {status}: {payload[:200]}")
+    return json.loads(payload)["token"]
+
+
+def wait_for_server(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            Connection(port).request("GET", "/")
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server didn't start listening on port {port}")
+
+
+def process_tree_rss(pid: int) -> int:
+    """Resident memory of a process and all its descendants, in bytes (Linux)."""
+    total = 0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as stream:
+                for line in stream:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as stream:
+                    pending.extend(int(child) for child in stream.read().split())
+        except (FileNotFoundError, ProcessLookupError):
+            continue
+    return total
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def summarize(latencies: list, errors: int, seconds: float) -> dict:
+    latencies = sorted(latencies)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_rps": len(latencies) / seconds if seconds else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p90_ms": percentile(latencies, 0.90) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": (latencies[-1] if latencies else 0.0) * 1000,
+    }
+
+
+def run_load(port: int, requests, concurrency: int, token: str):
+    """Send the requests from concurrency connections, returns per operation
+    latencies and error counts and the wall time."""
+    request_lock = threading.Lock()
+    latencies = {}
+    errors = {}
+
+    def send_requests():
+        connection = Connection(port)
+        thread_latencies = {}
+        thread_errors = {}
+        while True:
+            with request_lock:
+                entry = next(requests, None)
+            if entry is None:
+                break
+            operation, method, path, body = build_request(entry, token)
+            started = time.perf_counter()
+            try:
+                status, _ = connection.request(method, path, token if operation != "login" else None, body)
+                failed = status >= 400
+            except OSError:
+                failed = True
+            elapsed = time.perf_counter() - started
+            thread_latencies.setdefault(operation, []).append(elapsed)
+            if failed:
+                thread_errors[operation] = thread_errors.get(operation, 0) + 1
+        with request_lock:
+            for operation, values in thread_latencies.items():
+                latencies.setdefault(operation, []).extend(values)
+            for operation, count in thread_errors.items():
+                errors[operation] = errors.get(operation, 0) + count
+
+    threads = [threading.Thread(target=send_requests) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors, time.perf_counter() - started
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_to_baseline(result: dict, baseline: dict, max_regression: float) -> list:
+    """Descriptions of every metric that regressed by more than max_regression percent."""
+    regressions = []
+    pairs = [("overall", result["overall"], baseline.get("overall", {}))] + [
+        (operation, summary, baseline.get("operations", {}).get(operation, {}))
+        for operation, summary in result["operations"].items()
+    ]
+    for name, current, previous in pairs:
+        if previous.get("throughput_rps") and \
+                current["throughput_rps"] < previous["throughput_rps"] * (1 - max_regression / 100):
+            regressions.append(
+                f"{name}: throughput {current['throughput_rps']:.1f} < {previous['throughput_rps']:.1f} req/s")
+        if previous.get("p99_ms") and current["p99_ms"] > previous["p99_ms"] * (1 + max_regression / 100):
+            regressions.append(f"{name}: p99 {current['p99_ms']:.1f} > {previous['p99_ms']:.1f} ms")
+    return regressions
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for item in mix.split(","):
+        operation, weight = item.split("=")
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {operation}, expected one of {OPERATIONS}")
+        weights[operation] = float(weight)
+    return weights
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=1000)
+    parser.add_argument("--images", type=int, default=10)
+    parser.add_argument("--image-size-mib", type=float, default=4)
+    parser.add_argument("--images-per-client", type=int, default=2)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--warmup", type=int, default=200, help="requests sent before measuring")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--mix", type=parse_mix, default=DEFAULT_MIX,
+                        help=f"operation weights of the synthetic traffic, default {DEFAULT_MIX}")
+    parser.add_argument("--trace", help="replay requests from a jsonl trace instead of --mix")
+    parser.add_argument("--mode", choices=["dev", "gunicorn", "async"], default="dev")
+    parser.add_argument("--workers", type=int, default=2, help="server processes in gunicorn and async mode, 0 serves async mode from one process")
+    parser.add_argument("--threads", type=int, default=8, help="threads per gunicorn worker")
+    parser.add_argument("--port", type=int, default=18091)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", help="results JSON of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=10.0,
+                        help="allowed throughput drop / p99 increase against the baseline, in percent")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_directory:
+        mac_addresses, image_ids = seed_database(
+            work_directory, args.clients, args.images, int(args.image_size_mib * 1024 * 1024),
+            args.images_per_client, args.seed)
+        ready = multiprocessing.Event()
+        server_process = multiprocessing.Process(
+            target=run_server,
+            args=(work_directory, args.port, args.mode, args.workers, args.threads, ready),
+            daemon=True,
+        )
+        server_process.start()
+        ready.wait()
+        rss_samples = []
+        sampling = threading.Event()
+
+        def sample_rss():
+            while not sampling.wait(0.2):
+                rss_samples.append(process_tree_rss(server_process.pid))
+
+        try:
+            wait_for_server(args.port)
+            token = login(args.port)
+            if args.trace:
+                requests = trace_requests(args.trace, args.warmup + args.requests, mac_addresses, image_ids, args.seed)
+            else:
+                requests = synthetic_requests(args.mix, args.warmup + args.requests, mac_addresses, image_ids, args.seed)
+            warmup_requests = (next(requests) for _ in range(args.warmup))
+            run_load(args.port, warmup_requests, args.concurrency, token)
+            rss_sampler = threading.Thread(target=sample_rss, daemon=True)
+            rss_sampler.start()
+            latencies, errors, seconds = run_load(args.port, requests, args.concurrency, token)
+            sampling.set()
+            rss_sampler.join()
+            rss_end = process_tree_rss(server_process.pid)
+        finally:
+            # gunicorn stops its workers when its arbiter is terminated
+            server_process.terminate()
+            server_process.join()
+
+    all_latencies = [value for values in latencies.values() for value in values]
+    result = {
+        "config": {
+            key: value for key, value in vars(args).items() if key not in ["output", "baseline"]
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "git_revision": git_revision(),
+        },
+        "overall": summarize(all_latencies, sum(errors.values()), seconds),
+        "operations": {
+            operation: summarize(values, errors.get(operation, 0), seconds)
+            for operation, values in sorted(latencies.items())
+        },
+        "server_rss_mib": {
+            "peak": max(rss_samples + [rss_end]) / 2**20,
+            "end": rss_end / 2**20,
+        },
+    }
+
+    print(f"{'operation':12} {'requests':>9} {'errors':>7} {'req/s':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8}")
+    for name, summary in list(result["operations"].items()) + [("overall", result["overall"])]:
+        print(f"{name:12} {summary['requests']:9} {summary['errors']:7} {summary['throughput_rps']:9.1f} "
+              f"{summary['p50_ms']:8.2f} {summary['p90_ms']:8.2f} {summary['p99_ms']:8.2f}")
+    print(f"server rss: peak {result['server_rss_mib']['peak']:.1f} MiB, end {result['server_rss_mib']['end']:.1f} MiB")
+
+    if args.output:
+        with open(args.output, "w") as stream:
+            json.dump(result, stream, indent=2)
+    if args.baseline:
+        with open(args.baseline) as stream:
+            regressions = compare_to_baseline(result, json.load(stream), args.max_regression)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
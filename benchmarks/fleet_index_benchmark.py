@@ -0,0 +1,181 @@
+#!/usr/bin/python3
+"""Measure the in-memory fleet index against the database queries it replaces.
+
+Seeds a temporary database with N clients and M images, each client assigned
+to a few of them, loads a FleetIndex from it and then times the same lookups
+against the index and against Database:
+
+    client       one client by mac address
+    client_vms   image ids assigned to a client
+    image        one image by id
+    selector     mac addresses of a rollout selector (client_version and
+                 hostname_pattern)
+
+Results (load time, memory held by the index per structure, how much the
+peak RSS grew while loading it, mean and p99 latency per lookup) are printed
+and, with --output, written as JSON.
+
+    python3 benchmarks/fleet_index_benchmark.py --clients 100000 --images 50 --output results.json
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CLIENT_VERSIONS = ["1.0", "1.1", "1.2", "2.0"]
+
+
+def seed_database(database, client_count: int, image_count: int, images_per_client: int, seed: int):
+    from utils.models.models import VMImage, client_image_table
+
+    generator = random.Random(seed)
+    image_ids = []
+    for image_index in range(image_count):
+        image = VMImage(
+            image_name=f"benchmark-{image_index}",
+            image_file=f"/nonexistent/image-{image_index}.qcow2",
+            image_version="1",
+            image_hash=f"benchmark-{image_index}",
+            image_name_version_combo=f"benchmark-{image_index}@1",
+        )
+        database.add_image(image)
+        image_ids.append(image.image_id)
+    mac_addresses = [
+        ":".join(f"{byte:02x}" for byte in (client_index + 2**40).to_bytes(6, "big"))
+        for client_index in range(client_count)
+    ]
+    for offset in range(0, client_count, 1000):
+        database.upsert_clients([
+            {
+                "mac_address": mac_address,
+                "ip_address": f"10.{client_index >> 16 & 255}.{client_index >> 8 & 255}.{client_index & 255}",
+                "hostname": f"{generator.choice(['kiosk', 'lab', 'office'])}-{client_index:06d}",
+                "client_version": generator.choice(CLIENT_VERSIONS),
+            }
+            for client_index, mac_address in enumerate(mac_addresses[offset:offset + 1000], offset)
+        ])
+    assignments = [
+        {"client_mac": mac_address, "image_id": image_id}
+        for mac_address in mac_addresses
+        for image_id in generator.sample(image_ids, min(images_per_client, len(image_ids)))
+    ]
+    for offset in range(0, len(assignments), 10000):
+        with database.session_scope(write=True) as session:
+            session.execute(client_image_table.insert(), assignments[offset:offset + 10000])
+    return mac_addresses, image_ids
+
+
+def select_clients_from_database(database, selector: dict) -> list[str]:
+    # what create_rollout runs without the index
+    with database.session_scope() as session:
+        return [row.mac_address for row in database._select_clients_query(session, **selector)]
+
+
+def max_rss() -> int:
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def time_lookups(lookup, arguments: list) -> dict:
+    latencies = []
+    for argument in arguments:
+        started = time.perf_counter()
+        lookup(argument)
+        latencies.append(time.perf_counter() - started)
+    latencies.sort()
+    return {
+        "mean_ms": sum(latencies) / len(latencies) * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=100000)
+    parser.add_argument("--images", type=int, default=50)
+    parser.add_argument("--images-per-client", type=int, default=2)
+    parser.add_argument("--lookups", type=int, default=2000, help="lookups timed per operation")
+    parser.add_argument("--selector-lookups", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    from utils.database.database import Database
+    from utils.fleetindex.fleetindex import FleetIndex
+
+    generator = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as work_directory:
+        database = Database(os.path.join(work_directory, "database.db"), "ERROR")
+        started = time.perf_counter()
+        mac_addresses, image_ids = seed_database(
+            database, args.clients, args.images, args.images_per_client, args.seed)
+        seed_seconds = time.perf_counter() - started
+
+        rss_before = max_rss()
+        fleet_index = FleetIndex(database)
+        started = time.perf_counter()
+        fleet_index.start()
+        load_seconds = time.perf_counter() - started
+        rss_after = max_rss()
+
+        sample_macs = [generator.choice(mac_addresses) for _ in range(args.lookups)]
+        sample_images = [generator.choice(image_ids) for _ in range(args.lookups)]
+        selectors = [
+            {"client_version": generator.choice(CLIENT_VERSIONS), "hostname_pattern": "kiosk-*"}
+            for _ in range(args.selector_lookups)
+        ]
+        operations = {
+            "client": (
+                fleet_index.get_client,
+                lambda mac_address: database.get_client_by_mac_address(mac_address).as_dict(),
+                sample_macs,
+            ),
+            "client_vms": (
+                fleet_index.get_client_image_ids, database.get_client_vm_list_by_mac_address, sample_macs,
+            ),
+            "image": (
+                fleet_index.get_image,
+                lambda image_id: database.get_image_by_id(image_id).as_dict(),
+                sample_images,
+            ),
+            "selector": (
+                lambda selector: fleet_index.select_clients(**selector),
+                lambda selector: select_clients_from_database(database, selector),
+                selectors,
+            ),
+        }
+        results = {}
+        for operation, (index_lookup, database_lookup, arguments) in operations.items():
+            results[operation] = {
+                "index": time_lookups(index_lookup, arguments),
+                "database": time_lookups(database_lookup, arguments),
+            }
+
+    result = {
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "seed_seconds": seed_seconds,
+        "load_seconds": load_seconds,
+        "memory_bytes": fleet_index.memory_usage(),
+        "peak_rss_added_mib": (rss_after - rss_before) / 2**20,
+        "operations": results,
+    }
+    print(f"seeded {args.clients} clients in {seed_seconds:.1f}s, index loaded in {load_seconds:.2f}s")
+    print(f"index memory {result['memory_bytes']['total'] / 2**20:.1f} MiB "
+          f"({result['memory_bytes']['total'] / max(args.clients, 1):.0f} bytes per client), "
+          f"peak RSS grew by {result['peak_rss_added_mib']:.1f} MiB while loading")
+    for operation, timings in results.items():
+        print(f"{operation:<12} index mean {timings['index']['mean_ms']:.4f} ms p99 {timings['index']['p99_ms']:.4f} ms"
+              f" | database mean {timings['database']['mean_ms']:.3f} ms p99 {timings['database']['p99_ms']:.3f} ms")
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump(result, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+#!/usr/bin/python3
+"""Simulate a swarm of clients pulling one image through the peer tracker.
+
+Starts a Server with a temporary database and chunk store, registers a
+random image and N clients, then runs every client in its own process.
+Each client serves the chunks it already has over HTTP, asks the tracker
+for peers, downloads chunks from peers where possible and from the server
+otherwise, verifies every chunk hash and announces its progress.
+
+    python3 benchmarks/swarm_simulation.py --clients 8 --image-size-mib 64
+"""
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+USERNAME = "swarm"
+PASSWORD = "swarm-password"
+
+
+def run_server(work_directory: str, port: int, ready):
+    from werkzeug.serving import make_server
+    from network.communication import Server
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+
+    server = Server(
+        host="127.0.0.1",
+        port=port,
+        name="swarm-simulation",
+        access_password=PASSWORD,
+        access_username=USERNAME,
+        jwt_secret="swarm-simulation-secret",
+        version="simulation",
+        database_file_path=os.path.join(work_directory, "database.db"),
+        logging_level="ERROR",
+        image_store_path=os.path.join(work_directory, "store"),
+        image_directory=os.path.join(work_directory, "images"),
+        delta_directory=os.path.join(work_directory, "deltas"),
+        swarm_server_offload=True,
+    )
+    server.prepare()
+    http_server = make_server("127.0.0.1", port, server.flask_app, threaded=True)
+    ready.set()
+    http_server.serve_forever()
+
+
+def seed_database(work_directory: str, client_count: int, image_size: int) -> int:
+    from utils.database.database import Database
+    from utils.models.models import VMImage
+    from utils.storage.storage import ChunkStore
+
+    image_file = os.path.join(work_directory, "image.qcow2")
+    with open(image_file, "wb") as stream:
+        for _ in range(image_size // (1024 * 1024)):
+            stream.write(os.urandom(1024 * 1024))
+    database = Database(os.path.join(work_directory, "database.db"), "ERROR")
+    image = VMImage(
+        image_name="swarm",
+        image_file=image_file,
+        image_version="1",
+        image_hash="simulation",
+        image_name_version_combo="swarm@1",
+    )
+    database.add_image(image)
+    database.set_image_manifest(
+        image.image_id, ChunkStore(os.path.join(work_directory, "store")).store_file(image_file))
+    database.upsert_clients([
+        {
+            "mac_address": f"sim-{client_index}",
+            "ip_address": "127.0.0.1",
+            "hostname": f"sim-{client_index}",
+            "client_version": "simulation",
+        }
+        for client_index in range(client_count)
+    ])
+    # the clients must not be able to read the image behind the server's back
+    os.unlink(image_file)
+    return image.image_id
+
+
+def api_request(server_url: str, path: str, token: str = None, body=None):
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    data = json.dumps(body).encode("utf-8") if body is not None else None
+    request = urllib.request.Request(server_url + path, data=data, headers=headers)
+    with urllib.request.urlopen(request) as response:
+        return response.read()
+
+
+def run_client(client_index: int, server_url: str, image_id: int, start_delay: float, results, done):
+    mac_address = f"sim-{client_index}"
+    chunks = {}
+
+    class ChunkHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            chunk = chunks.get(self.path.rsplit("/", 1)[-1])
+            if chunk is None:
+                self.send_response(404)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(chunk)))
+            self.end_headers()
+            self.wfile.write(chunk)
+
+        def log_message(self, *args):
+            pass
+
+    peer_server = ThreadingHTTPServer(("127.0.0.1", 0), ChunkHandler)
+    threading.Thread(target=peer_server.serve_forever, daemon=True).start()
+    peer_port = peer_server.server_address[1]
+
+    time.sleep(start_delay)
+    token = json.loads(api_request(server_url, "/login", body={"username": USERNAME, "password": PASSWORD}))["token"]
+    tracker = json.loads(api_request(server_url, f"/images/{image_id}/peers?mac={mac_address}", token))["data"]
+    peers = tracker["peers"]
+    bytes_from_server = 0
+    bytes_from_peers = 0
+    started = time.monotonic()
+    for chunk in sorted(tracker["chunks"], key=lambda _: random.random()):
+        data = None
+        for peer_index in random.sample(chunk["peers"], len(chunk["peers"])):
+            peer = peers[peer_index]
+            try:
+                with urllib.request.urlopen(f"http://{peer['ip_address']}:{peer['port']}/{chunk['hash']}") as response:
+                    data = response.read()
+                bytes_from_peers += len(data)
+                break
+            except Exception:
+                data = None
+        if data is None:
+            data = api_request(server_url, f"/chunks/{chunk['hash']}?fallback=1", token)
+            bytes_from_server += len(data)
+        if hashlib.sha256(data).hexdigest() != chunk["hash"]:
+            raise RuntimeError(f"client {client_index} received a corrupted chunk {chunk['index']}")
+        chunks[chunk["hash"]] = data
+        held_indexes = [entry["index"] for entry in tracker["chunks"] if entry["hash"] in chunks]
+        api_request(server_url, f"/images/{image_id}/peers", token,
+                    {"mac_address": mac_address, "port": peer_port, "chunks": held_indexes})
+    api_request(server_url, f"/images/{image_id}/peers", token,
+                {"mac_address": mac_address, "port": peer_port, "complete": True})
+    results.put({
+        "client": client_index,
+        "bytes_from_server": bytes_from_server,
+        "bytes_from_peers": bytes_from_peers,
+        "seconds": time.monotonic() - started,
+    })
+    # keep seeding until every client is done
+    done.wait()
+    peer_server.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--image-size-mib", type=int, default=64)
+    parser.add_argument("--stagger", type=float, default=0.5, help="seconds between client starts")
+    parser.add_argument("--port", type=int, default=18090)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_directory:
+        image_id = seed_database(work_directory, args.clients, args.image_size_mib * 1024 * 1024)
+        ready = multiprocessing.Event()
+        server_process = multiprocessing.Process(
+            target=run_server, args=(work_directory, args.port, ready), daemon=True)
+        server_process.start()
+        ready.wait()
+        server_url = f"http://127.0.0.1:{args.port}"
+        results = multiprocessing.Queue()
+        done = multiprocessing.Event()
+        client_processes = [
+            multiprocessing.Process(
+                target=run_client,
+                args=(client_index, server_url, image_id, client_index * args.stagger, results, done))
+            for client_index in range(args.clients)
+        ]
+        for process in client_processes:
+            process.start()
+        client_results = [results.get() for _ in client_processes]
+        done.set()
+        for process in client_processes:
+            process.join()
+        server_process.terminate()
+
+    total_server = sum(result["bytes_from_server"] for result in client_results)
+    total_peers = sum(result["bytes_from_peers"] for result in client_results)
+    for result in sorted(client_results, key=lambda result: result["client"]):
+        print(f"client {result['client']:3}: {result['bytes_from_server'] / 2**20:8.1f} MiB from server, "
+              f"{result['bytes_from_peers'] / 2**20:8.1f} MiB from peers, {result['seconds']:.2f} s")
+    print(f"server egress {total_server / 2**20:.1f} MiB, peer traffic {total_peers / 2**20:.1f} MiB, "
+          f"{100 * total_peers / max(1, total_server + total_peers):.0f}% offloaded")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+from aiohttp import web
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.http import parse_range_header, http_date
+from network.communication import HTTP_REQUEST_SECONDS, HTTP_REQUESTS, DOWNLOAD_BYTES, DOWNLOADS_IN_FLIGHT
+from utils.delta.delta import delta_path
+from utils.middleware.auth import authenticate
+import asyncio
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import urllib.parse
+
+
+class AsyncServer:
+    """asyncio serving mode for a Server.
+
+    Downloads and the change feed are served natively: files are streamed
+    in blocks read by a small thread pool and long-poll/event stream
+    requests wait on futures, so slow clients cost a socket and a
+    coroutine instead of an OS thread. Database calls run in the same
+    bounded pool. Every other route is passed to the Server's Flask app in
+    that pool, so routes and response bodies are the same in both modes.
+    """
+
+    def __init__(self, server, io_workers: int = 16, file_block_size: int = 1024 * 1024):
+        self.server = server
+        self.io_workers = io_workers
+        self.file_block_size = file_block_size
+        self.executor = None
+        middlewares = [self._record_request] if server.metrics_enabled else []
+        self.app = web.Application(client_max_size=0, middlewares=middlewares)
+        self.app.on_startup.append(self._start_executor)
+        self.app.on_cleanup.append(self._stop_executor)
+        self.app.router.add_get("/images/{vm_id}/download", self.serve_vm_image)
+        self.app.router.add_get("/images/{vm_id}/delta", self.serve_vm_image_delta)
+        self.app.router.add_get("/chunks/{chunk_hash}", self.serve_chunk)
+        self.app.router.add_get("/clients/{client_mac_address}/changes", self.get_client_changes)
+        self.app.router.add_route("*", "/{path:.*}", self.call_wsgi_app)
+
+    async def _start_executor(self, app):
+        # created on startup so that every gunicorn worker gets its own threads
+        self.executor = ThreadPoolExecutor(self.io_workers, thread_name_prefix="aio-io")
+
+    async def _stop_executor(self, app):
+        self.executor.shutdown(wait=False)
+
+    @staticmethod
+    def _route(request) -> str:
+        # same labels as the Flask rules, e.g. /images/<vm_id>/download
+        return re.sub(r"\{(\w+)\}", r"<\1>", request.match_info.route.resource.canonical)
+
+    @web.middleware
+    async def _record_request(self, request, handler):
+        if request.match_info.handler == self.call_wsgi_app:
+            # recorded by the Flask app
+            return await handler(request)
+        started = time.perf_counter()
+        status = 500
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as ex:
+            status = ex.status
+            raise
+        finally:
+            route = self._route(request)
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, request.method, route)
+            HTTP_REQUESTS.inc(1, request.method, route, str(status))
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def _json_response(self, body: dict, status: int = 200, headers: dict = None):
+        # serialized like jsonify does
+        return web.json_response(body, status=status, headers=headers, dumps=self.server.flask_app.json.dumps)
+
+    async def _authenticate(self, request):
+        """The user making the request, or the error response require_auth gives."""
+        flask_config = self.server.flask_app.config
+        request_user, error, status_code = await self._run(
+            authenticate,
+            request.headers.get("Authorization"),
+            flask_config["SECRET_KEY"],
+            flask_config["AUTH_CACHE"],
+            flask_config["DATABASE"],
+        )
+        if request_user is None:
+            return None, self._json_response(error, status=status_code)
+        return request_user, None
+
+    def _not_found(self, message: str):
+        return self._json_response({"message": message, "data": None, "error": None}, status=404)
+
+    async def _send_file(self, request, file_path: str, etag: str, max_age: int = None, headers: dict = None):
+        """Stream a file with the same conditional and Range handling as
+        Flask's send_file."""
+        file_stat = await self._run(os.stat, file_path)
+        size = file_stat.st_size
+        response_headers = {
+            "ETag": f'"{etag}"',
+            "Accept-Ranges": "bytes",
+            "Last-Modified": http_date(file_stat.st_mtime),
+            "Cache-Control": f"public, max-age={max_age}" if max_age is not None else "no-cache",
+        }
+        response_headers.update(headers or {})
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match and (if_none_match.strip() == "*" or f'"{etag}"' in [
+                tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]):
+            return web.Response(status=304, headers=response_headers)
+        start, stop, status = 0, size, 200
+        if_range = request.headers.get("If-Range")
+        requested_range = parse_range_header(request.headers.get("Range"))
+        if requested_range is not None and (if_range is None or if_range.strip() == f'"{etag}"'):
+            byte_range = requested_range.range_for_length(size)
+            if byte_range is None:
+                response_headers["Content-Range"] = f"bytes */{size}"
+                return web.Response(status=416, headers=response_headers)
+            start, stop = byte_range
+            status = 206
+            response_headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+        response = web.StreamResponse(status=status, headers=response_headers)
+        response.content_type = "application/octet-stream"
+        response.content_length = stop - start
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+        image_file = await self._run(open, file_path, "rb")
+        route = self._route(request)
+        sent = 0
+        if self.server.metrics_enabled:
+            DOWNLOADS_IN_FLIGHT.inc(1, route)
+        try:
+            await self._run(image_file.seek, start)
+            remaining = stop - start
+            while remaining > 0:
+                block = await self._run(image_file.read, min(self.file_block_size, remaining))
+                if not block:
+                    break
+                # waits while the client is slower than the disk
+                await response.write(block)
+                remaining -= len(block)
+                sent += len(block)
+        finally:
+            if self.server.metrics_enabled:
+                DOWNLOADS_IN_FLIGHT.dec(1, route)
+                DOWNLOAD_BYTES.inc(sent, route)
+            await self._run(image_file.close)
+        await response.write_eof()
+        return response
+
+    async def _send_image(self, request, image_data, headers: dict = None):
+        """The image or its compressed variant, like Server._send_image."""
+        headers = dict(headers or {})
+        if self.server.image_variant_encodings:
+            headers["Vary"] = "Accept-Encoding"
+        variant = await self._run(
+            self.server._negotiate_image_variant, image_data, request.headers.get("Accept-Encoding"))
+        if variant is not None:
+            encoding, image_variant_path = variant
+            headers["Content-Encoding"] = encoding
+            return await self._send_file(
+                request, image_variant_path, f"{image_data.image_hash}-{encoding}", headers=headers)
+        if not await self._run(os.path.exists, image_data.image_file):
+            # reassembled from the chunk store by the Flask handler
+            return await self.call_wsgi_app(request)
+        return await self._send_file(request, image_data.image_file, image_data.image_hash, headers=headers)
+
+    async def _rollout_gate(self, request, image_data):
+        client_mac_address = request.query.get("mac") or request.headers.get("X-Client-MAC")
+        if await self._run(self.server._rollout_download_allowed, image_data, client_mac_address):
+            return None
+        return self._json_response(
+            {"message": "Download slot not available yet, retry later", "data": None, "error": None},
+            status=429,
+            headers={"Retry-After": str(self.server.rollout_retry_after)},
+        )
+
+    async def serve_vm_image(self, request):
+        request_user, error_response = await self._authenticate(request)
+        if error_response is not None:
+            return error_response
+        image_data = await self._run(self.server.database.get_image_by_id, request.match_info["vm_id"])
+        if image_data is None:
+            return self._not_found("Image not found in database")
+        rollout_response = await self._rollout_gate(request, image_data)
+        if rollout_response is not None:
+            return rollout_response
+        return await self._send_image(request, image_data)
+
+    async def serve_vm_image_delta(self, request):
+        request_user, error_response = await self._authenticate(request)
+        if error_response is not None:
+            return error_response
+        database = self.server.database
+        image_data = await self._run(database.get_image_by_id, request.match_info["vm_id"])
+        if image_data is None:
+            return self._not_found("Image not found in database")
+        rollout_response = await self._rollout_gate(request, image_data)
+        if rollout_response is not None:
+            return rollout_response
+        old_image_id = request.query.get("from")
+        old_image = None
+        if old_image_id is not None and old_image_id.isdigit():
+            old_image = await self._run(database.get_image_by_id, int(old_image_id))
+        if old_image is not None:
+            image_delta_path = delta_path(self.server.delta_directory, old_image.image_id, image_data.image_id)
+            if await self._run(os.path.exists, image_delta_path):
+                return await self._send_file(
+                    request, image_delta_path, f"{old_image.image_hash}..{image_data.image_hash}",
+                    headers={"X-Image-Delta": str(old_image.image_id)},
+                )
+        return await self._send_image(request, image_data, headers={"X-Image-Delta": "full"})
+
+    async def serve_chunk(self, request):
+        request_user, error_response = await self._authenticate(request)
+        if error_response is not None:
+            return error_response
+        chunk_store = self.server.chunk_store
+        chunk_hash = request.match_info["chunk_hash"]
+        if chunk_store is None or not re.fullmatch(r"[0-9a-f]{64}", chunk_hash) \
+                or not await self._run(chunk_store.has_chunk, chunk_hash):
+            return self._not_found("Chunk not found")
+        if self.server.swarm_server_offload and request.query.get("fallback") != "1":
+            # the peer lookup answers with 409 and is left to the Flask handler
+            return await self.call_wsgi_app(request)
+        return await self._send_file(request, chunk_store.chunk_path(chunk_hash), chunk_hash, max_age=31536000)
+
+    async def get_client_changes(self, request):
+        request_user, error_response = await self._authenticate(request)
+        if error_response is not None:
+            return error_response
+        database = self.server.database
+        change_feed = self.server.change_feed
+        client_mac_address = request.match_info["client_mac_address"]
+        try:
+            if not await self._run(self.server._client_exists, client_mac_address):
+                return self._not_found("Client not found in database")
+            if "text/event-stream" in request.headers.get("Accept", ""):
+                cursor = request.headers.get("Last-Event-ID", request.query.get("since"))
+                if cursor is None or not cursor.isdigit():
+                    cursor = await self._run(change_feed.current_seq)
+                return await self._stream_client_changes(request, client_mac_address, int(cursor))
+            since = request.query.get("since")
+            if since is None or not since.lstrip("-").isdigit():
+                changes = []
+                cursor = await self._run(change_feed.current_seq)
+            else:
+                since = int(since)
+                try:
+                    timeout = float(request.query.get("timeout", self.server.change_feed_max_wait))
+                except ValueError:
+                    timeout = self.server.change_feed_max_wait
+                timeout = min(max(timeout, 0), self.server.change_feed_max_wait)
+                changes = await change_feed.wait_async(client_mac_address, since, timeout, self.executor)
+                cursor = changes[-1].seq if changes else since
+            vm_list = await self._run(self.server._get_client_image_ids, client_mac_address)
+            return self._json_response({
+                "message": None,
+                "data": {
+                    "cursor": cursor,
+                    "changes": [change.as_dict() for change in changes],
+                    "vm_list": vm_list,
+                },
+                "error": None
+            })
+        except Exception as ex:
+            return self._json_response(
+                {"message": "Internal server error", "data": None, "error": str(ex)}, status=500)
+
+    async def _stream_client_changes(self, request, client_mac_address: str, cursor: int):
+        keepalive = self.server.change_feed_keepalive
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+        })
+        await response.prepare(request)
+        await response.write(f"retry: {keepalive * 1000}\n\n".encode("utf-8"))
+        while True:
+            try:
+                changes = await self.server.change_feed.wait_async(
+                    client_mac_address, cursor, keepalive, self.executor)
+            except Exception as ex:
+                # the client reconnects with Last-Event-ID
+                self.server.database.logger.error(f"Error streaming changes of {client_mac_address}: {ex}")
+                return response
+            if not changes:
+                await response.write(b": keepalive\n\n")
+                continue
+            for change in changes:
+                await response.write(
+                    f"id: {change.seq}\nevent: {change.change}\ndata: {json.dumps(change.as_dict())}\n\n"
+                    .encode("utf-8"))
+            cursor = changes[-1].seq
+
+    async def call_wsgi_app(self, request):
+        """Run a request through the Flask app on the thread pool."""
+        # request bodies (upload parts) are spooled to disk past 1 MiB
+        body = tempfile.SpooledTemporaryFile(max_size=1024 * 1024)
+        async for block in request.content.iter_chunked(self.file_block_size):
+            await self._run(body.write, block)
+        content_length = body.tell()
+        body.seek(0)
+        environ = {
+            "REQUEST_METHOD": request.method,
+            "SCRIPT_NAME": "",
+            "PATH_INFO": urllib.parse.unquote_to_bytes(request.raw_path.split("?", 1)[0]).decode("latin-1"),
+            "QUERY_STRING": request.query_string,
+            "SERVER_NAME": self.server.host,
+            "SERVER_PORT": str(self.server.port),
+            "SERVER_PROTOCOL": f"HTTP/{request.version.major}.{request.version.minor}",
+            "REMOTE_ADDR": request.remote or "",
+            "CONTENT_LENGTH": str(content_length),
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": request.scheme,
+            "wsgi.input": body,
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        if "Content-Type" in request.headers:
+            environ["CONTENT_TYPE"] = request.headers["Content-Type"]
+        for name, value in request.headers.items():
+            key = "HTTP_" + name.upper().replace("-", "_")
+            if key not in ["HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"]:
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start["status"] = int(status.split(" ", 1)[0])
+            response_start["headers"] = headers
+
+        def first_block():
+            body_iterable = self.server.flask_app(environ, start_response)
+            body_iterator = iter(body_iterable)
+            return body_iterable, body_iterator, next(body_iterator, None)
+
+        body_iterable = None
+        try:
+            body_iterable, body_iterator, block = await self._run(first_block)
+            response = web.StreamResponse(status=response_start["status"])
+            for name, value in response_start["headers"]:
+                response.headers.add(name, value)
+            await response.prepare(request)
+            # streamed responses (images from the chunk store) are read one
+            # block at a time on the thread pool
+            while block is not None:
+                if block:
+                    await response.write(block)
+                block = await self._run(next, body_iterator, None)
+            await response.write_eof()
+            return response
+        finally:
+            body.close()
+            if hasattr(body_iterable, "close"):
+                await self._run(body_iterable.close)
+
+    def run(self):
+        web.run_app(self.app, host=self.server.host, port=int(self.server.port), print=None)
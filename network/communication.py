@@ -1,13 +1,58 @@
 from http.client import NON_AUTHORITATIVE_INFORMATION
-from flask import Flask, request, jsonify, send_file, make_response
+from flask import Flask, request, jsonify, make_response, g
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_accept_header
+from werkzeug.wsgi import FileWrapper, ClosingIterator, wrap_file
 from utils.database.database import Database
 from utils.exceptions import DatabaseException
-from utils.models.models import Client, VMImage, User
-from utils.middleware.auth import require_auth
+from utils.models.models import Client, VMImage, User, UploadSession
+from utils.hashing.hashing import SUPPORTED_ALGORITHMS, TreeHasher, hash_file, rehash_file, BlockHashCache
+from utils.middleware.auth import require_auth, AuthCache, PasswordVerifier, PasswordVerifierBusy, issue_tokens, decode_token, password_fingerprint
+from utils.cache.cache import LRUCache, ResponseCache
+from utils.changefeed.changefeed import ChangeFeed
+from utils.metrics.metrics import REGISTRY, EXPOSITION_CONTENT_TYPE
+from utils.storage.storage import ChunkStore
+from utils.delta.delta import delta_path, build_delta_from_previous_version
+from utils.encoding.encoding import SUPPORTED_ENCODINGS, build_image_variants, load_image_variants, variant_path
+from utils.jobs.jobs import JobQueue
+from utils.fleetindex.fleetindex import FleetIndex
 import json
-import bcrypt
 import jwt
 import base64
+import datetime
+import fcntl
+import hashlib
+import io
+import os
+import random
+import re
+import threading
+import time
+import uuid
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "orchestrator_http_request_duration_seconds", "Time to build the response of a request", ["method", "route"])
+HTTP_REQUESTS = REGISTRY.counter(
+    "orchestrator_http_requests_total", "Requests by response status", ["method", "route", "status"])
+DOWNLOAD_BYTES = REGISTRY.counter(
+    "orchestrator_download_bytes_total", "Bytes of image, delta and chunk downloads", ["route"])
+DOWNLOADS_IN_FLIGHT = REGISTRY.gauge(
+    "orchestrator_downloads_in_flight", "Image, delta and chunk downloads being sent", ["route"])
+
+
+class _DownloadFile(io.FileIO):
+    """File being downloaded; on_close runs once the WSGI server closed it
+    after sending. Being a real file, wsgi.file_wrapper can still use
+    sendfile for it."""
+    on_close = None
+
+    def close(self):
+        on_close, self.on_close = self.on_close, None
+        try:
+            super().close()
+        finally:
+            if on_close is not None:
+                on_close()
 
 
 class FlaskAppWrapper(object):
@@ -30,24 +75,121 @@ class FlaskAppWrapper(object):
 
 class Server():
 
-    def __init__(self, host: str, port: int, name: str, access_password: str, access_username: str, jwt_secret: str, version: str, database_file_path: str, logging_level: str, ):
+    def __init__(self, host: str, port: int, name: str, access_password: str, access_username: str, jwt_secret: str, version: str, database_file_path: str, logging_level: str, database_options: dict = None, auth_cache_size: int = 1024, auth_cache_ttl: int = 300, client_batch_max_size: int = 1000, list_page_size: int = 100, list_page_max_size: int = 1000, image_store_path: str = None, image_directory: str = "images", image_hash_algorithm: str = "sha256", upload_session_ttl: int = 86400, delta_directory: str = "deltas", swarm_peer_ttl: int = 600, swarm_max_peers: int = 20, swarm_server_offload: bool = False, rollout_wave_size: int = 50, rollout_max_in_flight: int = 10, rollout_download_timeout: int = 3600, rollout_wave_timeout: int = 86400, rollout_expiry_interval: int = 300, rollout_retry_after: int = 60, response_cache_size: int = 4096, response_cache_ttl: int = 60, change_feed_poll_interval: float = 1.0, change_feed_retention: int = 86400, change_feed_max_wait: int = 60, change_feed_keepalive: int = 15, metrics_enabled: bool = True, access_token_ttl: int = 900, refresh_token_ttl: int = 2592000, bcrypt_rounds: int = 12, login_workers: int = 2, login_max_pending: int = 16, login_retry_after: int = 5, image_variant_directory: str = "variants", image_variant_encodings: list = None, image_variant_retry_interval: int = 3600, hash_workers: int = 0, hash_cache_file: str = "hash_cache.json", job_workers: int = 2, job_poll_interval: float = 1.0, job_retry_delay: int = 60, job_retention: int = 604800, image_scrub_interval: int = 86400, fleet_index_enabled: bool = False, fleet_index_refresh_interval: int = 60):
         self.host = host
         self.port = port
         self.name = name
         self.access_password = access_password
         self.access_username = access_username
         self.version = version
+        self.client_batch_max_size = client_batch_max_size
+        self.list_page_size = list_page_size
+        self.list_page_max_size = list_page_max_size
+        self.chunk_store = ChunkStore(image_store_path) if image_store_path else None
+        self.image_directory = image_directory
+        self.image_hash_algorithm = image_hash_algorithm
+        self.upload_session_ttl = upload_session_ttl
+        self.hash_workers = hash_workers
+        self.hash_cache_file = hash_cache_file
+        self.delta_directory = delta_directory
+        self.image_variant_directory = image_variant_directory
+        self.image_variant_encodings = [
+            encoding for encoding in (SUPPORTED_ENCODINGS if image_variant_encodings is None else image_variant_encodings)
+            if encoding in SUPPORTED_ENCODINGS
+        ]
+        # failed variant builds are queued again after this many seconds
+        self.image_variant_retry_interval = image_variant_retry_interval
+        # (image id, image hash) of the variant builds this process looked
+        # up lately, so downloads don't query the jobs table every time
+        self.variant_build_checks = LRUCache(max_size=response_cache_size, ttl=response_cache_ttl)
+        # variant sizes from the manifests on disk, by (image id, image hash)
+        self.image_variant_manifests = LRUCache(max_size=response_cache_size, ttl=response_cache_ttl)
+        self.swarm_peer_ttl = swarm_peer_ttl
+        self.swarm_max_peers = swarm_max_peers
+        self.swarm_server_offload = swarm_server_offload
+        self.rollout_wave_size = rollout_wave_size
+        self.rollout_max_in_flight = rollout_max_in_flight
+        self.rollout_download_timeout = rollout_download_timeout
+        self.rollout_wave_timeout = rollout_wave_timeout
+        self.rollout_retry_after = rollout_retry_after
+        self.access_token_ttl = access_token_ttl
+        self.refresh_token_ttl = refresh_token_ttl
+        self.login_retry_after = login_retry_after
+        self.password_verifier = PasswordVerifier(
+            rounds=bcrypt_rounds, max_workers=login_workers, max_pending=login_max_pending)
+        os.makedirs(image_directory, exist_ok=True)
+        # hash state of uploads in progress in this process, keyed by upload
+        # id, so consecutive parts don't re-read the partial last hash block
+        self.upload_hashers = {}
+        self.upload_hashers_lock = threading.Lock()
         self.database = Database(
-            database_file=database_file_path, logging_level=logging_level)
+            database_file=database_file_path, logging_level=logging_level, **(database_options or {}))
+        for encoding in set(image_variant_encodings or []) - set(self.image_variant_encodings):
+            self.database.logger.warning(f"Compressed image variants with {encoding} aren't available")
         self.flask_app = Flask(name)
         self.flask_app.config['SECRET_KEY'] = jwt_secret
         self.flask_app.config['DATABASE_FILE_PATH'] = database_file_path
         self.flask_app.config['LOGGING_LEVEL'] = logging_level
+        # share one database handle and token cache between all requests
+        # instead of rebuilding them in require_auth
+        self.auth_cache = AuthCache(max_size=auth_cache_size, ttl=auth_cache_ttl)
+        self.database.add_listener(self.auth_cache.handle_database_event)
+        # client records, client vm lists and image metadata polled by clients
+        self.response_cache = ResponseCache(max_size=response_cache_size, ttl=response_cache_ttl)
+        self.database.add_listener(self.response_cache.handle_database_event)
+        self.database.add_listener(self._handle_image_variant_event)
+        self.change_feed = ChangeFeed(
+            self.database, poll_interval=change_feed_poll_interval, retention=change_feed_retention)
+        self.database.add_listener(self.change_feed.handle_database_event)
+        self.change_feed_max_wait = change_feed_max_wait
+        self.change_feed_keepalive = change_feed_keepalive
+        self.metrics_enabled = metrics_enabled
+        # clients, images and assignments held in memory for the lookups below
+        self.fleet_index = None
+        if fleet_index_enabled:
+            self.fleet_index = FleetIndex(
+                self.database, refresh_interval=fleet_index_refresh_interval, change_feed=self.change_feed)
+            self.database.add_listener(self.fleet_index.handle_database_event)
+        self.job_queue = JobQueue(
+            self.database, workers=job_workers, poll_interval=job_poll_interval,
+            retry_delay=job_retry_delay, retention=job_retention)
+        self.database.add_listener(self.job_queue.handle_database_event)
+        self.job_queue.register(
+            "add_image", self._add_image_job,
+            required_fields={"image_name": str, "image_version": str, "image_file": str},
+            optional_fields={"hash_algorithm": str, "append_only": bool})
+        self.job_queue.register("build_variants", self._build_variants_job, required_fields={"image_id": int})
+        self.job_queue.register("scrub_images", self._scrub_images_job)
+        self.job_queue.register("expire_rollout_targets", self._expire_rollout_targets_job)
+        if image_scrub_interval:
+            self.job_queue.schedule("scrub_images", image_scrub_interval)
+        if rollout_expiry_interval:
+            self.job_queue.schedule("expire_rollout_targets", rollout_expiry_interval)
+        if metrics_enabled:
+            self.flask_app.before_request(self._start_request_timer)
+            self.flask_app.after_request(self._record_request)
+        self.flask_app.config['DATABASE'] = self.database
+        self.flask_app.config['AUTH_CACHE'] = self.auth_cache
         self.app = FlaskAppWrapper(self.flask_app)
 
     def basic_server_data(self):
         return {"server_name": self.name, "server_version": self.version, "host": self.host}
 
+    def _start_request_timer(self):
+        g.request_started = time.perf_counter()
+
+    def _record_request(self, response):
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        # unset when the request failed before the timer was started
+        request_started = g.get("request_started")
+        if request_started is not None:
+            HTTP_REQUEST_SECONDS.observe(time.perf_counter() - request_started, request.method, route)
+        HTTP_REQUESTS.inc(1, request.method, route, str(response.status_code))
+        return response
+
+    def get_metrics(self):
+        return self.flask_app.response_class(REGISTRY.expose(), content_type=EXPOSITION_CONTENT_TYPE)
+
     def login(self):
         try:
             request_data = request.json
@@ -66,29 +208,39 @@ class Server():
                     "data": None,
                     "error": "Bad request"
                 }, 400
-            correct_password = False
-            temporary_salt = bcrypt.gensalt()
-            hashed_request_password = bcrypt.hashpw(
-                password=request_data["password"].encode("utf-8"), salt=temporary_salt)
-            print(
-                f"Password: {request_data['password']}, password hash from database: {current_user.password_hash}")
-            # if current_user.password_hash != hashed_request_password:
-            if not bcrypt.checkpw(request_data["password"].encode("utf-8"), current_user.password_hash):
+            try:
+                password_is_correct = self.password_verifier.verify(
+                    request_data["password"], current_user.password_hash)
+            except PasswordVerifierBusy:
+                response = jsonify({
+                    "message": "Too many logins in progress, retry later",
+                    "data": None,
+                    "error": None
+                })
+                response.status_code = 503
+                response.headers.set("Retry-After", str(self.login_retry_after))
+                return response
+            if not password_is_correct:
                 return {
                     "message": "Invalid login data",
                     "data": None,
                     "error": "Auth error"
                 }, 401
+            if self.password_verifier.needs_rehash(current_user.password_hash):
+                # bcrypt_rounds changed, upgrade the stored hash now that
+                # the plain password is at hand
+                try:
+                    current_user.password_hash = self.password_verifier.rehash(request_data["password"])
+                    self.database.update_user_password_hash(current_user.username, current_user.password_hash)
+                except PasswordVerifierBusy:
+                    # the login is fine, the hash is upgraded on a later one
+                    pass
             try:
-                new_token = jwt.encode({
-                    "username": current_user.username
-                },
-                    self.flask_app.config["SECRET_KEY"],
-                    algorithm="HS256"
-                )
                 user_dictionary = current_user.as_dict()
                 user_dictionary.pop("password_hash")
-                user_dictionary["token"] = new_token
+                user_dictionary.update(issue_tokens(
+                    current_user, self.flask_app.config["SECRET_KEY"],
+                    self.access_token_ttl, self.refresh_token_ttl))
                 return user_dictionary, 202
             except Exception as ex:
                 return {
@@ -103,6 +255,43 @@ class Server():
                 "error": f"Internal server error: {str(ex)}",
             }, 500
 
+    def refresh_token(self):
+        """New token pair for a refresh token, without the bcrypt check of
+        a full login."""
+        try:
+            request_data = request.json
+            if not request_data or not request_data.get("refresh_token"):
+                return {
+                    "message": "Please provide a refresh token",
+                    "data": None,
+                    "error": "Bad request"
+                }, 400
+            try:
+                claims = decode_token(
+                    request_data["refresh_token"], self.flask_app.config["SECRET_KEY"], "refresh")
+            except jwt.InvalidTokenError as ex:
+                return {
+                    "message": "Invalid refresh token",
+                    "data": None,
+                    "error": str(ex)
+                }, 401
+            current_user = self.database.get_user_by_name(claims["username"])
+            if current_user is None or claims.get("pwd") != password_fingerprint(current_user.password_hash):
+                return {
+                    "message": "Invalid refresh token",
+                    "data": None,
+                    "error": "Unauthorized"
+                }, 401
+            return issue_tokens(
+                current_user, self.flask_app.config["SECRET_KEY"],
+                self.access_token_ttl, self.refresh_token_ttl), 200
+        except Exception as ex:
+            return {
+                "message": "Error refreshing token",
+                "data": None,
+                "error": f"Internal server error: {str(ex)}",
+            }, 500
+
     @require_auth
     def register_new_client_to_database(request_user, self):
         request_content_type = request.headers.get('Content-Type')
@@ -138,7 +327,8 @@ class Server():
                     image_name_version_combo=f"{json_object['image_name']}@{json_object['image_version']}",
                     clients=[]
                 )
-                self.database.add_client(new_image_object)
+                self.database.add_image(new_image_object)
+                self._build_variants_in_background(new_image_object)
                 response = jsonify(success=True)
                 response.status_code = 201
                 return response
@@ -157,7 +347,8 @@ class Server():
         if request_content_type == 'application/json':
             json_object = request.json
             try:
-                old_client: Client = self.database.get_client_by_mac_address(json_object["mac_address"])
+                old_client: Client = self.database.get_client_by_mac_address(
+                    json_object["mac_address"], replica=False)
                 if old_client == None:
                     response = jsonify({
                         "message": "client not found",
@@ -190,11 +381,296 @@ class Server():
                 response.status_code = 400
                 return response
     
+    @require_auth
+    def batch_update_clients(request_user, self):
+        json_object = request.get_json(silent=True)
+        if not isinstance(json_object, list):
+            response = jsonify({
+                "message": "Expected a JSON array of client records",
+                "data": None,
+                "error": "Bad request"
+            })
+            response.status_code = 400
+            return response
+        if len(json_object) > self.client_batch_max_size:
+            response = jsonify({
+                "message": f"Batch is limited to {self.client_batch_max_size} clients",
+                "data": None,
+                "error": "Bad request"
+            })
+            response.status_code = 413
+            return response
+        required_fields = ["mac_address", "ip_address", "hostname", "client_version"]
+        item_statuses = []
+        valid_records = []
+        for record in json_object:
+            missing_fields = [
+                field for field in required_fields
+                if not isinstance(record, dict) or not isinstance(record.get(field), str)
+            ]
+            if missing_fields:
+                item_statuses.append({
+                    "mac_address": record.get("mac_address") if isinstance(record, dict) else None,
+                    "status": "invalid",
+                    "error": f"Missing or invalid fields: {', '.join(missing_fields)}"
+                })
+            else:
+                item_statuses.append({"mac_address": record["mac_address"], "status": None, "error": None})
+                valid_records.append(record)
+        try:
+            upsert_results = self.database.upsert_clients(valid_records)
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+        for item_status in item_statuses:
+            if item_status["status"] is None:
+                item_status["status"] = upsert_results[item_status["mac_address"]]
+        response = jsonify({
+            "message": "Batch processed",
+            "data": item_statuses,
+            "error": None
+        })
+        response.status_code = 200
+        return response
+
+    @require_auth
+    def create_rollout(request_user, self):
+        json_object = request.get_json(silent=True) or {}
+        image_id = json_object.get("image_id")
+        selector = {
+            key: json_object[key]
+            for key in ["client_version", "hostname_pattern", "mac_addresses"]
+            if json_object.get(key) is not None
+        }
+        wave_size = json_object.get("wave_size", self.rollout_wave_size)
+        max_in_flight = json_object.get("max_in_flight", self.rollout_max_in_flight)
+        if not isinstance(image_id, int) or not selector \
+                or not isinstance(selector.get("client_version", ""), str) \
+                or not isinstance(selector.get("hostname_pattern", ""), str) \
+                or not isinstance(selector.get("mac_addresses", []), list) \
+                or not isinstance(wave_size, int) or wave_size < 1 \
+                or not isinstance(max_in_flight, int) or max_in_flight < 1:
+            response = jsonify({
+                "message": "Bad input",
+                "data": None,
+                "error": "image_id and at least one of client_version, hostname_pattern or mac_addresses are required"
+            })
+            response.status_code = 400
+            return response
+        try:
+            # the image may have been added moments ago
+            if self.database.get_image_by_id(image_id, replica=False) == None:
+                return self._image_not_found()
+            selected_mac_addresses = None
+            if self.fleet_index is not None:
+                # hostname patterns can't use an index in SQLite
+                selected_mac_addresses = self.fleet_index.select_clients(**selector)
+            rollout = self.database.create_rollout(
+                image_id, selector, wave_size, max_in_flight, selected_mac_addresses=selected_mac_addresses)
+            if rollout is None:
+                response = jsonify({
+                    "message": "No client matches the selector",
+                    "data": None,
+                    "error": None
+                })
+                response.status_code = 404
+                return response
+            response = jsonify({
+                "message": "Rollout started",
+                "data": rollout.as_dict(),
+                "error": None
+            })
+            response.status_code = 201
+            return response
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+
+    @require_auth
+    def get_rollout_status(request_user, self, rollout_id):
+        try:
+            rollout = self.database.get_rollout(rollout_id)
+            if rollout == None:
+                response = jsonify({
+                    "message": "Rollout not found in database",
+                    "data": None,
+                    "error": None
+                })
+                response.status_code = 404
+                return response
+            rollout_data = rollout.as_dict()
+            rollout_data["waves"] = self.database.get_rollout_progress(rollout_id)
+            return jsonify({
+                "message": None,
+                "data": rollout_data,
+                "error": None
+            })
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+
+    @require_auth
+    def update_rollout_client(request_user, self, rollout_id, client_mac_address):
+        """A client reports it finished (or failed) installing the rolled out image."""
+        json_object = request.get_json(silent=True) or {}
+        state = json_object.get("state")
+        if state not in ["downloading", "done", "failed"]:
+            response = jsonify({
+                "message": "Bad input",
+                "data": None,
+                "error": "state must be one of downloading, done or failed"
+            })
+            response.status_code = 400
+            return response
+        try:
+            if not self.database.update_rollout_target(int(rollout_id), client_mac_address, state):
+                response = jsonify({
+                    "message": "Client is not part of the rollout",
+                    "data": None,
+                    "error": None
+                })
+                response.status_code = 404
+                return response
+            return jsonify({
+                "message": "Rollout progress saved",
+                "data": None,
+                "error": None
+            })
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+
+    def _encode_cursor(self, key):
+        return base64.urlsafe_b64encode(json.dumps(key).encode("utf-8")).decode("ascii")
+
+    def _decode_cursor(self, cursor: str):
+        return json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+
+    def _list_page(self, get_page, key_field: str, filter_names: list[str]):
+        try:
+            limit = int(request.args.get("limit", self.list_page_size))
+            if limit < 1 or limit > self.list_page_max_size:
+                raise ValueError(f"limit has to be between 1 and {self.list_page_max_size}")
+            cursor = request.args.get("cursor")
+            after = self._decode_cursor(cursor) if cursor else None
+            if after is not None and not isinstance(after, int if key_field == "image_id" else str):
+                raise ValueError("Invalid cursor")
+            fields = request.args.get("fields")
+            fields = fields.split(",") if fields else None
+            filters = {name: request.args[name] for name in filter_names if name in request.args}
+        except Exception as ex:
+            response = jsonify({
+                "message": "Bad input",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 400
+            return response
+        try:
+            page = get_page(after=after, limit=limit, fields=fields, **filters)
+        except ValueError as ex:
+            # fields the table doesn't have
+            response = jsonify({
+                "message": "Bad input",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 400
+            return response
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+        next_cursor = None
+        if len(page) == limit:
+            last_key = page[-1][key_field]
+            next_cursor = self._encode_cursor(int(last_key) if key_field == "image_id" else last_key)
+        if fields is not None and key_field not in fields:
+            for row in page:
+                row.pop(key_field)
+        return jsonify({
+            "message": None,
+            "data": page,
+            "next_cursor": next_cursor,
+            "error": None
+        })
+
+    @require_auth
+    def list_clients(request_user, self):
+        return self._list_page(self.database.get_clients_page, "mac_address",
+                               ["client_version", "hostname_prefix"])
+
+    @require_auth
+    def list_images(request_user, self):
+        return self._list_page(self.database.get_images_page, "image_id", ["image_name"])
+
+    def _cached_json_response(self, cache_key, load):
+        """JSON response for a cached read, None when load() finds nothing.
+
+        The body is serialized once per cache fill; its hash is the ETag so
+        polling clients sending If-None-Match get a 304.
+        """
+        def load_body():
+            data = load()
+            if data is None:
+                return None
+            body = self.flask_app.json.dumps(data) + "\n"
+            return body, hashlib.sha1(body.encode("utf-8")).hexdigest()
+        cached = self.response_cache.get_or_load(cache_key, load_body)
+        if cached is None:
+            return None
+        body, etag = cached
+        response = self.flask_app.response_class(body, mimetype="application/json")
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        return response.make_conditional(request)
+
+    @require_auth
+    def get_cache_stats(request_user, self):
+        return jsonify({
+            "message": None,
+            "data": {
+                "auth": self.auth_cache.stats(),
+                "responses": self.response_cache.stats(),
+                "fleet_index": self.fleet_index.stats() if self.fleet_index is not None else None,
+            },
+            "error": None
+        })
+
     @require_auth
     def get_client_data(request_user, self, client_mac_address):
         try:
-            client_data = self.database.get_client_by_mac_address(client_mac_address)
-            if client_data == None:    
+            def load_client():
+                if self.fleet_index is not None:
+                    return self.fleet_index.get_client(client_mac_address)
+                client_data = self.database.get_client_by_mac_address(client_mac_address)
+                return client_data.as_dict() if client_data is not None else None
+            response = self._cached_json_response(("client", client_mac_address), load_client)
+            if response == None:
                 response = jsonify({
                     "message": "Client not found in database",
                     "data": None,
@@ -202,7 +678,7 @@ class Server():
                 })
                 response.status_code = 404
                 return response
-            return jsonify(client_data.as_dict())
+            return response
         except Exception as ex:
             response = jsonify({
                 "message": "Internal server error",
@@ -215,8 +691,11 @@ class Server():
     @require_auth
     def get_client_list_of_vms(request_user, self, client_mac_address):
         try:
-            vm_ids_list = self.database.get_client_vm_list_by_mac_address(client_mac_address)
-            return jsonify(vm_ids_list)
+            response = self._cached_json_response(
+                ("client_vms", client_mac_address),
+                lambda: self._get_client_image_ids(client_mac_address),
+            )
+            return response if response is not None else jsonify(None)
         except Exception as ex:
             response = jsonify({
                 "message": "Internal server error",
@@ -226,11 +705,105 @@ class Server():
             response.status_code = 500
             return response
     
+    def _client_exists(self, client_mac_address: str) -> bool:
+        if self.fleet_index is not None:
+            return self.fleet_index.has_client(client_mac_address)
+        return self.database.get_client_by_mac_address(client_mac_address) is not None
+
+    def _get_client_image_ids(self, client_mac_address: str) -> list[int]:
+        if self.fleet_index is not None:
+            return self.fleet_index.get_client_image_ids(client_mac_address)
+        return self.database.get_client_vm_list_by_mac_address(client_mac_address)
+
+    @require_auth
+    def get_client_changes(request_user, self, client_mac_address):
+        """Push channel for image assignment changes of a client.
+
+        Long-poll: GET ?since=<cursor>&timeout=<seconds> returns as soon as
+        there are changes after the cursor, or with an empty list once the
+        timeout passes. Without since it returns the current cursor at once.
+        Every response carries the client's current vm list and the cursor
+        to pass next.
+
+        With Accept: text/event-stream the changes are streamed as server
+        sent events instead, resuming after the Last-Event-ID header.
+        """
+        try:
+            if not self._client_exists(client_mac_address):
+                response = jsonify({
+                    "message": "Client not found in database",
+                    "data": None,
+                    "error": None
+                })
+                response.status_code = 404
+                return response
+            if "text/event-stream" in request.headers.get("Accept", ""):
+                cursor = request.headers.get("Last-Event-ID", request.args.get("since"))
+                cursor = int(cursor) if cursor is not None and cursor.isdigit() else self.change_feed.current_seq()
+                return self._stream_client_changes(client_mac_address, cursor)
+            since = request.args.get("since", type=int)
+            if since is None:
+                changes = []
+                cursor = self.change_feed.current_seq()
+            else:
+                timeout = min(
+                    max(request.args.get("timeout", self.change_feed_max_wait, type=float), 0),
+                    self.change_feed_max_wait,
+                )
+                changes = self.change_feed.wait(client_mac_address, since, timeout)
+                cursor = changes[-1].seq if changes else since
+            return jsonify({
+                "message": None,
+                "data": {
+                    "cursor": cursor,
+                    "changes": [change.as_dict() for change in changes],
+                    "vm_list": self._get_client_image_ids(client_mac_address),
+                },
+                "error": None
+            })
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+
+    def _stream_client_changes(self, client_mac_address: str, cursor: int):
+        def generate_events(cursor):
+            yield f"retry: {self.change_feed_keepalive * 1000}\n\n"
+            while True:
+                try:
+                    changes = self.change_feed.wait(client_mac_address, cursor, self.change_feed_keepalive)
+                except Exception as ex:
+                    # the client reconnects with Last-Event-ID
+                    self.database.logger.error(f"Error streaming changes of {client_mac_address}: {ex}")
+                    return
+                if not changes:
+                    yield ": keepalive\n\n"
+                    continue
+                for change in changes:
+                    yield f"id: {change.seq}\nevent: {change.change}\ndata: {json.dumps(change.as_dict())}\n\n"
+                cursor = changes[-1].seq
+        response = self.flask_app.response_class(generate_events(cursor), mimetype="text/event-stream")
+        response.cache_control.no_cache = True
+        # keep reverse proxies from buffering the stream
+        response.headers.set("X-Accel-Buffering", "no")
+        return response
+
     @require_auth
     def get_vm_data(request_user, self, vm_id):
         try:
-            vm_image: VMImage = self.database.get_image_by_id(vm_id)
-            return jsonify(vm_image.as_dict())
+            def load_image():
+                if self.fleet_index is not None:
+                    return self.fleet_index.get_image(int(vm_id))
+                vm_image: VMImage = self.database.get_image_by_id(vm_id)
+                return vm_image.as_dict() if vm_image is not None else None
+            response = self._cached_json_response(("image", int(vm_id)), load_image)
+            if response == None:
+                return self._image_not_found()
+            return response
         except Exception as ex:
             response = jsonify({
                 "message": "Internal server error",
@@ -240,46 +813,1022 @@ class Server():
             response.status_code = 500
             return response
     
+    @require_auth
+    def get_vm_clients(request_user, self, vm_id):
+        try:
+            if self.fleet_index is not None:
+                if self.fleet_index.get_image(int(vm_id)) is None:
+                    return self._image_not_found()
+                return jsonify(self.fleet_index.get_image_clients(int(vm_id)))
+            vm_image: VMImage = self.database.get_image_by_id(vm_id)
+            if vm_image == None:
+                response = jsonify({
+                    "message": "Image not found in database",
+                    "data": None,
+                    "error": None
+                })
+                response.status_code = 404
+                return response
+            clients = self.database.get_clients_by_image_id(vm_image.image_id)
+            return jsonify([client.as_dict() for client in clients])
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+
+    def _send_stream(self, stream, size: int, etag: str, max_age: int = None, last_modified: float = None):
+        """Send a seekable file object with the same conditional and Range
+        handling send_file applies to files on disk."""
+        if isinstance(stream, io.FileIO):
+            # the server's wsgi.file_wrapper, sendfile where supported
+            body = wrap_file(request.environ, stream, buffer_size=1024 * 1024)
+        else:
+            body = FileWrapper(stream, buffer_size=1024 * 1024)
+        response = self.flask_app.response_class(
+            body,
+            mimetype="application/octet-stream",
+            direct_passthrough=True,
+        )
+        response.content_length = size
+        if last_modified is not None:
+            response.last_modified = last_modified
+        response.set_etag(etag)
+        if max_age is not None:
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+        else:
+            response.cache_control.no_cache = True
+        try:
+            response = response.make_conditional(request, accept_ranges=True, complete_length=size)
+        except HTTPException:
+            stream.close()
+            raise
+        if self.metrics_enabled and response.status_code in [200, 206]:
+            self._track_download(response, stream)
+        return response
+
+    def _send_file(self, file_path: str, etag: str, max_age: int = None):
+        file_stream = _DownloadFile(file_path, "rb")
+        file_stat = os.fstat(file_stream.fileno())
+        return self._send_stream(
+            file_stream, file_stat.st_size, etag, max_age=max_age, last_modified=file_stat.st_mtime)
+
+    def _track_download(self, response, stream):
+        """Count a download as in flight until the server closes its body."""
+        route = request.url_rule.rule
+        size = response.content_length or 0
+        DOWNLOADS_IN_FLIGHT.inc(1, route)
+
+        def download_finished():
+            DOWNLOADS_IN_FLIGHT.dec(1, route)
+            # the size the response announced, also for aborted downloads
+            DOWNLOAD_BYTES.inc(size, route)
+        if isinstance(stream, _DownloadFile):
+            stream.on_close = download_finished
+        else:
+            response.response = ClosingIterator(response.response, [download_finished])
+
+    def _open_image_from_store(self, vm_image: VMImage):
+        if self.chunk_store is None:
+            return None
+        manifest = self.database.get_image_manifest(vm_image.image_id)
+        if not manifest:
+            return None
+        return self.chunk_store.open_image(
+            [(chunk.chunk_hash, chunk.chunk_offset, chunk.chunk_size) for chunk in manifest])
+
+    def _image_not_found(self):
+        response = jsonify({
+            "message": "Image not found in database",
+            "data": None,
+            "error": None
+        })
+        response.status_code = 404
+        return response
+
+    def _send_image(self, image_data: VMImage):
+        variant = self._negotiate_image_variant(image_data, request.headers.get("Accept-Encoding"))
+        if variant is not None:
+            encoding, image_variant_path = variant
+            # Range requests address the compressed bytes, the ETag tells
+            # the variants apart so If-Range can't mix them up
+            response = self._send_file(image_variant_path, f"{image_data.image_hash}-{encoding}")
+            response.headers.set("Content-Encoding", encoding)
+        else:
+            response = self._send_image_data(image_data)
+        if self.image_variant_encodings:
+            response.vary.add("Accept-Encoding")
+        return response
+
+    def _negotiate_image_variant(self, image_data: VMImage, accept_encoding: str):
+        """(encoding, path) of the compressed variant of an image to send
+        for an Accept-Encoding header, or None to send the image itself.
+
+        Variants are never built on the request path, missing ones are
+        built in the background for later requests.
+        """
+        if not self.image_variant_encodings:
+            return None
+        manifest_key = (image_data.image_id, image_data.image_hash)
+        variant_sizes = self.image_variant_manifests.get(manifest_key)
+        if variant_sizes is None:
+            variant_sizes = load_image_variants(self.image_variant_directory, image_data)
+            if variant_sizes is None:
+                self._build_variants_in_background(image_data)
+                return None
+            self.image_variant_manifests.set(manifest_key, variant_sizes)
+        if not accept_encoding:
+            return None
+        encoding = parse_accept_header(accept_encoding).best_match(
+            [encoding for encoding in self.image_variant_encodings if encoding in variant_sizes])
+        if encoding is None:
+            return None
+        return encoding, variant_path(self.image_variant_directory, image_data.image_id, encoding)
+
+    def _handle_image_variant_event(self, event: str, payload: dict):
+        if event == "image_changed":
+            self.image_variant_manifests.invalidate_where(lambda key, value: key[0] == payload["image_id"])
+
+    def _build_variants_in_background(self, image: VMImage):
+        if not self.image_variant_encodings:
+            return
+        build_key = (image.image_id, image.image_hash)
+        if self.variant_build_checks.get(build_key) is not None:
+            return
+        self.variant_build_checks.set(build_key, True)
+        # one key per image version, so a failed build doesn't hold back
+        # the variants of a changed image
+        job_key = f"build_variants:{image.image_id}:{image.image_hash}"
+        try:
+            job = self.database.get_latest_job("build_variants", job_key=job_key)
+            if job is not None and (job.status in ["queued", "running"] or (
+                    job.finished_at is not None and job.finished_at > datetime.datetime.utcnow()
+                    - datetime.timedelta(seconds=self.image_variant_retry_interval))):
+                # a build that failed, or finished without leaving variants
+                # behind, is queued again once the retry interval passed
+                return
+            self.job_queue.submit("build_variants", {"image_id": image.image_id}, job_key=job_key)
+        except Exception as ex:
+            self.database.logger.error(
+                f"Error queueing compressed variants for image with id={image.image_id}: {ex}")
+
+    def _build_variants_job(self, payload: dict, report_progress) -> dict:
+        # queued right after the image was added, don't read a lagging replica
+        image = self.database.get_image_by_id(payload["image_id"], replica=False)
+        if image is None:
+            # removed since the job was queued
+            return {"variants": {}}
+        variant_sizes = load_image_variants(self.image_variant_directory, image)
+        if variant_sizes is None:
+            variant_sizes = build_image_variants(
+                self.database, image, self.image_variant_directory, self.image_variant_encodings, self.chunk_store)
+        return {"variants": variant_sizes}
+
+    def _add_image_job(self, payload: dict, report_progress) -> dict:
+        """fleetcontrol add_image --background: hash an image file, then add
+        it to the database and the chunk store like add_image does."""
+        image_name_version_combo = f"{payload['image_name']}@{payload['image_version']}"
+        image_hash = hash_file(
+            payload["image_file"],
+            algorithm=payload.get("hash_algorithm", self.image_hash_algorithm),
+            workers=self.hash_workers or None,
+            cache=BlockHashCache(self.hash_cache_file),
+            append_only=payload.get("append_only", False),
+            progress=lambda fraction: report_progress(fraction * 0.9),
+        )
+        new_image = self.database.get_image_by_name_version_string(image_name_version_combo)
+        if new_image is None:
+            new_image = VMImage(
+                image_name=payload["image_name"],
+                image_file=payload["image_file"],
+                image_version=payload["image_version"],
+                image_hash=image_hash,
+                image_name_version_combo=image_name_version_combo,
+            )
+            self.database.add_image(new_image)
+        elif new_image.image_hash != image_hash:
+            raise Exception(f"Image {image_name_version_combo} already exists")
+        # an earlier attempt may have got this far already
+        if self.chunk_store is not None and not self.database.get_image_manifest(new_image.image_id, replica=False):
+            manifest = self.chunk_store.store_file(payload["image_file"])
+            self.database.set_image_manifest(new_image.image_id, manifest)
+        build_delta_from_previous_version(self.database, new_image, self.delta_directory, self.chunk_store)
+        self._build_variants_in_background(new_image)
+        return {"image_id": new_image.image_id, "image_hash": image_hash}
+
+    def _scrub_images_job(self, payload: dict, report_progress) -> dict:
+        """Hash every image file again and report the ones that no longer
+        match their image hash, or are gone."""
+        images = [image for image_page in self.database.iter_images(
+            page_size=self.list_page_max_size, fields=["image_id", "image_file", "image_hash"]) for image in image_page]
+        result = {"checked": 0, "mismatched": [], "missing": [], "unverifiable": []}
+        for index, image in enumerate(images):
+            report_progress(index / len(images))
+            image["image_id"] = int(image["image_id"])
+            if not os.path.exists(image["image_file"]):
+                # images kept only in the chunk store are checked chunk by chunk when read
+                if not self.database.get_image_manifest(image["image_id"]):
+                    result["missing"].append(image["image_id"])
+                continue
+            current_hash = rehash_file(
+                image["image_file"], image["image_hash"], workers=self.hash_workers or None,
+                progress=lambda fraction: report_progress((index + fraction) / len(images)))
+            if current_hash is None:
+                result["unverifiable"].append(image["image_id"])
+                continue
+            result["checked"] += 1
+            if current_hash != image["image_hash"]:
+                self.database.logger.error(
+                    f"File {image['image_file']} of image with id={image['image_id']} doesn't match the image hash")
+                result["mismatched"].append(image["image_id"])
+        for image_id in result["missing"]:
+            self.database.logger.error(f"File of image with id={image_id} is missing")
+        return result
+
+    def _expire_rollout_targets_job(self, payload: dict, report_progress) -> dict:
+        """Fail rollout clients that stopped reporting, so their waves finish."""
+        return {"expired": self.database.expire_rollout_targets(
+            self.rollout_download_timeout, self.rollout_wave_timeout)}
+
+    def _check_image_job_payload(self, payload: dict):
+        """Raise ValueError for an add_image job the API mustn't queue, the
+        API only adds image files from the image directory."""
+        image_directory = os.path.realpath(self.image_directory)
+        if os.path.commonpath([image_directory, os.path.realpath(payload["image_file"])]) != image_directory:
+            raise ValueError(f"image_file has to be in {self.image_directory}")
+        if payload.get("hash_algorithm", self.image_hash_algorithm) not in SUPPORTED_ALGORITHMS:
+            raise ValueError(f"hash_algorithm has to be one of: {', '.join(SUPPORTED_ALGORITHMS)}")
+
+    @require_auth
+    def create_job(request_user, self):
+        try:
+            json_object = request.get_json(silent=True)
+            if not isinstance(json_object, dict) or json_object.get("kind") not in self.job_queue.handlers:
+                response = jsonify({
+                    "message": f"kind has to be one of: {', '.join(self.job_queue.handlers)}",
+                    "data": None,
+                    "error": "Bad request"
+                })
+                response.status_code = 400
+                return response
+            kind = json_object["kind"]
+            payload = json_object.get("payload", {})
+            priority = json_object.get("priority", 0)
+            try:
+                if not isinstance(priority, int) or isinstance(priority, bool):
+                    raise ValueError("priority has to be an integer")
+                self.job_queue.check_payload(kind, payload)
+                if kind == "add_image":
+                    self._check_image_job_payload(payload)
+            except ValueError as ex:
+                response = jsonify({
+                    "message": "Bad input",
+                    "data": None,
+                    "error": str(ex)
+                })
+                response.status_code = 400
+                return response
+            job = self.job_queue.submit(kind, payload, priority=priority)
+            response = jsonify({
+                "message": "Job queued",
+                "data": job.as_dict(),
+                "error": None
+            })
+            response.status_code = 202
+            response.headers.set("Location", f"/jobs/{job.job_id}")
+            return response
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+
+    @require_auth
+    def get_job(request_user, self, job_id):
+        try:
+            job = self.database.get_job(job_id)
+            if job is None:
+                response = jsonify({
+                    "message": "Job not found",
+                    "data": None,
+                    "error": None
+                })
+                response.status_code = 404
+                return response
+            return jsonify({
+                "message": None,
+                "data": job.as_dict(),
+                "error": None
+            })
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+
+    def _send_image_data(self, image_data: VMImage):
+        if os.path.exists(image_data.image_file):
+            # streamed through wsgi.file_wrapper (sendfile where the WSGI
+            # server supports it), Range, If-Range and If-None-Match are
+            # checked against the image hash
+            return self._send_file(image_data.image_file, image_data.image_hash)
+        # the original file may have been removed once the image was
+        # split into the chunk store, reassemble it from its chunks
+        image_stream = self._open_image_from_store(image_data)
+        if image_stream is None:
+            response = jsonify({
+                "message": "Image file not found",
+                "data": None,
+                "error": None
+            })
+            response.status_code = 404
+            return response
+        return self._send_stream(image_stream, image_stream.size, image_data.image_hash)
+
+    def _rollout_download_allowed(self, image_data: VMImage, client_mac_address: str) -> bool:
+        """Whether a client may download an image now, rollouts hold back
+        clients whose download slot isn't open yet. Anonymous downloads
+        aren't limited."""
+        return not client_mac_address or self.database.begin_rollout_download(
+            image_data.image_id, client_mac_address, self.rollout_download_timeout)
+
+    def _rollout_gate(self, image_data: VMImage):
+        """429 response for clients of a rollout that have to wait, they
+        identify themselves with ?mac= or the X-Client-MAC header."""
+        client_mac_address = request.args.get("mac") or request.headers.get("X-Client-MAC")
+        if self._rollout_download_allowed(image_data, client_mac_address):
+            return None
+        response = jsonify({
+            "message": "Download slot not available yet, retry later",
+            "data": None,
+            "error": None
+        })
+        response.status_code = 429
+        response.headers.set("Retry-After", str(self.rollout_retry_after))
+        return response
+
     @require_auth
     def serve_vm_image(request_user, self, vm_id):
         try:
             image_data = self.database.get_image_by_id(vm_id)
-            with open(image_data.image_file, "rb") as image_file:
-                data = image_file.read()
-                response = make_response(data)
-                response.headers.set('Content-Type', 'application/octet-stream')
+            if image_data == None:
+                return self._image_not_found()
+            rollout_response = self._rollout_gate(image_data)
+            if rollout_response is not None:
+                return rollout_response
+            return self._send_image(image_data)
+        except HTTPException as ex:
+            return ex
+        except Exception as ex:
+            response = jsonify({
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+
+    @require_auth
+    def serve_vm_image_delta(request_user, self, vm_id):
+        """Serve the precomputed delta from image `from` to this image.
+
+        Falls back to the full image when no delta was computed (or it would
+        be larger than the image); the X-Image-Delta response header tells
+        the client which of the two it got.
+        """
+        try:
+            image_data = self.database.get_image_by_id(vm_id)
+            if image_data == None:
+                return self._image_not_found()
+            rollout_response = self._rollout_gate(image_data)
+            if rollout_response is not None:
+                return rollout_response
+            old_image_id = request.args.get("from", type=int)
+            old_image = self.database.get_image_by_id(old_image_id) if old_image_id is not None else None
+            if old_image is not None:
+                image_delta_path = delta_path(self.delta_directory, old_image.image_id, image_data.image_id)
+                if os.path.exists(image_delta_path):
+                    response = self._send_file(
+                        image_delta_path, f"{old_image.image_hash}..{image_data.image_hash}")
+                    response.headers.set("X-Image-Delta", str(old_image.image_id))
+                    return response
+            response = self._send_image(image_data)
+            response.headers.set("X-Image-Delta", "full")
+            return response
+        except HTTPException as ex:
+            return ex
+        except Exception as ex:
+            response = jsonify({
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+
+    def _build_delta_in_background(self, new_image: VMImage):
+        def build_delta():
+            try:
+                build_delta_from_previous_version(
+                    self.database, new_image, self.delta_directory, self.chunk_store)
+            except Exception as ex:
+                self.database.logger.error(
+                    f"Error building delta for image with id={new_image.image_id}: {ex}")
+        threading.Thread(target=build_delta, daemon=True).start()
+
+    @require_auth
+    def get_vm_manifest(request_user, self, vm_id):
+        try:
+            manifest = self.database.get_image_manifest(vm_id)
+            if not manifest:
+                response = jsonify({
+                    "message": "Image has no manifest in the chunk store",
+                    "data": None,
+                    "error": None
+                })
+                response.status_code = 404
+                return response
+            # with ?have=<image id> only the chunks missing from that image
+            # are listed, e.g. when a client updates to a new version
+            present_chunk_hashes = set()
+            if "have" in request.args:
+                present_chunk_hashes = {
+                    chunk.chunk_hash for chunk in self.database.get_image_manifest(request.args["have"])}
+            return jsonify({
+                "message": None,
+                "data": {
+                    "image_id": int(vm_id),
+                    "image_size": sum(chunk.chunk_size for chunk in manifest),
+                    "chunks": [
+                        chunk.as_dict() for chunk in manifest
+                        if chunk.chunk_hash not in present_chunk_hashes
+                    ],
+                },
+                "error": None
+            })
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+
+    def _live_image_seeds(self, image_id: int):
+        return self.database.get_image_seeds(
+            image_id, datetime.datetime.utcnow() - datetime.timedelta(seconds=self.swarm_peer_ttl))
+
+    def _chunk_held_by_peers(self, chunk_hash: str) -> bool:
+        seen_after = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.swarm_peer_ttl)
+        return any(
+            seed.has_chunk(chunk_index)
+            for seed, chunk_index in self.database.get_chunk_seeds(chunk_hash, seen_after)
+        )
+
+    @require_auth
+    def get_vm_peers(request_user, self, vm_id):
+        """Tracker: peers holding chunks of an image, plus the chunk list.
+
+        Every chunk lists the indexes of the returned peers that hold it;
+        server_chunks are the chunks none of them has, which are the only
+        ones the client should download from the server.
+        """
+        try:
+            vm_image: VMImage = self.database.get_image_by_id(vm_id)
+            if vm_image == None:
+                return self._image_not_found()
+            manifest = self.database.get_image_manifest(vm_image.image_id)
+            if not manifest:
+                response = jsonify({
+                    "message": "Image has no manifest in the chunk store",
+                    "data": None,
+                    "error": None
+                })
+                response.status_code = 404
+                return response
+            requesting_mac = request.args.get("mac")
+            seeds = [
+                (seed, ip_address) for seed, ip_address in self._live_image_seeds(vm_image.image_id)
+                if seed.client_mac != requesting_mac
+            ]
+            # a random sample spreads the load over all seeds
+            random.shuffle(seeds)
+            seeds = seeds[:self.swarm_max_peers]
+            held_chunks = [seed.chunk_indexes(len(manifest)) for seed, _ in seeds]
+            chunks = []
+            server_chunks = []
+            for chunk in manifest:
+                chunk_dict = chunk.as_dict()
+                chunk_dict["peers"] = [
+                    peer_index for peer_index, peer_chunks in enumerate(held_chunks)
+                    if chunk.chunk_index in peer_chunks
+                ]
+                if not chunk_dict["peers"]:
+                    server_chunks.append(chunk.chunk_index)
+                chunks.append(chunk_dict)
+            return jsonify({
+                "message": None,
+                "data": {
+                    "image_id": vm_image.image_id,
+                    "image_hash": vm_image.image_hash,
+                    "image_size": sum(chunk.chunk_size for chunk in manifest),
+                    "peers": [
+                        {
+                            "mac_address": seed.client_mac,
+                            "ip_address": ip_address,
+                            "port": seed.peer_port,
+                            "complete": seed.complete,
+                        }
+                        for seed, ip_address in seeds
+                    ],
+                    "chunks": chunks,
+                    "server_chunks": server_chunks,
+                },
+                "error": None
+            })
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+
+    @require_auth
+    def announce_vm_seed(request_user, self, vm_id):
+        """A client announces the chunks of an image it can serve to peers."""
+        json_object = request.get_json(silent=True) or {}
+        mac_address = json_object.get("mac_address")
+        port = json_object.get("port")
+        chunk_indexes = json_object.get("chunks")
+        complete = json_object.get("complete", False)
+        if not isinstance(mac_address, str) \
+                or (port is not None and not isinstance(port, int)) \
+                or (not complete and (not isinstance(chunk_indexes, list)
+                                     or not all(isinstance(index, int) and index >= 0 for index in chunk_indexes))):
+            response = jsonify({
+                "message": "Bad input",
+                "data": None,
+                "error": "mac_address and either complete or a list of chunk indexes are required"
+            })
+            response.status_code = 400
+            return response
+        try:
+            if self.database.get_image_by_id(vm_id) == None:
+                return self._image_not_found()
+            if self.database.get_client_by_mac_address(mac_address) == None:
+                response = jsonify({
+                    "message": "Client not found in database",
+                    "data": None,
+                    "error": None
+                })
+                response.status_code = 404
+                return response
+            # the bitmap is sized by the highest index, don't let one allocate more than the image has
+            if not complete and chunk_indexes \
+                    and max(chunk_indexes) >= len(self.database.get_image_manifest(int(vm_id))):
+                response = jsonify({
+                    "message": "Bad input",
+                    "data": None,
+                    "error": "chunk index out of range of the image manifest"
+                })
+                response.status_code = 400
+                return response
+            self.database.announce_image_seed(
+                mac_address, int(vm_id), peer_port=port, chunk_indexes=None if complete else chunk_indexes)
+            return jsonify({
+                "message": "Announcement saved",
+                "data": None,
+                "error": None
+            })
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+
+    @require_auth
+    def serve_chunk(request_user, self, chunk_hash):
+        if self.chunk_store is None or not re.fullmatch(r"[0-9a-f]{64}", chunk_hash) \
+                or not self.chunk_store.has_chunk(chunk_hash):
+            response = jsonify({
+                "message": "Chunk not found",
+                "data": None,
+                "error": None
+            })
+            response.status_code = 404
+            return response
+        try:
+            # with offloading enabled chunks held by peers are refused unless
+            # the client says it failed to get them from the peers
+            if self.swarm_server_offload and request.args.get("fallback") != "1" \
+                    and self._chunk_held_by_peers(chunk_hash):
+                response = jsonify({
+                    "message": "Chunk is available from peers",
+                    "data": None,
+                    "error": None
+                })
+                response.status_code = 409
+                return response
+            # chunks are immutable, clients may cache them forever
+            return self._send_file(self.chunk_store.chunk_path(chunk_hash), chunk_hash, max_age=31536000)
+        except HTTPException as ex:
+            return ex
+
+    def _upload_not_found(self):
+        response = jsonify({
+            "message": "Upload session not found",
+            "data": None,
+            "error": None
+        })
+        response.status_code = 404
+        return response
+
+    def _upload_hasher(self, upload_session: UploadSession, temp_file) -> TreeHasher:
+        with self.upload_hashers_lock:
+            cached = self.upload_hashers.pop(upload_session.upload_id, None)
+        if cached is not None and cached[0] == upload_session.received_bytes:
+            return cached[1]
+        # another process handled the previous part, resume from the saved
+        # block digests and re-read only the unfinished last block
+        hasher = TreeHasher(upload_session.hash_algorithm,
+                            block_digests=json.loads(upload_session.block_digests))
+        hashed_bytes = len(hasher.block_digests) * hasher.block_size
+        temp_file.seek(hashed_bytes)
+        hasher.update(temp_file.read(upload_session.received_bytes - hashed_bytes))
+        return hasher
+
+    def _lock_upload_file(self, upload_session: UploadSession):
+        """Open the upload's temp file, or return None if another request holds it.
+
+        Raises FileNotFoundError if the upload was completed or expired since
+        its session was read.
+        """
+        temp_file = open(upload_session.temp_file, "r+b")
+        try:
+            fcntl.flock(temp_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            temp_file.close()
+            return None
+        return temp_file
+
+    @require_auth
+    def create_upload(request_user, self):
+        json_object = request.get_json(silent=True) or {}
+        image_name = json_object.get("image_name")
+        image_version = json_object.get("image_version")
+        total_size = json_object.get("size")
+        if not isinstance(image_name, str) or not isinstance(image_version, str) \
+                or (total_size is not None and (not isinstance(total_size, int) or total_size < 0)):
+            response = jsonify({
+                "message": "Bad input",
+                "data": None,
+                "error": "image_name and image_version are required, size has to be a positive integer"
+            })
+            response.status_code = 400
+            return response
+        try:
+            if self.database.get_image_by_name_version_string(f"{image_name}@{image_version}") is not None:
+                response = jsonify({
+                    "message": "Image version already exists",
+                    "data": None,
+                    "error": None
+                })
+                response.status_code = 409
+                return response
+            stale_files = self.database.delete_stale_upload_sessions(
+                datetime.datetime.utcnow() - datetime.timedelta(seconds=self.upload_session_ttl))
+            for stale_file in stale_files:
+                if os.path.exists(stale_file):
+                    os.unlink(stale_file)
+            upload_id = uuid.uuid4().hex
+            # the temporary file lives next to the final one so that the
+            # rename on completion is atomic
+            temp_file = os.path.join(self.image_directory, f".upload-{upload_id}.part")
+            open(temp_file, "wb").close()
+            upload_session = UploadSession(
+                upload_id=upload_id,
+                image_name=image_name,
+                image_version=image_version,
+                temp_file=temp_file,
+                hash_algorithm=self.image_hash_algorithm,
+                received_bytes=0,
+                total_size=total_size,
+                block_digests="[]",
+            )
+            self.database.add_upload_session(upload_session)
+            response = jsonify({
+                "message": "Upload session created",
+                "data": upload_session.as_dict(),
+                "error": None
+            })
+            response.status_code = 201
+            return response
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+
+    @require_auth
+    def get_upload(request_user, self, upload_id):
+        upload_session = self.database.get_upload_session(upload_id)
+        if upload_session is None:
+            return self._upload_not_found()
+        return jsonify({
+            "message": None,
+            "data": upload_session.as_dict(),
+            "error": None
+        })
+
+    @require_auth
+    def upload_image_data(request_user, self, upload_id):
+        """Append the request body to an upload, streaming it to disk.
+
+        The part's position is given as "Content-Range: bytes <start>-<end>/<size>"
+        and has to start at the current offset, so an interrupted upload is
+        resumed by asking GET /uploads/<id> for the offset and sending the rest.
+        """
+        upload_session = self.database.get_upload_session(upload_id)
+        if upload_session is None:
+            return self._upload_not_found()
+        start = upload_session.received_bytes
+        content_range = request.headers.get("Content-Range")
+        if content_range:
+            match = re.fullmatch(r"bytes (\d+)-\d+/(\d+|\*)", content_range.strip())
+            if match is None:
+                response = jsonify({
+                    "message": "Bad input",
+                    "data": None,
+                    "error": "Invalid Content-Range header"
+                })
+                response.status_code = 400
+                return response
+            start = int(match.group(1))
+        temp_file = None
+        try:
+            temp_file = self._lock_upload_file(upload_session)
+            if temp_file is None:
+                response = jsonify({
+                    "message": "Another part of this upload is being written",
+                    "data": upload_session.as_dict(),
+                    "error": None
+                })
+                response.status_code = 409
+                return response
+            # re-read under the lock, a concurrent request may have finished
+            upload_session = self.database.get_upload_session(upload_id)
+            if upload_session is None:
+                return self._upload_not_found()
+            if start != upload_session.received_bytes:
+                response = jsonify({
+                    "message": "Upload has to continue at the current offset",
+                    "data": upload_session.as_dict(),
+                    "error": None
+                })
+                response.status_code = 409
+                return response
+            hasher = self._upload_hasher(upload_session, temp_file)
+            # drop whatever an interrupted request wrote past the offset
+            temp_file.seek(start)
+            temp_file.truncate()
+            received_bytes = start
+            while True:
+                data = request.stream.read(1024 * 1024)
+                if not data:
+                    break
+                received_bytes += len(data)
+                if upload_session.total_size is not None and received_bytes > upload_session.total_size:
+                    temp_file.truncate(start)
+                    response = jsonify({
+                        "message": "Bad input",
+                        "data": upload_session.as_dict(),
+                        "error": "Upload is larger than the declared size"
+                    })
+                    response.status_code = 400
+                    return response
+                temp_file.write(data)
+                hasher.update(data)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+            if not self.database.update_upload_progress(
+                    upload_id, start, received_bytes, json.dumps(hasher.block_digests)):
+                # the session moved on or went away while the part was written
+                temp_file.truncate(start)
+                upload_session = self.database.get_upload_session(upload_id)
+                if upload_session is None:
+                    return self._upload_not_found()
+                response = jsonify({
+                    "message": "Upload has to continue at the current offset",
+                    "data": upload_session.as_dict(),
+                    "error": None
+                })
+                response.status_code = 409
+                return response
+            with self.upload_hashers_lock:
+                self.upload_hashers[upload_id] = (received_bytes, hasher)
+            upload_session.received_bytes = received_bytes
+            return jsonify({
+                "message": "Data received",
+                "data": upload_session.as_dict(),
+                "error": None
+            })
+        except FileNotFoundError:
+            return self._upload_not_found()
+        except Exception as ex:
+            response = jsonify({
+                "message": "Internal server error",
+                "data": None,
+                "error": str(ex)
+            })
+            response.status_code = 500
+            return response
+        finally:
+            if temp_file is not None:
+                temp_file.close()
+
+    @require_auth
+    def complete_upload(request_user, self, upload_id):
+        upload_session = self.database.get_upload_session(upload_id)
+        if upload_session is None:
+            return self._upload_not_found()
+        temp_file = None
+        try:
+            temp_file = self._lock_upload_file(upload_session)
+            if temp_file is None:
+                response = jsonify({
+                    "message": "Another part of this upload is being written",
+                    "data": upload_session.as_dict(),
+                    "error": None
+                })
+                response.status_code = 409
                 return response
+            # re-read under the lock, a part may have been written since
+            upload_session = self.database.get_upload_session(upload_id)
+            if upload_session is None:
+                return self._upload_not_found()
+            if upload_session.total_size is not None and upload_session.received_bytes != upload_session.total_size:
+                response = jsonify({
+                    "message": "Upload is incomplete",
+                    "data": upload_session.as_dict(),
+                    "error": None
+                })
+                response.status_code = 400
+                return response
+            image_hash = self._upload_hasher(upload_session, temp_file).hexdigest()
+            image_name_version_combo = f"{upload_session.image_name}@{upload_session.image_version}"
+            image_file = os.path.join(
+                self.image_directory, re.sub(r"[^A-Za-z0-9._@-]", "_", image_name_version_combo) + ".qcow2")
+            if os.path.exists(image_file):
+                response = jsonify({
+                    "message": "Image file already exists",
+                    "data": upload_session.as_dict(),
+                    "error": None
+                })
+                response.status_code = 409
+                return response
+            os.replace(upload_session.temp_file, image_file)
+            new_image_object = VMImage(
+                image_name=upload_session.image_name,
+                image_file=image_file,
+                image_version=upload_session.image_version,
+                image_hash=image_hash,
+                image_name_version_combo=image_name_version_combo,
+            )
+            try:
+                self.database.complete_upload_session(upload_id, new_image_object)
+            except Exception:
+                os.replace(image_file, upload_session.temp_file)
+                raise
+            self._build_delta_in_background(new_image_object)
+            self._build_variants_in_background(new_image_object)
+            response = jsonify({
+                "message": "Image added",
+                "data": new_image_object.as_dict(),
+                "error": None
+            })
+            response.status_code = 201
+            return response
+        except FileNotFoundError:
+            return self._upload_not_found()
         except Exception as ex:
             response = jsonify({
+                "message": "Internal server error",
+                "data": None,
                 "error": str(ex)
             })
             response.status_code = 500
             return response
+        finally:
+            if temp_file is not None:
+                temp_file.close()
+            with self.upload_hashers_lock:
+                self.upload_hashers.pop(upload_id, None)
 
-    def run(self):
+    def prepare(self):
         # add admin user to database (or update existing one)
-        salt = bcrypt.gensalt()
-        temp_password_hash = bcrypt.hashpw(
-            self.access_password.encode("utf-8"), salt)
         admin_user = self.database.get_user_by_name(self.access_username)
         if admin_user == None:
             admin_user = User(username=self.access_username,
-                              password_hash=temp_password_hash)
-        self.database.add_user(admin_user)
+                              password_hash=self.password_verifier.hash(self.access_password))
+            self.database.add_user(admin_user)
         self.app.add_endpoint(endpoint="/", endpoint_name="server_data",
                               handler=self.basic_server_data, methods=["GET"])
         self.app.add_endpoint(
             endpoint="/login", endpoint_name="login", handler=self.login, methods=["POST"])
+        self.app.add_endpoint(endpoint="/jobs", endpoint_name="create_job",
+                              handler=self.create_job, methods=["POST"])
+        self.app.add_endpoint(endpoint="/jobs/<int:job_id>", endpoint_name="get_job",
+                              handler=self.get_job, methods=["GET"])
+        self.app.add_endpoint(endpoint="/token/refresh", endpoint_name="refresh_token",
+                              handler=self.refresh_token, methods=["POST"])
         self.app.add_endpoint(endpoint="/clients", endpoint_name="register_client",
                               handler=self.register_new_client_to_database, methods=["POST"])
         self.app.add_endpoint(endpoint="/images", endpoint_name="add_image",
                               handler=self.add_image_to_database, methods=["POST"])
+        self.app.add_endpoint(endpoint="/clients", endpoint_name="list_clients",
+                              handler=self.list_clients, methods=["GET"])
+        self.app.add_endpoint(endpoint="/images", endpoint_name="list_images",
+                              handler=self.list_images, methods=["GET"])
+        self.app.add_endpoint(endpoint="/uploads", endpoint_name="create_upload",
+                              handler=self.create_upload, methods=["POST"])
+        self.app.add_endpoint(endpoint="/uploads/<upload_id>", endpoint_name="get_upload",
+                              handler=self.get_upload, methods=["GET"])
+        self.app.add_endpoint(endpoint="/uploads/<upload_id>", endpoint_name="upload_image_data",
+                              handler=self.upload_image_data, methods=["PUT"])
+        self.app.add_endpoint(endpoint="/uploads/<upload_id>/complete", endpoint_name="complete_upload",
+                              handler=self.complete_upload, methods=["POST"])
         self.app.add_endpoint(endpoint="/images/<vm_id>", endpoint_name="get_vm_data",
                               handler=self.get_vm_data, methods=["GET"])
+        self.app.add_endpoint(endpoint="/images/<vm_id>/clients", endpoint_name="get_vm_clients",
+                              handler=self.get_vm_clients, methods=["GET"])
         self.app.add_endpoint(endpoint="/images/<vm_id>/download", endpoint_name="download_vm",
                               handler=self.serve_vm_image, methods=["GET"])
+        self.app.add_endpoint(endpoint="/images/<vm_id>/delta", endpoint_name="download_vm_delta",
+                              handler=self.serve_vm_image_delta, methods=["GET"])
+        self.app.add_endpoint(endpoint="/images/<vm_id>/manifest", endpoint_name="get_vm_manifest",
+                              handler=self.get_vm_manifest, methods=["GET"])
+        self.app.add_endpoint(endpoint="/images/<vm_id>/peers", endpoint_name="get_vm_peers",
+                              handler=self.get_vm_peers, methods=["GET"])
+        self.app.add_endpoint(endpoint="/images/<vm_id>/peers", endpoint_name="announce_vm_seed",
+                              handler=self.announce_vm_seed, methods=["POST"])
+        self.app.add_endpoint(endpoint="/chunks/<chunk_hash>", endpoint_name="download_chunk",
+                              handler=self.serve_chunk, methods=["GET"])
+        if self.metrics_enabled:
+            self.app.add_endpoint(endpoint="/metrics", endpoint_name="get_metrics",
+                                  handler=self.get_metrics, methods=["GET"])
+        self.app.add_endpoint(endpoint="/stats/cache", endpoint_name="get_cache_stats",
+                              handler=self.get_cache_stats, methods=["GET"])
+        self.app.add_endpoint(endpoint="/rollouts", endpoint_name="create_rollout",
+                              handler=self.create_rollout, methods=["POST"])
+        self.app.add_endpoint(endpoint="/rollouts/<rollout_id>", endpoint_name="get_rollout_status",
+                              handler=self.get_rollout_status, methods=["GET"])
+        self.app.add_endpoint(endpoint="/rollouts/<rollout_id>/clients/<client_mac_address>",
+                              endpoint_name="update_rollout_client", handler=self.update_rollout_client, methods=["PUT"])
         self.app.add_endpoint(endpoint="/clients", endpoint_name="update_client", handler=self.update_client_data, methods=["PUT"])
+        self.app.add_endpoint(endpoint="/clients/batch", endpoint_name="batch_update_clients", handler=self.batch_update_clients, methods=["POST"])
         self.app.add_endpoint(endpoint="/clients/<client_mac_address>", endpoint_name="get_client_data", handler=self.get_client_data, methods=["GET"])
+        self.app.add_endpoint(endpoint="/clients/<client_mac_address>/changes", endpoint_name="get_client_changes",
+                              handler=self.get_client_changes, methods=["GET"])
         self.app.add_endpoint(endpoint="/clients/<client_mac_address>/vms", endpoint_name="get_client_vms_list", handler=self.get_client_list_of_vms, methods=["GET"])
         # TODO: add rest of endpoints
-        self.app.run()
+
+    def run(self, workers: int = None, threads: int = 1, graceful_timeout: int = 30,
+            worker_class: str = None, worker_connections: int = 1000,
+            async_mode: bool = False, async_io_workers: int = 16):
+        self.prepare()
+        async_server = None
+        if async_mode:
+            # imported here so that aiohttp stays an optional dependency
+            from network.aio import AsyncServer
+            async_server = AsyncServer(self, io_workers=async_io_workers)
+        if not workers:
+            # gunicorn workers start theirs after forking, see GunicornApplication
+            self.job_queue.start()
+            if self.fleet_index is not None:
+                self.fleet_index.start()
+            if async_server is not None:
+                async_server.run()
+                return
+            # single process development server
+            self.app.run(host=self.host, port=int(self.port), threaded=True)
+            return
+        # imported here so that the development server works without gunicorn
+        from network.wsgi import GunicornApplication
+        GunicornApplication(self, workers=workers, threads=threads,
+                            graceful_timeout=graceful_timeout, worker_class=worker_class,
+                            worker_connections=worker_connections, async_server=async_server).run()
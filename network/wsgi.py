@@ -0,0 +1,48 @@
+from gunicorn.app.base import BaseApplication
+
+
+class GunicornApplication(BaseApplication):
+    """Serves the Server's Flask app from a pre-forking gunicorn arbiter."""
+
+    def __init__(self, server, workers: int, threads: int, graceful_timeout: int,
+                 worker_class: str = None, worker_connections: int = 1000, async_server=None):
+        self.server = server
+        # an AsyncServer is served by aiohttp's worker instead of the Flask app
+        self.async_server = async_server
+        if async_server is not None:
+            worker_class = "aiohttp.GunicornWebWorker"
+        self.options = {
+            "bind": f"{server.host}:{server.port}",
+            "workers": workers,
+            "threads": threads,
+            # "gevent" (needs the gevent package) serves each request from a
+            # greenlet, for many idle long-poll and event stream connections
+            "worker_class": worker_class or ("gthread" if threads > 1 else "sync"),
+            "worker_connections": worker_connections,
+            "graceful_timeout": graceful_timeout,
+            "post_fork": self.post_fork,
+            "post_worker_init": self.post_worker_init,
+        }
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        if self.async_server is not None:
+            return self.async_server.app
+        return self.server.flask_app
+
+    def post_fork(self, arbiter, worker):
+        # every worker gets its own connection pool with at least one
+        # connection per request thread
+        database = self.server.database
+        database.reconnect(pool_size=max(database.pool_size, self.cfg.threads))
+
+    def post_worker_init(self, worker):
+        # after the worker class set itself up, so that under gevent the job
+        # threads use the patched primitives
+        self.server.job_queue.start()
+        if self.server.fleet_index is not None:
+            self.server.fleet_index.start()
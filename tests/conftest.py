@@ -0,0 +1,93 @@
+"""Tests run against a temporary SQLite database, or against PostgreSQL when
+VALHALLA_TEST_DATABASE_URL points to a throwaway database, e.g.
+
+    VALHALLA_TEST_DATABASE_URL=postgresql+psycopg2://postgres@localhost/valhalla_test python -m pytest tests
+
+All tables of that database are dropped before and after every test.
+"""
+import os
+
+import pytest
+from sqlalchemy import create_engine
+from network.communication import Server
+from utils.database.database import Database
+from utils.models.models import Base, Client, VMImage
+
+
+def open_database(path: str, **options) -> Database:
+    return Database(path, "ERROR", database_url=os.environ.get("VALHALLA_TEST_DATABASE_URL"), **options)
+
+
+def drop_tables():
+    # of the PostgreSQL database, also what an interrupted test run left behind
+    database_url = os.environ.get("VALHALLA_TEST_DATABASE_URL")
+    if database_url:
+        engine = create_engine(database_url)
+        Base.metadata.drop_all(engine)
+        engine.dispose()
+
+
+@pytest.fixture
+def database(tmp_path):
+    drop_tables()
+    database = open_database(str(tmp_path / "database.db"))
+    yield database
+    database.engine.dispose()
+    drop_tables()
+
+
+@pytest.fixture
+def image(database):
+    image = VMImage(image_name="test", image_file="/nonexistent/test-1.qcow2", image_version="1",
+                    image_hash="test-1", image_name_version_combo="test@1")
+    database.add_image(image)
+    return image
+
+
+@pytest.fixture
+def client(database):
+    client = Client(mac_address="00:00:00:00:00:01", ip_address="127.0.0.1", hostname="test-1", client_version="1")
+    database.add_client(client)
+    return client
+
+
+def start_server(tmp_path, **options) -> Server:
+    """A Server with its endpoints registered, for flask_app.test_client()."""
+    drop_tables()
+    server = Server(
+        "localhost", 0, "test", "password", "admin", "test-secret-" + "0" * 32, "test", str(tmp_path / "server.db"), "ERROR",
+        database_options={"database_url": os.environ.get("VALHALLA_TEST_DATABASE_URL")},
+        bcrypt_rounds=4, job_workers=0, image_scrub_interval=0, metrics_enabled=False,
+        image_directory=str(tmp_path / "images"), delta_directory=str(tmp_path / "deltas"),
+        image_variant_directory=str(tmp_path / "variants"), hash_cache_file=str(tmp_path / "hash_cache.json"),
+        **options)
+    server.prepare()
+    return server
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = start_server(tmp_path)
+    yield server
+    server.database.engine.dispose()
+    drop_tables()
+
+
+def logged_in_client(server: Server):
+    """Test client of the server, logged in as the admin user."""
+    api = server.flask_app.test_client()
+    token = api.post("/login", json={"username": "admin", "password": "password"}).json["token"]
+    api.environ_base["HTTP_AUTHORIZATION"] = f"Bearer {token}"
+    return api
+
+
+@pytest.fixture
+def api(server):
+    return logged_in_client(server)
+
+
+@pytest.fixture
+def image_file(tmp_path):
+    image_path = tmp_path / "image.qcow2"
+    image_path.write_bytes(os.urandom(256 * 1024))
+    return image_path
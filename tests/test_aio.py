@@ -0,0 +1,83 @@
+import asyncio
+
+import pytest
+
+from tests.conftest import logged_in_client
+from tests.test_downloads import add_image
+from utils.models.models import Client
+
+pytest.importorskip("aiohttp")
+from aiohttp.test_utils import TestClient, TestServer
+from network.aio import AsyncServer
+
+
+def run_requests(server, send_requests):
+    """Run send_requests(client, headers) against the asyncio serving mode."""
+    headers = {"Authorization": logged_in_client(server).environ_base["HTTP_AUTHORIZATION"]}
+
+    async def run():
+        async with TestClient(TestServer(AsyncServer(server, io_workers=4).app)) as client:
+            return await send_requests(client, headers)
+    return asyncio.run(run())
+
+
+def test_download_handles_etag_and_ranges(server, image_file):
+    image = add_image(server, image_file)
+    image_data = image_file.read_bytes()
+
+    async def send_requests(client, headers):
+        url = f"/images/{image.image_id}/download"
+        response = await client.get(url, headers=headers)
+        assert response.status == 200
+        assert response.headers["ETag"] == '"test-1"'
+        assert await response.read() == image_data
+        response = await client.get(url, headers={**headers, "If-None-Match": '"test-1"'})
+        assert response.status == 304
+        response = await client.get(url, headers={**headers, "Range": "bytes=100-199"})
+        assert response.status == 206
+        assert response.headers["Content-Range"] == f"bytes 100-199/{len(image_data)}"
+        assert await response.read() == image_data[100:200]
+        response = await client.get(url, headers={**headers, "Range": "bytes=100-199", "If-Range": '"test-0"'})
+        assert response.status == 200
+        assert await response.read() == image_data
+    run_requests(server, send_requests)
+
+
+def test_download_requires_a_token(server, image_file):
+    image = add_image(server, image_file)
+
+    async def send_requests(client, headers):
+        response = await client.get(f"/images/{image.image_id}/download")
+        assert response.status == 401
+    run_requests(server, send_requests)
+
+
+def test_other_routes_are_answered_by_the_flask_app(server, image_file):
+    image = add_image(server, image_file)
+
+    async def send_requests(client, headers):
+        response = await client.get(f"/images/{image.image_id}", headers=headers)
+        assert response.status == 200
+        assert (await response.json())["image_hash"] == "test-1"
+        response = await client.get("/images/12345/download", headers=headers)
+        assert response.status == 404
+    run_requests(server, send_requests)
+
+
+def test_long_poll_returns_when_an_image_is_assigned(server, image_file):
+    add_image(server, image_file)
+    server.database.add_client(Client(mac_address="00:00:00:00:00:01", ip_address="10.0.0.1",
+                                      hostname="test-1", client_version="1"))
+
+    async def send_requests(client, headers):
+        url = "/clients/00:00:00:00:00:01/changes"
+        cursor = (await (await client.get(url, headers=headers)).json())["data"]["cursor"]
+        long_poll = asyncio.ensure_future(client.get(f"{url}?since={cursor}&timeout=10", headers=headers))
+        await asyncio.sleep(0.2)
+        assert not long_poll.done()
+        await asyncio.get_running_loop().run_in_executor(
+            None, server.database.assign_image_to_client, "00:00:00:00:00:01", "test@1")
+        body = await (await asyncio.wait_for(long_poll, 5)).json()
+        assert [change["change"] for change in body["data"]["changes"]] == ["assigned"]
+        assert len(body["data"]["vm_list"]) == 1
+    run_requests(server, send_requests)
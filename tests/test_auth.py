@@ -0,0 +1,27 @@
+import threading
+
+import pytest
+
+from utils.middleware.auth import PasswordVerifier, PasswordVerifierBusy
+
+
+def test_timed_out_check_keeps_its_slot():
+    verifier = PasswordVerifier(rounds=4, max_workers=1, max_pending=0, timeout=0.05)
+    release = threading.Event()
+
+    with pytest.raises(PasswordVerifierBusy):
+        verifier._run(release.wait)
+    # the timed out check is still running and holds the only slot
+    with pytest.raises(PasswordVerifierBusy):
+        verifier._run(lambda: True)
+
+    release.set()
+    verifier._get_executor().submit(lambda: None).result()
+    assert verifier._run(lambda: True)
+
+
+def test_verify():
+    verifier = PasswordVerifier(rounds=4)
+    password_hash = verifier.hash("secret")
+    assert verifier.verify("secret", password_hash)
+    assert not verifier.verify("wrong", password_hash)
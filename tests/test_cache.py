@@ -0,0 +1,71 @@
+from utils.cache.cache import ResponseCache
+from utils.models.models import Client, VMImage
+
+
+def add_client(server) -> Client:
+    client = Client(mac_address="00:00:00:00:00:01", ip_address="10.0.0.1", hostname="test-1", client_version="1")
+    server.database.add_client(client)
+    return client
+
+
+def add_image(server) -> VMImage:
+    image = VMImage(image_name="test", image_file="/nonexistent/test-1.qcow2", image_version="1",
+                    image_hash="test-1", image_name_version_combo="test@1")
+    server.database.add_image(image)
+    return image
+
+
+def test_client_write_drops_the_cached_client(server, api):
+    client = add_client(server)
+    assert api.get(f"/clients/{client.mac_address}").json["hostname"] == "test-1"
+    assert api.get(f"/clients/{client.mac_address}").json["hostname"] == "test-1"
+    assert server.response_cache.stats()["hits"] == 1
+
+    client.hostname = "test-2"
+    server.database.modify_client(client)
+    assert api.get(f"/clients/{client.mac_address}").json["hostname"] == "test-2"
+
+
+def test_batch_upsert_drops_the_cached_clients(server, api):
+    client = add_client(server)
+    etag = api.get(f"/clients/{client.mac_address}").headers["ETag"]
+    assert api.get(f"/clients/{client.mac_address}", headers={"If-None-Match": etag}).status_code == 304
+
+    response = api.post("/clients/batch", json=[{"mac_address": client.mac_address, "ip_address": "10.0.0.2",
+                                                "hostname": "test-1", "client_version": "2"}])
+    assert response.status_code == 200
+    response = api.get(f"/clients/{client.mac_address}", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json["client_version"] == "2"
+
+
+def test_assignments_drop_the_cached_vm_list(server, api):
+    client = add_client(server)
+    image = add_image(server)
+    assert api.get(f"/clients/{client.mac_address}/vms").json == []
+
+    server.database.assign_image_to_client(client.mac_address, "test@1")
+    assert api.get(f"/clients/{client.mac_address}/vms").json == [image.image_id]
+    server.database.detach_image_from_client(client.mac_address, "test@1")
+    assert api.get(f"/clients/{client.mac_address}/vms").json == []
+
+
+def test_image_delete_drops_it_from_cached_vm_lists(server, api):
+    client = add_client(server)
+    image = add_image(server)
+    server.database.assign_image_to_client(client.mac_address, "test@1")
+    assert api.get(f"/clients/{client.mac_address}/vms").json == [image.image_id]
+
+    server.database.delete_image(image)
+    assert api.get(f"/clients/{client.mac_address}/vms").json == []
+
+
+def test_value_loaded_during_an_invalidation_is_not_cached():
+    cache = ResponseCache()
+
+    def load():
+        # a write lands while the value is being read
+        cache.handle_database_event("client_changed", {"mac_addresses": ["00:00:00:00:00:01"]})
+        return "stale"
+    assert cache.get_or_load(("client", "00:00:00:00:00:01"), load) == "stale"
+    assert cache.get(("client", "00:00:00:00:00:01")) is None
@@ -0,0 +1,38 @@
+import datetime
+
+import pytest
+
+
+def test_seq_isnt_reused_after_pruning(database, image, client):
+    database.assign_image_to_client(client.mac_address, image.image_name_version_combo)
+    database.detach_image_from_client(client.mac_address, image.image_name_version_combo)
+    cursor = database.get_latest_client_change_seq()
+    assert cursor == 2
+
+    database.delete_client_changes(datetime.datetime.utcnow() + datetime.timedelta(seconds=1))
+    database.assign_image_to_client(client.mac_address, image.image_name_version_combo)
+
+    assert [change.seq for change in database.get_client_changes(client.mac_address, cursor)] == [3]
+
+
+def test_migration_rebuilds_client_changes_with_autoincrement(database, image, client):
+    if database.dialect != "sqlite":
+        pytest.skip("PostgreSQL sequences never reuse values")
+    # client_changes as databases created before migration 5 have it
+    with database.session_scope(write=True) as session:
+        session.execute("DROP TABLE client_changes")
+        session.execute(
+            "CREATE TABLE client_changes (seq INTEGER NOT NULL, client_mac VARCHAR NOT NULL, "
+            "image_id INTEGER NOT NULL, change VARCHAR(20) NOT NULL, created_at DATETIME NOT NULL, "
+            "PRIMARY KEY (seq))")
+        session.execute("CREATE INDEX ix_client_changes_created_at ON client_changes (created_at)")
+        session.execute("DELETE FROM schema_migrations WHERE version = 5")
+    database.assign_image_to_client(client.mac_address, image.image_name_version_combo)
+    database.detach_image_from_client(client.mac_address, image.image_name_version_combo)
+
+    assert database.migrate() == [(5, "Never reuse client change seqs")]
+
+    assert [change.seq for change in database.get_client_changes(client.mac_address, 0)] == [1, 2]
+    database.delete_client_changes(datetime.datetime.utcnow() + datetime.timedelta(seconds=1))
+    database.assign_image_to_client(client.mac_address, image.image_name_version_combo)
+    assert [change.seq for change in database.get_client_changes(client.mac_address, 2)] == [3]
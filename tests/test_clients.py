@@ -0,0 +1,40 @@
+import pytest
+
+from tests.conftest import logged_in_client, start_server
+
+
+def client_record(index: int, **fields) -> dict:
+    record = {"mac_address": f"00:00:00:00:00:{index:02x}", "ip_address": "127.0.0.1",
+              "hostname": f"test-{index}", "client_version": "1"}
+    record.update(fields)
+    return record
+
+
+def test_batch_creates_and_updates_clients(server, api):
+    assert api.post("/clients/batch", json=[client_record(1)]).json["data"] == [
+        {"mac_address": "00:00:00:00:00:01", "status": "created", "error": None}]
+
+    response = api.post("/clients/batch", json=[client_record(1, hostname="renamed"), client_record(2)])
+    assert response.status_code == 200
+    assert [item["status"] for item in response.json["data"]] == ["updated", "created"]
+    assert server.database.get_client_by_mac_address("00:00:00:00:00:01").hostname == "renamed"
+
+
+def test_batch_saves_the_valid_records_of_partial_input(server, api):
+    response = api.post("/clients/batch", json=[client_record(1), client_record(2, hostname=None), "client"])
+    assert response.status_code == 200
+    assert [item["status"] for item in response.json["data"]] == ["created", "invalid", "invalid"]
+    assert "hostname" in response.json["data"][1]["error"]
+    assert [client.mac_address for client in server.database.get_clients()] == ["00:00:00:00:00:01"]
+
+
+@pytest.mark.parametrize("body", [{"mac_address": "00:00:00:00:00:01"}, "clients", None])
+def test_batch_has_to_be_a_list(api, body):
+    assert api.post("/clients/batch", json=body).status_code == 400
+
+
+def test_batch_size_is_limited(tmp_path):
+    server = start_server(tmp_path, client_batch_max_size=2)
+    response = logged_in_client(server).post("/clients/batch", json=[client_record(index) for index in range(3)])
+    assert response.status_code == 413
+    assert server.database.get_clients() == []
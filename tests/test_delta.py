@@ -0,0 +1,35 @@
+import io
+import os
+
+from utils.delta.delta import DEFAULT_BLOCK_SIZE, apply_delta, create_delta
+
+
+def round_trip(old_image: bytes, new_image: bytes) -> int:
+    delta = io.BytesIO()
+    delta_size = create_delta(io.BytesIO(old_image), io.BytesIO(new_image), delta)
+    delta.seek(0)
+    rebuilt_image = io.BytesIO()
+    apply_delta(io.BytesIO(old_image), delta, rebuilt_image)
+    assert rebuilt_image.getvalue() == new_image
+    return delta_size
+
+
+def test_unaligned_insert_keeps_the_delta_small():
+    old_image = os.urandom(32 * DEFAULT_BLOCK_SIZE)
+    new_image = old_image[:300000] + os.urandom(5000) + old_image[300000:]
+
+    # the inserted bytes and the old block they landed in
+    assert round_trip(old_image, new_image) < 5000 + 2 * DEFAULT_BLOCK_SIZE
+
+
+def test_unaligned_removal_keeps_the_delta_small():
+    old_image = os.urandom(32 * DEFAULT_BLOCK_SIZE)
+    new_image = old_image[:300000] + old_image[300123:] + os.urandom(777)
+
+    assert round_trip(old_image, new_image) < 3 * DEFAULT_BLOCK_SIZE
+
+
+def test_unrelated_images_round_trip():
+    assert round_trip(os.urandom(3 * DEFAULT_BLOCK_SIZE), os.urandom(2 * DEFAULT_BLOCK_SIZE + 10)) > 0
+    assert round_trip(b"", b"new") > 0
+    assert round_trip(b"old", b"") > 0
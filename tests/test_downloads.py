@@ -0,0 +1,153 @@
+import datetime
+import gzip
+
+import pytest
+
+from network import communication
+from utils.encoding.encoding import build_image_variants
+from utils.models.models import Job, VMImage
+
+
+def add_image(server, image_file) -> VMImage:
+    image = VMImage(image_name="test", image_file=str(image_file), image_version="1",
+                    image_hash="test-1", image_name_version_combo="test@1")
+    server.database.add_image(image)
+    return image
+
+
+def test_download_sends_the_image_with_an_etag(server, api, image_file):
+    image = add_image(server, image_file)
+    response = api.get(f"/images/{image.image_id}/download")
+    assert response.status_code == 200
+    assert response.data == image_file.read_bytes()
+    assert response.headers["ETag"] == '"test-1"'
+
+
+def test_if_none_match_answers_304(server, api, image_file):
+    image = add_image(server, image_file)
+    response = api.get(f"/images/{image.image_id}/download", headers={"If-None-Match": '"test-1"'})
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+def test_range_sends_part_of_the_image(server, api, image_file):
+    image = add_image(server, image_file)
+    response = api.get(f"/images/{image.image_id}/download", headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 100-199/{image_file.stat().st_size}"
+    assert response.data == image_file.read_bytes()[100:200]
+
+
+def test_if_range_with_an_old_etag_sends_the_whole_image(server, api, image_file):
+    image = add_image(server, image_file)
+    response = api.get(f"/images/{image.image_id}/download",
+                       headers={"Range": "bytes=100-199", "If-Range": '"test-0"'})
+    assert response.status_code == 200
+    assert response.data == image_file.read_bytes()
+
+    response = api.get(f"/images/{image.image_id}/download",
+                       headers={"Range": "bytes=100-199", "If-Range": '"test-1"'})
+    assert response.status_code == 206
+
+
+def test_unknown_image_answers_404(api):
+    assert api.get("/images/1000/download").status_code == 404
+
+
+@pytest.fixture
+def compressible_image(server, tmp_path) -> VMImage:
+    image_file = tmp_path / "compressible.qcow2"
+    image_file.write_bytes(b"valhalla" * 32768)
+    image = add_image(server, image_file)
+    build_image_variants(server.database, image, server.image_variant_directory, ["gzip"])
+    return image
+
+
+def test_accepted_encoding_sends_the_compressed_variant(api, compressible_image):
+    url = f"/images/{compressible_image.image_id}/download"
+    response = api.get(url, headers={"Accept-Encoding": "gzip"})
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["ETag"] == '"test-1-gzip"'
+    assert "Accept-Encoding" in response.headers["Vary"]
+    assert gzip.decompress(response.data) == b"valhalla" * 32768
+
+    response = api.get(url)
+    assert "Content-Encoding" not in response.headers
+    assert response.data == b"valhalla" * 32768
+
+
+def test_encoding_with_zero_quality_is_not_sent(api, compressible_image):
+    url = f"/images/{compressible_image.image_id}/download"
+    for accept_encoding in ["gzip;q=0", "gzip;q=0, *", "identity"]:
+        response = api.get(url, headers={"Accept-Encoding": accept_encoding})
+        assert "Content-Encoding" not in response.headers
+        assert response.data == b"valhalla" * 32768
+
+
+def test_range_and_if_range_address_the_variant(api, compressible_image):
+    url = f"/images/{compressible_image.image_id}/download"
+    variant = api.get(url, headers={"Accept-Encoding": "gzip"}).data
+
+    response = api.get(url, headers={"Accept-Encoding": "gzip", "Range": "bytes=10-19", "If-Range": '"test-1-gzip"'})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 10-19/{len(variant)}"
+    assert response.data == variant[10:20]
+    # resuming a plain download must not splice in compressed bytes
+    response = api.get(url, headers={"Accept-Encoding": "gzip", "Range": "bytes=10-19", "If-Range": '"test-1"'})
+    assert response.status_code == 200
+    assert response.data == variant
+
+
+def test_variant_manifest_is_read_once(server, api, compressible_image, monkeypatch):
+    manifest_reads = []
+    load_image_variants = communication.load_image_variants
+
+    def counting_load_image_variants(*args):
+        manifest_reads.append(args)
+        return load_image_variants(*args)
+    monkeypatch.setattr(communication, "load_image_variants", counting_load_image_variants)
+    for _ in range(3):
+        api.get(f"/images/{compressible_image.image_id}/download", headers={"Accept-Encoding": "gzip"})
+    assert len(manifest_reads) == 1
+
+    server.database.modify_image(compressible_image)
+    api.get(f"/images/{compressible_image.image_id}/download", headers={"Accept-Encoding": "gzip"})
+    assert len(manifest_reads) == 2
+
+
+def build_variants_jobs(server) -> list:
+    with server.database.session_scope() as session:
+        return session.query(Job).filter(Job.kind == "build_variants").order_by(Job.job_id).all()
+
+
+def test_failed_variant_build_is_retried_after_the_interval(server, api, image_file):
+    image = add_image(server, image_file)
+    api.get(f"/images/{image.image_id}/download", headers={"Accept-Encoding": "gzip"})
+    job, = build_variants_jobs(server)
+    for _ in range(job.max_attempts):
+        claim = server.database.claim_job(["build_variants"], 60)
+        server.database.fail_job(job.job_id, claim.attempts, "out of disk space", 0)
+    assert server.database.get_job(job.job_id).status == "failed"
+
+    for _ in range(3):
+        server.variant_build_checks.clear()
+        api.get(f"/images/{image.image_id}/download", headers={"Accept-Encoding": "gzip"})
+    assert len(build_variants_jobs(server)) == 1
+
+    with server.database.session_scope(write=True) as session:
+        session.query(Job).update({Job.finished_at: datetime.datetime.utcnow() - datetime.timedelta(hours=2)})
+    server.variant_build_checks.clear()
+    api.get(f"/images/{image.image_id}/download", headers={"Accept-Encoding": "gzip"})
+    assert [job.status for job in build_variants_jobs(server)] == ["failed", "queued"]
+
+
+def test_downloads_dont_look_up_the_variant_build_every_time(server, api, image_file, monkeypatch):
+    image = add_image(server, image_file)
+    job_lookups = []
+    get_latest_job = server.database.get_latest_job
+    monkeypatch.setattr(server.database, "get_latest_job",
+                        lambda *args, **kwargs: job_lookups.append(args) or get_latest_job(*args, **kwargs))
+    for _ in range(3):
+        api.get(f"/images/{image.image_id}/download", headers={"Accept-Encoding": "gzip"})
+    assert len(job_lookups) == 1
+    assert len(build_variants_jobs(server)) == 1
@@ -0,0 +1,82 @@
+import time
+
+from utils.changefeed.changefeed import ChangeFeed
+from utils.fleetindex.fleetindex import FleetIndex
+from utils.models.models import Client, VMImage
+from tests.conftest import open_database
+
+
+def test_clients_and_images_of_other_processes_are_found(database):
+    fleet_index = FleetIndex(database)
+    fleet_index.start()
+    # another process writing to the same database, without events reaching this index
+    other_database = open_database(database.database_file)
+    other_database.add_client(Client(mac_address="00:00:00:00:00:02", ip_address="127.0.0.1",
+                                     hostname="test-2", client_version="1"))
+    image = VMImage(image_name="test", image_file="/nonexistent/test-2.qcow2", image_version="2",
+                    image_hash="test-2", image_name_version_combo="test@2")
+    other_database.add_image(image)
+
+    assert fleet_index.has_client("00:00:00:00:00:02")
+    assert fleet_index.get_client("00:00:00:00:00:02")["hostname"] == "test-2"
+    assert fleet_index.get_image(image.image_id)["image_name"] == "test"
+    assert not fleet_index.has_client("00:00:00:00:00:03")
+
+
+def test_assignments_of_other_processes_are_applied_from_the_change_feed(database, image, client):
+    change_feed = ChangeFeed(database, poll_interval=0.05)
+    fleet_index = FleetIndex(database, change_feed=change_feed)
+    fleet_index.start()
+    other_database = open_database(database.database_file)
+    other_database.assign_image_to_client(client.mac_address, image.image_name_version_combo)
+
+    deadline = time.monotonic() + 5
+    while not fleet_index.get_client_image_ids(client.mac_address) and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert fleet_index.get_client_image_ids(client.mac_address) == [image.image_id]
+
+
+def test_client_changes_are_applied_from_the_event_payload(database, image, client, monkeypatch):
+    fleet_index = FleetIndex(database)
+    database.add_listener(fleet_index.handle_database_event)
+    database.assign_image_to_client(client.mac_address, image.image_name_version_combo)
+    fleet_index.start()
+
+    def get_fleet_rows(mac_addresses=None):
+        raise AssertionError("client rows read from the database")
+
+    monkeypatch.setattr(database, "get_fleet_rows", get_fleet_rows)
+    old_version = fleet_index.get_client(client.mac_address)["client_version"]
+    client_records = [{"mac_address": client.mac_address, "ip_address": "10.0.0.1",
+                       "hostname": "renamed", "client_version": "2"}]
+    # the second heartbeat repeats the values the index already holds
+    database.upsert_clients(client_records)
+    database.upsert_clients(client_records)
+
+    assert fleet_index.get_client(client.mac_address)["hostname"] == "renamed"
+    assert fleet_index.get_client_image_ids(client.mac_address) == [image.image_id]
+    assert fleet_index.select_clients(client_version="2") == [client.mac_address]
+    assert fleet_index.select_clients(client_version=old_version) == []
+
+    database.delete_client(database.get_client_by_mac_address(client.mac_address))
+    assert fleet_index.select_clients() == []
+    assert fleet_index.get_image_clients(image.image_id) == []
+
+
+def test_event_for_client_unknown_to_the_index_reads_its_assignments(database, image, client):
+    fleet_index = FleetIndex(database)
+    fleet_index.start()
+    database.add_listener(fleet_index.handle_database_event)
+    # assigned by another process, after the index was loaded
+    other_database = open_database(database.database_file)
+    other_database.add_client(Client(mac_address="00:00:00:00:00:02", ip_address="127.0.0.1",
+                                     hostname="test-2", client_version="1"))
+    other_database.assign_image_to_client("00:00:00:00:00:02", image.image_name_version_combo)
+
+    database.upsert_clients([{"mac_address": "00:00:00:00:00:02", "ip_address": "127.0.0.2",
+                              "hostname": "test-2", "client_version": "1"}])
+
+    assert fleet_index.get_client("00:00:00:00:00:02")["ip_address"] == "127.0.0.2"
+    assert fleet_index.get_client_image_ids("00:00:00:00:00:02") == [image.image_id]
+    assert sorted(client["mac_address"] for client in fleet_index.get_image_clients(image.image_id)) == [
+        "00:00:00:00:00:02"]
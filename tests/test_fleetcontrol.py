@@ -0,0 +1,65 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from utils.models.models import Client
+
+FLEETCONTROL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "fleetcontrol")
+
+
+@pytest.fixture
+def clients(database, image):
+    mac_addresses = [f"00:00:00:00:00:0{index}" for index in range(1, 4)]
+    for mac_address in mac_addresses:
+        database.add_client(Client(mac_address=mac_address, ip_address="127.0.0.1",
+                                   hostname=mac_address, client_version="1"))
+    return mac_addresses
+
+
+def fleetcontrol(tmp_path, *arguments, stdin: str = None) -> subprocess.CompletedProcess:
+    (tmp_path / "config.yml").write_text(
+        'server_name: "test"\nserver_port: 8088\nserver_loglevel: "ERROR"\n'
+        f'database_file: "{tmp_path / "database.db"}"\nserver_host: "localhost"\n'
+        'server_password: "password"\nserver_access_username: "admin"\njwt_secret: "test-secret"\n')
+    environment = dict(os.environ, PYTHONPATH=os.path.dirname(FLEETCONTROL))
+    if os.environ.get("VALHALLA_TEST_DATABASE_URL"):
+        environment["VALHALLA_DATABASE_URL"] = os.environ["VALHALLA_TEST_DATABASE_URL"]
+    return subprocess.run([sys.executable, FLEETCONTROL, *arguments], cwd=tmp_path, env=environment,
+                          input=stdin, capture_output=True, text=True, timeout=60)
+
+
+def assigned_mac_addresses(database, image) -> list[str]:
+    return sorted(client.mac_address for client in database.get_clients_by_image_id(image.image_id))
+
+
+def test_assign_from_file_assigns_every_client(tmp_path, database, image, clients):
+    (tmp_path / "clients.txt").write_text("# rack 1\n" + "\n".join(clients) + "\n\n")
+
+    result = fleetcontrol(tmp_path, "assign_image", "--image-name", "test", "--image-version", "1",
+                          "--from-file", str(tmp_path / "clients.txt"))
+    assert result.returncode == 0, result.stderr
+    assert "to 3 clients" in result.stdout
+    assert assigned_mac_addresses(database, image) == clients
+
+
+def test_assign_from_file_with_an_unknown_client_changes_nothing(tmp_path, database, image, clients):
+    result = fleetcontrol(tmp_path, "assign_image", "--image-name", "test", "--image-version", "1",
+                          "--from-file", "-", stdin="\n".join(clients + ["00:00:00:00:00:99"]))
+    assert result.returncode != 0
+    assert assigned_mac_addresses(database, image) == []
+    assert database.get_latest_client_change_seq() == 0
+
+
+def test_detach_from_file_with_an_unknown_client_changes_nothing(tmp_path, database, image, clients):
+    database.assign_image_to_clients(clients, "test@1")
+
+    result = fleetcontrol(tmp_path, "detach_image", "--image-name", "test", "--image-version", "1",
+                          "--from-file", "-", stdin="\n".join(clients[:2] + ["00:00:00:00:00:99"]))
+    assert result.returncode != 0
+    assert assigned_mac_addresses(database, image) == clients
+    result = fleetcontrol(tmp_path, "detach_image", "--image-name", "test", "--image-version", "1",
+                          "--from-file", "-", stdin="\n".join(clients[:2]))
+    assert result.returncode == 0, result.stderr
+    assert assigned_mac_addresses(database, image) == clients[2:]
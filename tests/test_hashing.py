@@ -0,0 +1,67 @@
+import os
+
+import pytest
+
+from utils.hashing import hashing
+from utils.hashing.hashing import BlockHashCache, TreeHasher, hash_file
+
+BLOCK_SIZE = 64 * 1024
+
+
+@pytest.mark.parametrize("size", [0, 1000, BLOCK_SIZE, 5 * BLOCK_SIZE + 17])
+@pytest.mark.parametrize("algorithm", ["sha256", "blake2b"])
+def test_streamed_and_parallel_hashes_match(tmp_path, size, algorithm):
+    data = os.urandom(size)
+    image_path = tmp_path / "image.qcow2"
+    image_path.write_bytes(data)
+    tree_hasher = TreeHasher(algorithm, block_size=BLOCK_SIZE)
+    # uploads arrive in parts that don't line up with the blocks
+    for offset in range(0, size, 10000):
+        tree_hasher.update(data[offset:offset + 10000])
+
+    assert tree_hasher.hexdigest() == hash_file(str(image_path), algorithm, block_size=BLOCK_SIZE, workers=4)
+
+
+def test_resumed_tree_hash_matches(tmp_path):
+    data = os.urandom(3 * BLOCK_SIZE + 5)
+    tree_hasher = TreeHasher(block_size=BLOCK_SIZE)
+    tree_hasher.update(data[:2 * BLOCK_SIZE])
+    resumed_hasher = TreeHasher(block_size=BLOCK_SIZE, block_digests=tree_hasher.block_digests)
+    resumed_hasher.update(data[2 * BLOCK_SIZE:])
+    tree_hasher.update(data[2 * BLOCK_SIZE:])
+    assert resumed_hasher.hexdigest() == tree_hasher.hexdigest()
+
+
+def test_append_only_cache_hashes_only_new_blocks(tmp_path, monkeypatch):
+    image_path = tmp_path / "image.qcow2"
+    image_path.write_bytes(os.urandom(4 * BLOCK_SIZE))
+    cache = BlockHashCache(str(tmp_path / "hash_cache.json"))
+    hash_file(str(image_path), block_size=BLOCK_SIZE, cache=cache)
+    with open(image_path, "ab") as image_file:
+        image_file.write(os.urandom(2 * BLOCK_SIZE + 3))
+
+    hashed_offsets = []
+    hash_block = hashing._hash_block
+
+    def counting_hash_block(file_descriptor, algorithm, offset, length):
+        hashed_offsets.append(offset)
+        return hash_block(file_descriptor, algorithm, offset, length)
+    monkeypatch.setattr(hashing, "_hash_block", counting_hash_block)
+    appended_hash = hash_file(str(image_path), block_size=BLOCK_SIZE, cache=cache, append_only=True)
+
+    # the first and last cached blocks as a sanity check, then the new ones
+    assert sorted(hashed_offsets) == [0, 3 * BLOCK_SIZE, 4 * BLOCK_SIZE, 5 * BLOCK_SIZE, 6 * BLOCK_SIZE]
+    monkeypatch.setattr(hashing, "_hash_block", hash_block)
+    assert appended_hash == hash_file(str(image_path), block_size=BLOCK_SIZE)
+
+
+def test_append_only_cache_ignores_rewritten_files(tmp_path):
+    image_path = tmp_path / "image.qcow2"
+    image_path.write_bytes(os.urandom(4 * BLOCK_SIZE))
+    cache = BlockHashCache(str(tmp_path / "hash_cache.json"))
+    hash_file(str(image_path), block_size=BLOCK_SIZE, cache=cache)
+    # grown, but with its first block rewritten too
+    image_path.write_bytes(os.urandom(5 * BLOCK_SIZE))
+
+    assert hash_file(str(image_path), block_size=BLOCK_SIZE, cache=cache, append_only=True) == \
+        hash_file(str(image_path), block_size=BLOCK_SIZE)
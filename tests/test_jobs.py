@@ -0,0 +1,83 @@
+import threading
+import time
+
+from utils.jobs.jobs import JobQueue
+
+
+def test_expired_claim_cant_finish_or_fail_the_job(database):
+    job = database.add_job("test", {})
+    first_claim = database.claim_job(["test"], 0)
+    second_claim = database.claim_job(["test"], 60)
+    assert (first_claim.job_id, first_claim.attempts) == (job.job_id, 1)
+    assert (second_claim.job_id, second_claim.attempts) == (job.job_id, 2)
+
+    assert not database.finish_job(job.job_id, first_claim.attempts, {"from": "first"})
+    assert database.fail_job(job.job_id, first_claim.attempts, "first failed", 0) is None
+    assert not database.extend_job_lease(job.job_id, first_claim.attempts, 60)
+    assert database.get_job(job.job_id).status == "running"
+
+    assert database.finish_job(job.job_id, second_claim.attempts, {"from": "second"})
+    finished_job = database.get_job(job.job_id)
+    assert (finished_job.status, finished_job.as_dict()["result"]) == ("done", {"from": "second"})
+
+
+def test_failed_job_is_queued_again_until_its_last_attempt(database):
+    job = database.add_job("test", {}, max_attempts=2)
+    claim = database.claim_job(["test"], 60)
+    assert database.fail_job(job.job_id, claim.attempts, "failed", 0).status == "queued"
+    claim = database.claim_job(["test"], 60)
+    assert database.fail_job(job.job_id, claim.attempts, "failed", 0).status == "failed"
+    assert database.claim_job(["test"], 60) is None
+
+
+def test_running_job_keeps_its_lease_without_progress_reports(database):
+    release = threading.Event()
+    job_queue = JobQueue(database, workers=0, lease=0.6)
+    job_queue.register("test", lambda payload, report_progress: release.wait() and {"done": True})
+    job = job_queue.submit("test", {})
+    worker = threading.Thread(target=job_queue._run, args=(database.claim_job(["test"], job_queue.lease),))
+    worker.start()
+
+    time.sleep(1.2)
+    assert database.claim_job(["test"], job_queue.lease) is None
+
+    release.set()
+    worker.join()
+    finished_job = database.get_job(job.job_id)
+    assert (finished_job.status, finished_job.attempts) == ("done", 1)
+
+
+def test_job_with_a_bad_payload_is_rejected(server, api, tmp_path):
+    image_file = tmp_path / "images" / "test.qcow2"
+    image_file.write_bytes(b"test")
+    for job in [
+        {"kind": "add_image", "payload": {"image_name": "test", "image_version": "1"}},
+        {"kind": "add_image", "payload": {"image_name": "test", "image_version": 1, "image_file": str(image_file)}},
+        {"kind": "add_image", "payload": {"image_name": "test", "image_version": "1", "image_file": str(image_file),
+                                          "hash_algorithm": "md4"}},
+        {"kind": "add_image", "payload": {"image_name": "test", "image_version": "1", "image_file": "/etc/passwd"}},
+        {"kind": "add_image", "payload": {"image_name": "test", "image_version": "1",
+                                          "image_file": str(tmp_path / "images" / ".." / "server.db")}},
+        {"kind": "build_variants", "payload": {"image_id": "1"}},
+        {"kind": "build_variants", "payload": {"image_id": True}},
+        {"kind": "build_variants", "payload": {"image_id": 1, "encodings": ["gzip"]}},
+        {"kind": "scrub_images", "payload": []},
+        {"kind": "scrub_images", "priority": "high"},
+        {"kind": "scrub_images", "priority": 1.5},
+    ]:
+        response = api.post("/jobs", json=job)
+        assert response.status_code == 400, job
+        assert response.json["message"] == "Bad input"
+    assert api.post("/jobs", json={"kind": "unknown"}).status_code == 400
+    assert api.post("/jobs", data="not json", content_type="application/json").status_code == 400
+    assert server.database.claim_job(list(server.job_queue.handlers), 60) is None
+
+
+def test_job_with_a_valid_payload_is_queued(server, api, tmp_path):
+    image_file = tmp_path / "images" / "test.qcow2"
+    image_file.write_bytes(b"test")
+    response = api.post("/jobs", json={"kind": "add_image", "priority": 5, "payload": {
+        "image_name": "test", "image_version": "1", "image_file": str(image_file), "append_only": False}})
+    assert response.status_code == 202
+    job = server.database.get_job(response.json["data"]["job_id"])
+    assert (job.kind, job.priority) == ("add_image", 5)
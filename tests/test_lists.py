@@ -0,0 +1,35 @@
+import base64
+import json
+
+from utils.exceptions.DatabaseException import DatabaseException
+
+
+def cursor(value) -> str:
+    return base64.urlsafe_b64encode(json.dumps(value).encode()).decode()
+
+
+def test_bad_list_parameters_answer_400(api):
+    assert api.get("/clients?limit=0").status_code == 400
+    assert api.get("/clients?cursor=not-a-cursor").status_code == 400
+    assert api.get(f"/images?cursor={cursor('image')}").status_code == 400
+    assert api.get("/clients?fields=password").status_code == 400
+
+
+def test_database_errors_answer_500(server, api, monkeypatch):
+    def failing_page(**arguments):
+        raise DatabaseException("database is locked")
+    monkeypatch.setattr(server.database, "get_clients_page", failing_page)
+    response = api.get("/clients")
+    assert response.status_code == 500
+    assert response.json["message"] == "Internal server error"
+
+
+def test_pages_follow_the_cursor(server, api):
+    api.post("/clients/batch", json=[
+        {"mac_address": f"00:00:00:00:00:0{index}", "ip_address": "127.0.0.1",
+         "hostname": f"test-{index}", "client_version": "1"} for index in range(3)])
+    first_page = api.get("/clients?limit=2&fields=hostname").json
+    assert first_page["data"] == [{"hostname": "test-0"}, {"hostname": "test-1"}]
+    second_page = api.get(f"/clients?limit=2&cursor={first_page['next_cursor']}").json
+    assert [client["mac_address"] for client in second_page["data"]] == ["00:00:00:00:00:02"]
+    assert second_page["next_cursor"] is None
@@ -0,0 +1,38 @@
+from network.communication import HTTP_REQUEST_SECONDS, HTTP_REQUESTS
+from utils.database.database import DATABASE_POOL_CONNECTIONS, Database
+from tests.conftest import drop_tables, open_database
+
+
+def pool_connections(engine_name: str, state: str) -> int:
+    return DATABASE_POOL_CONNECTIONS.callback().get((engine_name, state), 0)
+
+
+def test_pool_state_is_reported_per_engine(tmp_path):
+    replica_path = tmp_path / "replica.db"
+    Database(str(replica_path), "ERROR").engine.dispose()
+    drop_tables()
+    database = open_database(str(tmp_path / "database.db"), replica_url=f"sqlite:///{replica_path}")
+    try:
+        checked_out = {engine_name: pool_connections(engine_name, "checked_out")
+                       for engine_name in ["primary", "replica"]}
+        with database.session_scope(replica=True) as session:
+            session.execute("SELECT 1")
+            assert pool_connections("replica", "checked_out") == checked_out["replica"] + 1
+            assert pool_connections("primary", "checked_out") == checked_out["primary"]
+        assert pool_connections("replica", "checked_out") == checked_out["replica"]
+        assert 'engine="replica",state="size"' in "\n".join(DATABASE_POOL_CONNECTIONS.expose())
+    finally:
+        database.engine.dispose()
+        database.replica_engine.dispose()
+        drop_tables()
+
+
+def test_request_without_a_start_time_is_counted_but_not_timed(server):
+    labels = ("GET", "/", "200")
+    requests = HTTP_REQUESTS._values.get(labels, 0)
+    timed_requests = HTTP_REQUEST_SECONDS._values.get(("GET", "/"), [None, 0.0, 0])[2]
+    with server.flask_app.test_request_context("/"):
+        server._record_request(server.flask_app.response_class("ok"))
+
+    assert HTTP_REQUESTS._values[labels] == requests + 1
+    assert HTTP_REQUEST_SECONDS._values.get(("GET", "/"), [None, 0.0, 0])[2] == timed_requests
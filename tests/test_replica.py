@@ -0,0 +1,24 @@
+from utils.database.database import Database
+from utils.models.models import VMImage
+from tests.conftest import drop_tables, open_database
+
+
+def test_reads_after_writes_can_skip_the_replica(tmp_path):
+    # a replica that hasn't caught up with anything yet
+    replica_path = tmp_path / "replica.db"
+    Database(str(replica_path), "ERROR").engine.dispose()
+    drop_tables()
+    database = open_database(str(tmp_path / "database.db"), replica_url=f"sqlite:///{replica_path}")
+    try:
+        image = VMImage(image_name="test", image_file="/nonexistent/test-1.qcow2", image_version="1",
+                        image_hash="test-1", image_name_version_combo="test@1")
+        database.add_image(image)
+        database.set_image_manifest(image.image_id, [("0" * 64, 0, 1024)])
+
+        assert database.get_image_by_id(image.image_id) is None
+        assert database.get_image_by_id(image.image_id, replica=False).image_hash == "test-1"
+        assert database.get_image_manifest(image.image_id) == []
+        assert len(database.get_image_manifest(image.image_id, replica=False)) == 1
+    finally:
+        database.engine.dispose()
+        drop_tables()
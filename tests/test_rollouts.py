@@ -0,0 +1,74 @@
+import datetime
+
+from utils.models.models import Client, RolloutTarget
+
+
+def test_reported_download_counts_as_in_flight(database, image, client):
+    rollout = database.create_rollout(image.image_id, {"mac_addresses": [client.mac_address]}, 10, 1)
+    assert database.update_rollout_target(rollout.rollout_id, client.mac_address, "downloading")
+
+    assert database.begin_rollout_download(image.image_id, client.mac_address, 3600)
+    assert database.get_rollout_progress(rollout.rollout_id) == {0: {"downloading": 1}}
+
+
+def test_download_without_start_time_counts_as_timed_out(database, image, client):
+    rollout = database.create_rollout(image.image_id, {"mac_addresses": [client.mac_address]}, 10, 1)
+    assert database.begin_rollout_download(image.image_id, client.mac_address, 3600)
+    # what update_rollout_target left behind before it set the start time
+    with database.session_scope(write=True) as session:
+        session.execute("UPDATE rollout_targets SET download_started_at = NULL")
+
+    assert database.begin_rollout_download(image.image_id, client.mac_address, 3600)
+
+
+def test_max_in_flight_gates_downloads(database, image):
+    mac_addresses = [f"00:00:00:00:00:0{index}" for index in range(1, 4)]
+    for mac_address in mac_addresses:
+        database.add_client(Client(mac_address=mac_address, ip_address="127.0.0.1",
+                                   hostname=mac_address, client_version="1"))
+    database.create_rollout(image.image_id, {"mac_addresses": mac_addresses}, 10, 2)
+
+    assert [database.begin_rollout_download(image.image_id, mac_address, 3600)
+            for mac_address in mac_addresses] == [True, True, False]
+
+
+def add_clients(database, count: int) -> list[str]:
+    mac_addresses = [f"00:00:00:00:00:0{index}" for index in range(1, count + 1)]
+    for mac_address in mac_addresses:
+        database.add_client(Client(mac_address=mac_address, ip_address="127.0.0.1",
+                                   hostname=mac_address, client_version="1"))
+    return mac_addresses
+
+
+def age_rollout_targets(database, seconds: int):
+    with database.session_scope(write=True) as session:
+        for target in session.query(RolloutTarget):
+            if target.download_started_at is not None:
+                target.download_started_at -= datetime.timedelta(seconds=seconds)
+            target.updated_at -= datetime.timedelta(seconds=seconds)
+
+
+def test_stalled_download_fails_and_starts_the_next_wave(database, image):
+    first_client, silent_client, next_client = add_clients(database, 3)
+    rollout = database.create_rollout(
+        image.image_id, {"mac_addresses": [first_client, silent_client, next_client]}, 2, 2)
+    assert database.update_rollout_target(rollout.rollout_id, first_client, "done")
+    # the other client starts downloading and is never heard from again
+    assert database.begin_rollout_download(image.image_id, silent_client, 3600)
+    assert database.expire_rollout_targets(3600, 86400) == 0
+
+    age_rollout_targets(database, 3601)
+    assert database.expire_rollout_targets(3600, 86400) == 1
+    assert database.get_rollout_progress(rollout.rollout_id) == {0: {"done": 1, "failed": 1}, 1: {"assigned": 1}}
+    assert database.begin_rollout_download(image.image_id, next_client, 3600)
+
+
+def test_client_that_never_starts_fails_after_the_wave_timeout(database, image):
+    silent_client, = add_clients(database, 1)
+    rollout = database.create_rollout(image.image_id, {"mac_addresses": [silent_client]}, 1, 1)
+
+    age_rollout_targets(database, 3601)
+    assert database.expire_rollout_targets(3600, 86400) == 0
+    age_rollout_targets(database, 86400)
+    assert database.expire_rollout_targets(3600, 86400) == 1
+    assert database.get_rollout(rollout.rollout_id).status == "finished"
@@ -0,0 +1,62 @@
+import io
+import os
+import random
+
+from utils.storage.storage import ChunkStore
+
+CHUNK_SIZES = {"block_size": 4096, "min_chunk_size": 16 * 1024, "avg_chunk_size": 64 * 1024,
+               "max_chunk_size": 256 * 1024}
+
+
+def random_bytes(size: int, seed: int) -> bytes:
+    return random.Random(seed).randbytes(size)
+
+
+def test_stored_file_reads_back_with_seeks(tmp_path):
+    chunk_store = ChunkStore(str(tmp_path / "store"), **CHUNK_SIZES)
+    data = random_bytes(1024 * 1024 + 123, 1)
+    image_path = tmp_path / "image.qcow2"
+    image_path.write_bytes(data)
+
+    manifest = chunk_store.store_file(str(image_path))
+    assert len(manifest) > 1
+    assert sum(size for _, _, size in manifest) == len(data)
+
+    reader = io.BufferedReader(chunk_store.open_image(manifest))
+    assert reader.read() == data
+    for offset, length in [(0, 10), (70000, 200000), (len(data) - 5, 100)]:
+        reader.seek(offset)
+        assert reader.read(length) == data[offset:offset + length]
+    reader.seek(-7, io.SEEK_END)
+    assert reader.read() == data[-7:]
+    reader.close()
+
+
+def test_edited_image_reuses_chunks(tmp_path):
+    chunk_store = ChunkStore(str(tmp_path / "store"), **CHUNK_SIZES)
+    data = random_bytes(2 * 1024 * 1024, 2)
+    old_path, new_path = tmp_path / "old.qcow2", tmp_path / "new.qcow2"
+    old_path.write_bytes(data)
+    # a block overwritten and two blocks inserted, like a disk image edit
+    edited = bytearray(data)
+    edited[512 * 1024:516 * 1024] = os.urandom(4096)
+    edited[1024 * 1024:1024 * 1024] = os.urandom(8192)
+    new_path.write_bytes(edited)
+
+    old_hashes = {chunk_hash for chunk_hash, _, _ in chunk_store.store_file(str(old_path))}
+    new_manifest = chunk_store.store_file(str(new_path))
+    reused = [chunk_hash for chunk_hash, _, _ in new_manifest if chunk_hash in old_hashes]
+    assert len(reused) >= len(new_manifest) - 4
+    assert io.BufferedReader(chunk_store.open_image(new_manifest)).read() == bytes(edited)
+
+
+def test_garbage_collection_keeps_referenced_chunks(tmp_path):
+    chunk_store = ChunkStore(str(tmp_path / "store"), **CHUNK_SIZES)
+    image_path = tmp_path / "image.qcow2"
+    image_path.write_bytes(random_bytes(512 * 1024, 3))
+    manifest = chunk_store.store_file(str(image_path))
+    kept = {manifest[0][0]}
+
+    assert chunk_store.collect_garbage(kept) == len({chunk_hash for chunk_hash, _, _ in manifest}) - 1
+    assert chunk_store.has_chunk(manifest[0][0])
+    assert not chunk_store.has_chunk(manifest[1][0])
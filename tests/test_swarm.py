@@ -0,0 +1,53 @@
+import hashlib
+
+import pytest
+
+from tests.conftest import drop_tables, logged_in_client, start_server
+from utils.models.models import Client, VMImage
+
+
+@pytest.fixture
+def offload_server(tmp_path):
+    server = start_server(tmp_path, image_store_path=str(tmp_path / "store"), swarm_server_offload=True)
+    yield server
+    server.database.engine.dispose()
+    drop_tables()
+
+
+def add_chunked_image(server, chunks: list[bytes]) -> VMImage:
+    image = VMImage(image_name="test", image_file="/nonexistent/test-1.qcow2", image_version="1",
+                    image_hash="test-1", image_name_version_combo="test@1")
+    server.database.add_image(image)
+    manifest = []
+    offset = 0
+    for chunk in chunks:
+        chunk_hash = hashlib.sha256(chunk).hexdigest()
+        server.chunk_store.write_chunk(chunk_hash, chunk)
+        manifest.append((chunk_hash, offset, len(chunk)))
+        offset += len(chunk)
+    server.database.set_image_manifest(image.image_id, manifest)
+    server.database.add_client(Client(mac_address="00:00:00:00:00:01", ip_address="10.0.0.1", hostname="test-1", client_version="1"))
+    return image
+
+
+def test_chunks_held_by_peers_are_offloaded(offload_server):
+    api = logged_in_client(offload_server)
+    chunks = [b"first chunk", b"second chunk", b"third chunk"]
+    image = add_chunked_image(offload_server, chunks)
+    response = api.post(f"/images/{image.image_id}/peers",
+                        json={"mac_address": "00:00:00:00:00:01", "port": 6881, "chunks": [1]})
+    assert response.status_code == 200
+
+    assert api.get(f"/chunks/{hashlib.sha256(chunks[1]).hexdigest()}").status_code == 409
+    assert api.get(f"/chunks/{hashlib.sha256(chunks[1]).hexdigest()}?fallback=1").data == chunks[1]
+    assert api.get(f"/chunks/{hashlib.sha256(chunks[2]).hexdigest()}").data == chunks[2]
+
+
+def test_complete_seeds_offload_every_chunk(offload_server):
+    api = logged_in_client(offload_server)
+    chunks = [b"first chunk", b"second chunk"]
+    image = add_chunked_image(offload_server, chunks)
+    api.post(f"/images/{image.image_id}/peers", json={"mac_address": "00:00:00:00:00:01", "complete": True})
+
+    for chunk in chunks:
+        assert api.get(f"/chunks/{hashlib.sha256(chunk).hexdigest()}").status_code == 409
@@ -0,0 +1,73 @@
+import fcntl
+import os
+
+from utils.hashing.hashing import hash_file
+
+
+def create_upload(api, size) -> dict:
+    response = api.post("/uploads", json={"image_name": "test", "image_version": "1", "size": size})
+    assert response.status_code == 201
+    return response.json["data"]
+
+
+def temp_file_path(server, upload) -> str:
+    return server.database.get_upload_session(upload["upload_id"]).temp_file
+
+
+def put_part(api, upload_id, data, start, size):
+    return api.put(f"/uploads/{upload_id}", data=data,
+                   headers={"Content-Range": f"bytes {start}-{start + len(data) - 1}/{size}"})
+
+
+def test_interrupted_upload_resumes_at_the_offset(server, api, image_file):
+    data = image_file.read_bytes()
+    upload = create_upload(api, len(data))
+    assert put_part(api, upload["upload_id"], data[:100000], 0, len(data)).status_code == 200
+    # a fresh process resumes from the saved block digests
+    server.upload_hashers.clear()
+
+    offset = api.get(f"/uploads/{upload['upload_id']}").json["data"]["offset"]
+    assert offset == 100000
+    assert put_part(api, upload["upload_id"], data[offset:], offset, len(data)).status_code == 200
+    response = api.post(f"/uploads/{upload['upload_id']}/complete")
+    assert response.status_code == 201
+    assert response.json["data"]["image_hash"] == hash_file(str(image_file))
+
+
+def test_part_at_the_wrong_offset_is_rejected(server, api, image_file):
+    data = image_file.read_bytes()
+    upload = create_upload(api, len(data))
+    assert put_part(api, upload["upload_id"], data[:1000], 0, len(data)).status_code == 200
+
+    response = put_part(api, upload["upload_id"], data[2000:3000], 2000, len(data))
+    assert response.status_code == 409
+    assert response.json["data"]["offset"] == 1000
+
+
+def test_complete_while_a_part_is_written_is_rejected(server, api, image_file):
+    data = image_file.read_bytes()
+    upload = create_upload(api, 1000)
+    assert put_part(api, upload["upload_id"], data[:1000], 0, 1000).status_code == 200
+    with open(temp_file_path(server, upload), "rb") as temp_file:
+        fcntl.flock(temp_file, fcntl.LOCK_EX)
+        response = api.post(f"/uploads/{upload['upload_id']}/complete")
+    assert response.status_code == 409
+    assert api.post(f"/uploads/{upload['upload_id']}/complete").status_code == 201
+
+
+def test_part_after_the_temp_file_went_away_is_not_found(server, api, image_file):
+    upload = create_upload(api, 1000)
+    os.unlink(temp_file_path(server, upload))
+
+    response = put_part(api, upload["upload_id"], image_file.read_bytes()[:1000], 0, 1000)
+    assert response.status_code == 404
+
+
+def test_part_is_dropped_when_the_session_moved_on(server, api, image_file, monkeypatch):
+    data = image_file.read_bytes()
+    upload = create_upload(api, len(data))
+    monkeypatch.setattr(server.database, "update_upload_progress", lambda *args: False)
+
+    response = put_part(api, upload["upload_id"], data[:1000], 0, len(data))
+    assert response.status_code == 409
+    assert os.path.getsize(temp_file_path(server, upload)) == 0
@@ -0,0 +1,116 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache:
+    """Thread-safe, size-bounded LRU cache with an optional per-entry TTL."""
+
+    def __init__(self, max_size: int = 1024, ttl: float = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._entries[key]
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        if self.max_size <= 0:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        with self._lock:
+            stale_keys = [
+                key for key, (value, _) in self._entries.items() if predicate(key, value)
+            ]
+            for key in stale_keys:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+        }
+
+
+class ResponseCache(LRUCache):
+    """Serialized read responses keyed by (kind, id), e.g. ("client", mac).
+
+    Entries are dropped on database change events. Writes made by other
+    processes (gunicorn workers, fleetcontrol) aren't seen, the TTL bounds
+    how long such entries stay stale.
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: float = None):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self._generation = 0
+
+    def get_or_load(self, key, load):
+        """Return the cached value for key, calling load() on a miss.
+
+        A value loaded while an invalidation happened isn't stored, it may
+        already be stale. None results aren't cached.
+        """
+        value = self.get(key)
+        if value is not None:
+            return value
+        generation = self._generation
+        value = load()
+        if value is not None:
+            with self._lock:
+                if generation == self._generation:
+                    self.set(key, value)
+        return value
+
+    def _invalidate_where(self, predicate):
+        with self._lock:
+            self._generation += 1
+        self.invalidate_where(predicate)
+
+    def handle_database_event(self, event: str, payload: dict):
+        if event in ["client_changed", "assignment_changed"]:
+            mac_addresses = set(payload["mac_addresses"])
+            self._invalidate_where(
+                lambda key, value: key[0] in ["client", "client_vms"] and key[1] in mac_addresses)
+        elif event == "image_changed":
+            # deleting an image also removes it from the clients' vm lists
+            self._invalidate_where(
+                lambda key, value: key == ("image", payload["image_id"]) or key[0] == "client_vms")
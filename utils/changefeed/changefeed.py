@@ -0,0 +1,140 @@
+import asyncio
+import datetime
+import logging
+import os
+import threading
+import time
+
+
+class ChangeFeed:
+    """Wakes up requests waiting for image assignment changes of a client.
+
+    Changes are rows of the client_changes table. One background thread per
+    process follows that table and remembers the latest change of every
+    client, so waiting requests only query the database once their client
+    actually changed. Changes written by this process wake the thread up
+    right away; changes written by other worker processes or by fleetcontrol
+    are picked up within poll_interval seconds.
+    """
+
+    def __init__(self, database, poll_interval: float = 1.0, retention: int = 86400):
+        self.database = database
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.logger = logging.getLogger(__name__)
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._condition = None
+        self._wakeup = None
+        self._latest_seq = 0
+        self._latest_seq_by_mac = {}
+        # mac address -> [(event loop, future)] of waiting asyncio requests
+        self._async_waiters = {}
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """Call listener(mac_addresses) from the feed thread with the clients
+        of every batch of changes it picks up, including other processes'."""
+        self._listeners.append(listener)
+
+    def handle_database_event(self, event: str, payload: dict):
+        if event == "assignment_changed" and self._pid == os.getpid():
+            self._wakeup.set()
+
+    def start(self):
+        # started on first use, so every forked worker follows the table with
+        # its own thread, and under gevent the primitives created here are
+        # the monkey patched ones
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            self._condition = threading.Condition()
+            self._wakeup = threading.Event()
+            self._latest_seq = self.database.get_latest_client_change_seq()
+            self._latest_seq_by_mac = {}
+            self._pid = pid
+        threading.Thread(target=self._follow, name="change-feed", daemon=True).start()
+
+    def _follow(self):
+        last_cleanup = 0
+        while True:
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+            try:
+                changes = self.database.get_changed_clients(self._latest_seq)
+                if time.monotonic() - last_cleanup > 3600:
+                    last_cleanup = time.monotonic()
+                    self.database.delete_client_changes(
+                        datetime.datetime.utcnow() - datetime.timedelta(seconds=self.retention))
+            except Exception as ex:
+                self.logger.error(f"Error following client changes: {ex}")
+                continue
+            if not changes:
+                continue
+            with self._condition:
+                for seq, mac_address in changes:
+                    self._latest_seq_by_mac[mac_address] = seq
+                    for loop, future in self._async_waiters.pop(mac_address, []):
+                        loop.call_soon_threadsafe(_resolve_future, future)
+                self._latest_seq = changes[-1][0]
+                self._condition.notify_all()
+            mac_addresses = list({mac_address for _, mac_address in changes})
+            for listener in self._listeners:
+                try:
+                    listener(mac_addresses)
+                except Exception as ex:
+                    self.logger.error(f"Error in client change listener: {ex}")
+
+    def current_seq(self) -> int:
+        """Cursor for a client that hasn't seen any change yet."""
+        return self.database.get_latest_client_change_seq()
+
+    def wait(self, mac_address: str, after_seq: int, timeout: float) -> list:
+        """Changes of a client after after_seq, waiting up to timeout seconds
+        for one when there are none yet. Returns an empty list on timeout."""
+        self.start()
+        changes = self.database.get_client_changes(mac_address, after_seq)
+        if changes or timeout <= 0:
+            return changes
+        with self._condition:
+            changed = self._condition.wait_for(
+                lambda: self._latest_seq_by_mac.get(mac_address, 0) > after_seq, timeout)
+        if not changed:
+            return []
+        return self.database.get_client_changes(mac_address, after_seq)
+
+    async def wait_async(self, mac_address: str, after_seq: int, timeout: float, executor=None) -> list:
+        """wait() for asyncio servers; waiting holds no thread, only the
+        database queries run in the executor."""
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, self.start)
+        changes = await loop.run_in_executor(executor, self.database.get_client_changes, mac_address, after_seq)
+        if changes or timeout <= 0:
+            return changes
+        future = loop.create_future()
+        waiter = (loop, future)
+        with self._condition:
+            if self._latest_seq_by_mac.get(mac_address, 0) > after_seq:
+                future.set_result(None)
+            else:
+                self._async_waiters.setdefault(mac_address, []).append(waiter)
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return []
+        finally:
+            with self._condition:
+                waiters = self._async_waiters.get(mac_address)
+                if waiters and waiter in waiters:
+                    waiters.remove(waiter)
+                    if not waiters:
+                        del self._async_waiters[mac_address]
+        return await loop.run_in_executor(executor, self.database.get_client_changes, mac_address, after_seq)
+
+
+def _resolve_future(future):
+    if not future.done():
+        future.set_result(None)
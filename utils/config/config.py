@@ -22,6 +22,8 @@ class ServerConfig:
         server_access_username_override = os.environ.get(
             "VALHALLA_SERVER_ACCESS_USERNAME")
         database_file_override = os.environ.get("VALHALLA_DATABASE_FILE")
+        database_url_override = os.environ.get("VALHALLA_DATABASE_URL")
+        database_replica_url_override = os.environ.get("VALHALLA_DATABASE_REPLICA_URL")
         server_logging_override = os.environ.get("VALHALLA_LOGLEVEL")
 
         if server_name_override:
@@ -36,6 +38,12 @@ class ServerConfig:
         if database_file_override:
             config["database_file"] = database_file_override
 
+        if database_url_override:
+            config["database_url"] = database_url_override
+
+        if database_replica_url_override:
+            config["database_replica_url"] = database_replica_url_override
+
         if server_password_override:
             config["server_password"] = server_password_override
 
@@ -56,3 +64,67 @@ class ServerConfig:
         self.jwt_secret = config["jwt_secret"]
         self.server_access_username = config["server_access_username"]
         self.server_loglevel = config["server_loglevel"]
+        self.server_workers = int(config.get("server_workers", 0))
+        self.server_threads = int(config.get("server_threads", 1))
+        self.server_graceful_timeout = int(config.get("server_graceful_timeout", 30))
+        self.server_worker_class = config.get("server_worker_class")
+        self.server_worker_connections = int(config.get("server_worker_connections", 1000))
+        self.server_async = bool(config.get("server_async", False))
+        self.server_async_io_workers = int(config.get("server_async_io_workers", 16))
+        # engine, pool and SQLite pragma settings passed on to Database
+        self.database_options = {
+            "database_url": config.get("database_url"),
+            "replica_url": config.get("database_replica_url"),
+            "pool_size": int(config.get("database_pool_size", 5)),
+            "max_overflow": int(config.get("database_max_overflow", 10)),
+            "pool_timeout": int(config.get("database_pool_timeout", 30)),
+            "journal_mode": config.get("database_journal_mode", "WAL"),
+            "synchronous": config.get("database_synchronous", "NORMAL"),
+            "busy_timeout": int(config.get("database_busy_timeout", 5000)),
+            "mmap_size": int(config.get("database_mmap_size", 268435456)),
+            "cache_size": int(config.get("database_cache_size", -65536)),
+        }
+        self.auth_cache_size = int(config.get("auth_cache_size", 1024))
+        self.auth_cache_ttl = int(config.get("auth_cache_ttl", 300))
+        self.access_token_ttl = int(config.get("access_token_ttl", 900))
+        self.refresh_token_ttl = int(config.get("refresh_token_ttl", 2592000))
+        self.bcrypt_rounds = int(config.get("bcrypt_rounds", 12))
+        self.login_workers = int(config.get("login_workers", 2))
+        self.login_max_pending = int(config.get("login_max_pending", 16))
+        self.login_retry_after = int(config.get("login_retry_after", 5))
+        self.client_batch_max_size = int(config.get("client_batch_max_size", 1000))
+        self.list_page_size = int(config.get("list_page_size", 100))
+        self.list_page_max_size = int(config.get("list_page_max_size", 1000))
+        self.image_store_path = config.get("image_store_path")
+        self.image_hash_algorithm = config.get("image_hash_algorithm", "sha256")
+        self.image_directory = config.get("image_directory", "images")
+        self.upload_session_ttl = int(config.get("upload_session_ttl", 86400))
+        self.delta_directory = config.get("delta_directory", "deltas")
+        self.image_variant_directory = config.get("image_variant_directory", "variants")
+        self.image_variant_encodings = config.get("image_variant_encodings")
+        self.image_variant_retry_interval = int(config.get("image_variant_retry_interval", 3600))
+        self.swarm_peer_ttl = int(config.get("swarm_peer_ttl", 600))
+        self.swarm_max_peers = int(config.get("swarm_max_peers", 20))
+        self.swarm_server_offload = bool(config.get("swarm_server_offload", False))
+        self.rollout_wave_size = int(config.get("rollout_wave_size", 50))
+        self.rollout_max_in_flight = int(config.get("rollout_max_in_flight", 10))
+        self.rollout_download_timeout = int(config.get("rollout_download_timeout", 3600))
+        self.rollout_wave_timeout = int(config.get("rollout_wave_timeout", 86400))
+        self.rollout_expiry_interval = int(config.get("rollout_expiry_interval", 300))
+        self.rollout_retry_after = int(config.get("rollout_retry_after", 60))
+        self.response_cache_size = int(config.get("response_cache_size", 4096))
+        self.response_cache_ttl = int(config.get("response_cache_ttl", 60))
+        self.change_feed_poll_interval = float(config.get("change_feed_poll_interval", 1.0))
+        self.change_feed_retention = int(config.get("change_feed_retention", 86400))
+        self.change_feed_max_wait = int(config.get("change_feed_max_wait", 60))
+        self.change_feed_keepalive = int(config.get("change_feed_keepalive", 15))
+        self.metrics_enabled = bool(config.get("metrics_enabled", True))
+        self.hash_workers = int(config.get("hash_workers", 0))
+        self.hash_cache_file = config.get("hash_cache_file", "hash_cache.json")
+        self.job_workers = int(config.get("job_workers", 2))
+        self.job_poll_interval = float(config.get("job_poll_interval", 1.0))
+        self.job_retry_delay = int(config.get("job_retry_delay", 60))
+        self.job_retention = int(config.get("job_retention", 604800))
+        self.image_scrub_interval = int(config.get("image_scrub_interval", 86400))
+        self.fleet_index_enabled = bool(config.get("fleet_index_enabled", False))
+        self.fleet_index_refresh_interval = int(config.get("fleet_index_refresh_interval", 60))
@@ -1,21 +1,141 @@
-from sqlalchemy import create_engine
+from contextlib import contextmanager
+from sqlalchemy import create_engine, event, func, or_, and_, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
-from utils.models.models import Client, VMImage, User, Base
+from utils.models.models import Client, VMImage, User, ImageChunk, ImageSeed, Rollout, RolloutTarget, ClientChange, Job, UploadSession, Base, client_image_table
 from utils.exceptions.DatabaseException import DatabaseException
+from utils.metrics.metrics import REGISTRY
+from utils.migrations import migrations
+from functools import wraps
+import datetime
+import inspect
+import json
 import logging
+import time
+import weakref
+import zlib
+
+
+SQLITE_JOURNAL_MODES = ["DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"]
+SQLITE_SYNCHRONOUS_MODES = ["OFF", "NORMAL", "FULL", "EXTRA"]
+# mac addresses per IN (...) of batch operations
+MAC_ADDRESS_BATCH_SIZE = 500
+# INSERT ... ON CONFLICT, per database backend
+INSERT_CONSTRUCTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+DATABASE_CALL_SECONDS = REGISTRY.histogram(
+    "orchestrator_database_call_duration_seconds", "Duration of Database method calls", ["method"])
+DATABASE_CALL_ERRORS = REGISTRY.counter(
+    "orchestrator_database_call_errors_total", "Database method calls that raised", ["method"])
+# every Database of the process, their pools are read at scrape time
+_databases = weakref.WeakSet()
+
+
+def _pool_status() -> dict:
+    status = {}
+    for database in list(_databases):
+        engines = [("primary", database.engine)]
+        if database.replica_engine is not None:
+            engines.append(("replica", database.replica_engine))
+        for engine_name, engine in engines:
+            pool = engine.pool
+            for state, connections in [
+                ("checked_out", pool.checkedout()),
+                ("idle", pool.checkedin()),
+                ("overflow", max(pool.overflow(), 0)),
+                ("size", pool.size()),
+            ]:
+                status[(engine_name, state)] = status.get((engine_name, state), 0) + connections
+    return status
+
+
+DATABASE_POOL_CONNECTIONS = REGISTRY.gauge(
+    "orchestrator_database_pool_connections", "Connections of the database connection pools",
+    ["engine", "state"], callback=_pool_status)
 
 
 class Database:
-    def __init__(self, database_file: str, logging_level: str):
+    def __init__(
+        self,
+        database_file: str,
+        logging_level: str,
+        pool_size: int = 5,
+        max_overflow: int = 10,
+        pool_timeout: int = 30,
+        journal_mode: str = "WAL",
+        synchronous: str = "NORMAL",
+        busy_timeout: int = 5000,
+        mmap_size: int = 268435456,
+        cache_size: int = -65536,
+        database_url: str = None,
+        replica_url: str = None,
+        check_schema: bool = True,
+    ):
+        """Connect to `database_url`, or to the SQLite file `database_file`
+        when no URL is given. The journal, synchronous and cache options
+        only apply to SQLite.
+
+        With `replica_url`, reads that can tolerate replication lag (client
+        and image lookups and listings) go to that database instead, see
+        session_scope.
+
+        An empty database gets all tables created. One with migrations
+        missing is refused until they are applied with migrate()
+        (fleetcontrol migrate), unless check_schema is False.
+        """
+        # callables notified with (event, payload) after successful writes,
+        # used by in-process caches to drop stale entries
+        self.listeners = []
         try:
+            journal_mode = journal_mode.upper()
+            synchronous = synchronous.upper()
+            if journal_mode not in SQLITE_JOURNAL_MODES:
+                raise DatabaseException(f"Unsupported journal mode: {journal_mode}")
+            if synchronous not in SQLITE_SYNCHRONOUS_MODES:
+                raise DatabaseException(f"Unsupported synchronous mode: {synchronous}")
+            self.database_file = database_file
+            self.database_url = database_url or f"sqlite:///{database_file}"
+            self.replica_url = replica_url
+            self.dialect = make_url(self.database_url).get_backend_name()
+            if self.dialect not in INSERT_CONSTRUCTS:
+                raise DatabaseException(f"Unsupported database: {self.dialect}")
+            self.pool_size = pool_size
+            self.max_overflow = max_overflow
+            self.pool_timeout = pool_timeout
+            self.pragmas = {
+                "journal_mode": journal_mode,
+                "synchronous": synchronous,
+                "busy_timeout": int(busy_timeout),
+                "mmap_size": int(mmap_size),
+                "cache_size": int(cache_size),
+            }
             # Connect to the database using SQLAlchemy
-            engine = create_engine(f"sqlite:///{database_file}")
+            self.engine = self._create_engine(self.database_url, pool_size)
             self.Session = sessionmaker()
-            self.Session.configure(bind=engine, expire_on_commit=False)
+            self.Session.configure(bind=self.engine, expire_on_commit=False)
+            self.replica_engine = None
+            self.ReplicaSession = None
+            if replica_url:
+                self.replica_engine = self._create_engine(replica_url, pool_size)
+                self.ReplicaSession = sessionmaker()
+                self.ReplicaSession.configure(bind=self.replica_engine, expire_on_commit=False)
+            _databases.add(self)
             self.base = Base
-            self.base.metadata.create_all(bind=engine)
-            # session = self.Session()
+            if check_schema:
+                schema_version = migrations.schema_version(self.engine)
+                if schema_version is None:
+                    migrations.migrate(self.engine)
+                elif schema_version < migrations.LATEST_VERSION:
+                    raise DatabaseException(
+                        f"Database schema is at version {schema_version}, this version of the orchestrator "
+                        f"needs {migrations.LATEST_VERSION}: run fleetcontrol migrate")
+                elif schema_version > migrations.LATEST_VERSION:
+                    raise DatabaseException(
+                        f"Database schema is at version {schema_version}, newer than the "
+                        f"{migrations.LATEST_VERSION} this version of the orchestrator supports")
             # create logger using data from config file
             self.logger = logging.getLogger(__name__)
             log_level_mapping_dict = {
@@ -31,23 +151,206 @@ class Database:
             print(ex)
             exit(-1)
 
-    def get_clients(self) -> list[Client]:
-        result = []
+    def _create_engine(self, database_url: str, pool_size: int):
+        if make_url(database_url).get_backend_name() != "sqlite":
+            return create_engine(
+                database_url,
+                pool_size=pool_size,
+                max_overflow=self.max_overflow,
+                pool_timeout=self.pool_timeout,
+                # connections dropped by the server or a proxy in between are
+                # replaced instead of failing the next request
+                pool_pre_ping=True,
+            )
+        engine = create_engine(
+            database_url,
+            poolclass=QueuePool,
+            pool_size=pool_size,
+            max_overflow=self.max_overflow,
+            pool_timeout=self.pool_timeout,
+            connect_args={
+                "check_same_thread": False,
+                "timeout": self.pragmas["busy_timeout"] / 1000,
+            },
+        )
+
+        @event.listens_for(engine, "connect")
+        def on_connect(dbapi_connection, connection_record):
+            # let SQLAlchemy emit BEGIN itself (see on_begin) instead of the
+            # pysqlite driver deferring it until the first write
+            dbapi_connection.isolation_level = None
+            cursor = dbapi_connection.cursor()
+            for pragma, value in self.pragmas.items():
+                cursor.execute(f"PRAGMA {pragma}={value}")
+            cursor.close()
+
+        @event.listens_for(engine, "begin")
+        def on_begin(connection):
+            # writers take the write lock up front, so two transactions that
+            # started as readers can't deadlock when upgrading to writers
+            if connection.get_execution_options().get("sqlite_write"):
+                connection.exec_driver_sql("BEGIN IMMEDIATE")
+            else:
+                connection.exec_driver_sql("BEGIN")
+
+        return engine
+
+    def migrate(self) -> list[tuple[int, str]]:
+        """Apply missing schema migrations, returns (version, description)
+        of the ones applied."""
         try:
+            return migrations.migrate(self.engine)
+        except Exception as ex:
+            self.logger.error(f"Couldn't migrate the database: {ex}")
+            raise DatabaseException(f"Couldn't migrate the database: {ex}")
+
+    def get_schema_version(self) -> int:
+        return migrations.schema_version(self.engine)
+
+    def reconnect(self, pool_size: int = None):
+        """Replace the engine, e.g. in a freshly forked worker process."""
+        if pool_size is not None:
+            self.pool_size = pool_size
+        # connections inherited from the parent process must not be reused
+        self.engine.dispose(close=False)
+        self.engine = self._create_engine(self.database_url, self.pool_size)
+        self.Session.configure(bind=self.engine)
+        if self.replica_engine is not None:
+            self.replica_engine.dispose(close=False)
+            self.replica_engine = self._create_engine(self.replica_url, self.pool_size)
+            self.ReplicaSession.configure(bind=self.replica_engine)
+
+    def _insert(self, table):
+        """INSERT supporting on_conflict_do_update / on_conflict_do_nothing."""
+        return INSERT_CONSTRUCTS[self.dialect](table)
+
+    @contextmanager
+    def session_scope(self, write: bool = False, replica: bool = False):
+        """Session wrapped in a transaction that is always closed afterwards.
+
+        The transaction is committed when the block finishes and rolled back
+        if it raises. Reads with `replica` go to the read replica when one
+        is configured, so they may miss writes of the last moments.
+        """
+        if replica and self.ReplicaSession is not None:
+            session = self.ReplicaSession()
+        else:
             session = self.Session()
+        try:
             with session.begin():
+                if write:
+                    session.connection(execution_options={"sqlite_write": True})
+                yield session
+        finally:
+            session.close()
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def _notify(self, event: str, **payload):
+        for listener in self.listeners:
+            try:
+                listener(event, payload)
+            except Exception as ex:
+                self.logger.error(f"Error notifying listener about {event}: {ex}")
+
+    def get_clients(self) -> list[Client]:
+        result = []
+        try:
+            with self.session_scope(replica=True) as session:
                 result = session.query(Client).all()
         except Exception as ex:
             self.logger.error(f"Error getting list of clients from database: {ex}")
             result = []
         return result
 
-    def get_client_by_mac_address(self, mac_address: str) -> Client:
+    def get_clients_page(
+        self,
+        after: str = None,
+        limit: int = 100,
+        fields: list[str] = None,
+        client_version: str = None,
+        hostname_prefix: str = None,
+    ) -> list[dict]:
+        """One page of clients ordered by mac address, starting after `after`.
+
+        Only the requested `fields` are selected, unknown ones raise
+        ValueError; rows are returned as dictionaries of strings, like
+        Client.as_dict().
+        """
+        query_filters = []
+        if after is not None:
+            query_filters.append(Client.mac_address > after)
+        if client_version is not None:
+            query_filters.append(Client.client_version == client_version)
+        if hostname_prefix is not None:
+            query_filters.append(Client.hostname.startswith(hostname_prefix, autoescape=True))
+        return self._get_page(Client, Client.mac_address, query_filters, limit, fields)
+
+    def get_images_page(
+        self,
+        after: int = None,
+        limit: int = 100,
+        fields: list[str] = None,
+        image_name: str = None,
+    ) -> list[dict]:
+        """One page of images ordered by id, starting after `after`."""
+        query_filters = []
+        if after is not None:
+            query_filters.append(VMImage.image_id > after)
+        if image_name is not None:
+            query_filters.append(VMImage.image_name == image_name)
+        return self._get_page(VMImage, VMImage.image_id, query_filters, limit, fields)
+
+    def iter_clients(self, page_size: int = 1000, **filters):
+        """Yield pages of clients until the whole table was read."""
+        after = None
+        while True:
+            page = self.get_clients_page(after=after, limit=page_size, **filters)
+            if not page:
+                return
+            yield page
+            after = page[-1]["mac_address"]
+
+    def iter_images(self, page_size: int = 1000, **filters):
+        """Yield pages of images until the whole table was read."""
+        after = None
+        while True:
+            page = self.get_images_page(after=after, limit=page_size, **filters)
+            if not page:
+                return
+            yield page
+            after = int(page[-1]["image_id"])
+
+    def _get_page(self, model, key_column, query_filters, limit, fields):
+        column_names = [column.name for column in model.__table__.columns]
+        if fields is None:
+            fields = column_names
+        invalid_fields = [field for field in fields if field not in column_names]
+        if invalid_fields:
+            raise ValueError(f"Unknown fields: {', '.join(invalid_fields)}")
+        # the key column is always selected so the caller can build a cursor
+        if key_column.name not in fields:
+            fields = [key_column.name] + list(fields)
+        try:
+            with self.session_scope(replica=True) as session:
+                rows = (
+                    session.query(*[model.__table__.c[field] for field in fields])
+                    .filter(*query_filters)
+                    .order_by(key_column)
+                    .limit(limit)
+                    .all()
+                )
+        except Exception as ex:
+            self.logger.error(f"Error getting page of {model.__tablename__} from database: {ex}")
+            raise DatabaseException(f"Error getting page of {model.__tablename__} from database: {ex}")
+        return [{field: str(value) for field, value in zip(fields, row)} for row in rows]
+
+    def get_client_by_mac_address(self, mac_address: str, replica: bool = True) -> Client:
+        """Pass replica=False to see a write made moments ago."""
         result = None
-        session = self.Session()
-        session.expire_on_commit = False
         try:
-            with session.begin():
+            with self.session_scope(replica=replica) as session:
                 result = (
                     session.query(Client)
                     .filter(Client.mac_address == mac_address)
@@ -57,20 +360,52 @@ class Database:
             self.logger.warn(f"Error getting client by mac address: {ex}")
         return result
     
+    def get_fleet_rows(self, mac_addresses: list[str] = None) -> tuple[list, list]:
+        """Plain (mac, ip, hostname, version) rows of the given clients, or
+        of all of them, and their (mac, image id) assignments, without
+        building ORM objects. Used to fill the in-memory fleet index."""
+        client_columns = [Client.mac_address, Client.ip_address, Client.hostname, Client.client_version]
+        assignment_columns = [client_image_table.c.client_mac, client_image_table.c.image_id]
+        try:
+            with self.session_scope() as session:
+                if mac_addresses is None:
+                    client_rows = session.query(*client_columns).all()
+                    assignment_rows = session.query(*assignment_columns).all()
+                else:
+                    client_rows, assignment_rows = [], []
+                    for start in range(0, len(mac_addresses), MAC_ADDRESS_BATCH_SIZE):
+                        mac_address_batch = mac_addresses[start:start + MAC_ADDRESS_BATCH_SIZE]
+                        client_rows += session.query(*client_columns).filter(
+                            Client.mac_address.in_(mac_address_batch)).all()
+                        assignment_rows += session.query(*assignment_columns).filter(
+                            client_image_table.c.client_mac.in_(mac_address_batch)).all()
+                return [tuple(row) for row in client_rows], [tuple(row) for row in assignment_rows]
+        except Exception as ex:
+            self.logger.error(f"Error getting data from database: {ex}")
+            raise DatabaseException(f"Error getting data from database: {ex}")
+
+    def get_image_rows(self, image_ids: list[int] = None) -> list[tuple]:
+        """Plain rows of the given images, or all of them, in VMImage column order."""
+        try:
+            with self.session_scope() as session:
+                query = session.query(*VMImage.__table__.columns)
+                if image_ids is not None:
+                    query = query.filter(VMImage.image_id.in_(image_ids))
+                return [tuple(row) for row in query]
+        except Exception as ex:
+            self.logger.error(f"Error getting data from database: {ex}")
+            raise DatabaseException(f"Error getting data from database: {ex}")
+
     def get_client_vm_list_by_mac_address(self, mac_address: str):
         result = None
-        session = self.Session()
-        session.expire_on_commit = False
         try:
-            with session.begin():
-                client = (
-                    session.query(Client)
-                    .filter(Client.mac_address == mac_address)
-                    .first()
-                )
-                result = []
-                for vm in client.vm_list_on_machine:
-                    result.append(vm.image_id)
+            with self.session_scope(replica=True) as session:
+                result = [
+                    row.image_id
+                    for row in session.query(client_image_table.c.image_id).filter(
+                        client_image_table.c.client_mac == mac_address
+                    )
+                ]
         except Exception as ex:
             self.logger.warn(f"Error getting client by mac address: {ex}")
         return result
@@ -78,64 +413,141 @@ class Database:
     def get_clients_by_client_version(self, client_version: str) -> list[Client]:
         result = []
         try:
-            session = self.Session()
-            with session.begin():
-                result = session.query(Client, client_version=client_version).all()
+            with self.session_scope(replica=True) as session:
+                result = (
+                    session.query(Client)
+                    .filter(Client.client_version == client_version)
+                    .all()
+                )
         except Exception as ex:
             self.logger.warn(f"Error getting client list by software version: {ex}")
         return result
 
     def get_clients_by_vm_image(self, vm_image: VMImage) -> list[Client]:
+        return self.get_clients_by_image_id(vm_image.image_id)
+
+    def get_clients_by_image_id(self, image_id: int) -> list[Client]:
         result = []
         try:
-            clients_list = self.get_clients()
-            for client in clients_list:
-                if client.has_vm_installed(vm_image.image_hash):
-                    result.append()
+            with self.session_scope(replica=True) as session:
+                result = (
+                    session.query(Client)
+                    .join(
+                        client_image_table,
+                        client_image_table.c.client_mac == Client.mac_address,
+                    )
+                    .filter(client_image_table.c.image_id == image_id)
+                    .all()
+                )
         except Exception as ex:
             self.logger.warn(f"Error getting list of clients with VM installed: {ex}")
             result = []
         return result
 
+    def get_images_by_client(self, mac_address: str) -> list[VMImage]:
+        result = []
+        try:
+            with self.session_scope(replica=True) as session:
+                result = (
+                    session.query(VMImage)
+                    .join(
+                        client_image_table,
+                        client_image_table.c.image_id == VMImage.image_id,
+                    )
+                    .filter(client_image_table.c.client_mac == mac_address)
+                    .all()
+                )
+        except Exception as ex:
+            self.logger.warn(f"Error getting list of images installed on client: {ex}")
+            result = []
+        return result
+
     def add_client(self, client: Client):
+        client_row = (client.mac_address, client.ip_address, client.hostname, client.client_version)
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope(write=True) as session:
                 session.add(client)
-                session.flush()
-                session.commit()
         except Exception as ex:
             self.logger.error(f"Error adding entity to database: {ex}")
             raise DatabaseException("Error adding entity to database")
+        self._notify("client_changed", mac_addresses=[client_row[0]], clients=[client_row])
 
     def modify_client(self, client: Client) -> Client:
+        client_row = (client.mac_address, client.ip_address, client.hostname, client.client_version)
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope(write=True) as session:
                 old_object: Client = session.query(Client).filter(Client.mac_address==client.mac_address).first()
                 old_object.ip_address = client.ip_address
                 old_object.hostname = client.hostname
                 old_object.client_version = client.client_version
                 session.merge(old_object)
-                session.flush()
-                session.commit()
-                return old_object
         except Exception as ex:
             self.logger.error(f"Error modifying object in the database: {ex}")
             raise DatabaseException("Error modifying entity in database")
+        self._notify("client_changed", mac_addresses=[client_row[0]], clients=[client_row])
+        return old_object
+
+    def upsert_clients(self, client_records: list[dict]) -> dict:
+        """Insert or update many clients in one transaction.
+
+        Returns a dictionary mapping every mac address to either "created"
+        or "updated".
+        """
+        # later records for the same mac address win
+        records_by_mac = {}
+        for record in client_records:
+            records_by_mac[record["mac_address"]] = {
+                "mac_address": record["mac_address"],
+                "ip_address": record["ip_address"],
+                "hostname": record["hostname"],
+                "client_version": record["client_version"],
+            }
+        if not records_by_mac:
+            return {}
+        try:
+            with self.session_scope(write=True) as session:
+                existing = {
+                    row.mac_address
+                    for row in session.query(Client.mac_address).filter(
+                        Client.mac_address.in_(records_by_mac.keys())
+                    )
+                }
+                statement = self._insert(Client).values(list(records_by_mac.values()))
+                statement = statement.on_conflict_do_update(
+                    index_elements=[Client.mac_address],
+                    set_={
+                        "ip_address": statement.excluded.ip_address,
+                        "hostname": statement.excluded.hostname,
+                        "client_version": statement.excluded.client_version,
+                    },
+                )
+                session.execute(statement)
+        except Exception as ex:
+            self.logger.error(f"Error upserting clients in the database: {ex}")
+            raise DatabaseException(f"Error upserting clients in the database: {ex}")
+        self._notify(
+            "client_changed",
+            mac_addresses=list(records_by_mac),
+            clients=[tuple(record.values()) for record in records_by_mac.values()],
+        )
+        return {
+            mac_address: "updated" if mac_address in existing else "created"
+            for mac_address in records_by_mac
+        }
 
     def delete_client(self, client: Client):
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope(write=True) as session:
                 session.delete(client)
         except Exception as ex:
             self.logger.error(f"Error deleting client from database: {ex}")
+            return
+        self._notify("client_changed", mac_addresses=[client.mac_address], clients=[])
 
-    def get_image_by_id(self, image_id: int) -> VMImage:
+    def get_image_by_id(self, image_id: int, replica: bool = True) -> VMImage:
+        """Pass replica=False to see a write made moments ago."""
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope(replica=replica) as session:
                 response = (
                     session.query(VMImage).filter(VMImage.image_id == image_id).first()
                 )
@@ -145,8 +557,7 @@ class Database:
 
     def get_images(self) -> list[VMImage]:
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope(replica=True) as session:
                 response = session.query(VMImage).all()
                 return response
         except Exception as ex:
@@ -154,8 +565,7 @@ class Database:
 
     def get_image_by_name(self, image_name: str) -> list[VMImage]:
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope(replica=True) as session:
                 response = (
                     session.query(VMImage)
                     .filter(VMImage.image_name == image_name)
@@ -165,12 +575,27 @@ class Database:
         except Exception as ex:
             self.logger.error(f"Error getting list of images from database: {ex}")
 
+    def get_previous_image_version(self, image: VMImage, replica: bool = True) -> VMImage:
+        """The image with the same name registered right before this one."""
+        try:
+            with self.session_scope(replica=replica) as session:
+                return (
+                    session.query(VMImage)
+                    .filter(
+                        VMImage.image_name == image.image_name,
+                        VMImage.image_id < image.image_id,
+                    )
+                    .order_by(VMImage.image_id.desc())
+                    .first()
+                )
+        except Exception as ex:
+            self.logger.error(f"Error getting previous version of image: {ex}")
+
     def get_image_by_name_version_string(
         self, image_name_version_string: str
     ) -> list[VMImage]:
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope() as session:
                 response = (
                     session.query(VMImage)
                     .filter(
@@ -184,8 +609,7 @@ class Database:
 
     def get_image_by_hash(self, image_hash: str) -> list[VMImage]:
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope() as session:
                 response = (
                     session.query(VMImage)
                     .filter(VMImage.image_hash == image_hash)
@@ -197,36 +621,42 @@ class Database:
 
     def add_image(self, image: VMImage):
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope(write=True) as session:
                 session.add(image)
-                session.flush()
-                session.commit()
         except Exception as ex:
             self.logger.error(f"Couldn't save client data do database: {ex}")
             raise DatabaseException(f"Couldn't add image to database: {ex}")
+        self._notify("image_changed", image_id=image.image_id)
 
     def modify_image(self, new_image_object: VMImage) -> VMImage:
         try:
             old_object = self.get_image_by_id(new_image_object.image_id)
-            session = self.Session()
-            with session.begin():
+            with self.session_scope(write=True) as session:
                 old_object = new_image_object
                 session.merge(old_object)
-                session.flush()
-                session.commit()
-                return old_object
         except Exception as ex:
             self.logger.error(f"Couldn't modify object in database: {ex}")
             raise DatabaseException(f"Couldn't modify object in database: {ex}")
+        self._notify("image_changed", image_id=new_image_object.image_id)
+        return old_object
 
     def delete_image(self, image_to_delete: VMImage):
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope(write=True) as session:
+                session.query(ImageChunk).filter(
+                    ImageChunk.image_id == image_to_delete.image_id
+                ).delete()
+                session.query(ImageSeed).filter(
+                    ImageSeed.image_id == image_to_delete.image_id
+                ).delete()
+                assigned_mac_addresses = [
+                    row.client_mac for row in session.query(client_image_table.c.client_mac).filter(
+                        client_image_table.c.image_id == image_to_delete.image_id
+                    )
+                ]
+                self._record_client_changes(
+                    session, image_to_delete.image_id, assigned_mac_addresses, "detached")
                 session.delete(image_to_delete)
-                session.flush()
-                session.commit()
         except Exception as ex:
             self.logger.error(
                 f"Error deleting image with id={image_to_delete.image_id}: {str(ex)}"
@@ -234,13 +664,121 @@ class Database:
             raise DatabaseException(
                 f"Error deleting image with id={image_to_delete.image_id}: {str(ex)}"
             )
+        self._notify("image_changed", image_id=image_to_delete.image_id)
+        if assigned_mac_addresses:
+            self._notify("assignment_changed", mac_addresses=assigned_mac_addresses)
+
+    def set_image_manifest(self, image_id: int, manifest: list[tuple[str, int, int]]):
+        try:
+            with self.session_scope(write=True) as session:
+                session.query(ImageChunk).filter(ImageChunk.image_id == image_id).delete()
+                session.bulk_insert_mappings(
+                    ImageChunk,
+                    [
+                        {
+                            "image_id": image_id,
+                            "chunk_index": chunk_index,
+                            "chunk_hash": chunk_hash,
+                            "chunk_offset": chunk_offset,
+                            "chunk_size": chunk_size,
+                        }
+                        for chunk_index, (chunk_hash, chunk_offset, chunk_size) in enumerate(manifest)
+                    ],
+                )
+        except Exception as ex:
+            self.logger.error(f"Couldn't save manifest of image with id={image_id}: {ex}")
+            raise DatabaseException(f"Couldn't save manifest of image with id={image_id}: {ex}")
+
+    def get_image_manifest(self, image_id: int, replica: bool = True) -> list[ImageChunk]:
+        """Pass replica=False to see a manifest saved moments ago."""
+        try:
+            with self.session_scope(replica=replica) as session:
+                return (
+                    session.query(ImageChunk)
+                    .filter(ImageChunk.image_id == image_id)
+                    .order_by(ImageChunk.chunk_index)
+                    .all()
+                )
+        except Exception as ex:
+            self.logger.error(f"Error getting manifest of image with id={image_id}: {ex}")
+            raise DatabaseException(f"Error getting manifest of image with id={image_id}: {ex}")
+
+    def get_referenced_chunk_hashes(self) -> set[str]:
+        try:
+            with self.session_scope() as session:
+                return {row.chunk_hash for row in session.query(ImageChunk.chunk_hash).distinct()}
+        except Exception as ex:
+            self.logger.error(f"Error getting list of referenced chunks: {ex}")
+            raise DatabaseException(f"Error getting list of referenced chunks: {ex}")
+
+    def announce_image_seed(
+        self, client_mac_address: str, image_id: int, peer_port: int = None, chunk_indexes: list[int] = None
+    ):
+        """Record which chunks of an image a client holds; None means all of them."""
+        seed_record = {
+            "client_mac": client_mac_address,
+            "image_id": image_id,
+            "peer_port": peer_port,
+            "complete": chunk_indexes is None,
+            "chunk_bitmap": None if chunk_indexes is None else ImageSeed.encode_chunk_bitmap(chunk_indexes),
+            "last_seen": datetime.datetime.utcnow(),
+        }
+        try:
+            with self.session_scope(write=True) as session:
+                statement = self._insert(ImageSeed).values(seed_record)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[ImageSeed.client_mac, ImageSeed.image_id],
+                    set_={
+                        "peer_port": statement.excluded.peer_port,
+                        "complete": statement.excluded.complete,
+                        "chunk_bitmap": statement.excluded.chunk_bitmap,
+                        "last_seen": statement.excluded.last_seen,
+                    },
+                )
+                session.execute(statement)
+        except Exception as ex:
+            self.logger.error(f"Couldn't save image seed of client {client_mac_address}: {ex}")
+            raise DatabaseException(f"Couldn't save image seed of client {client_mac_address}: {ex}")
+
+    def get_image_seeds(self, image_id: int, seen_after: datetime.datetime) -> list[tuple[ImageSeed, str]]:
+        """Live seeds of an image together with their clients' ip addresses."""
+        try:
+            with self.session_scope(replica=True) as session:
+                return (
+                    session.query(ImageSeed, Client.ip_address)
+                    .join(Client, Client.mac_address == ImageSeed.client_mac)
+                    .filter(
+                        ImageSeed.image_id == image_id,
+                        ImageSeed.last_seen > seen_after,
+                    )
+                    .all()
+                )
+        except Exception as ex:
+            self.logger.error(f"Error getting seeds of image with id={image_id}: {ex}")
+            raise DatabaseException(f"Error getting seeds of image with id={image_id}: {ex}")
+
+    def get_chunk_seeds(self, chunk_hash: str, seen_after: datetime.datetime) -> list[tuple[ImageSeed, int]]:
+        """Live seeds of every image with this chunk, with its index in that image."""
+        try:
+            with self.session_scope(replica=True) as session:
+                return (
+                    session.query(ImageSeed, ImageChunk.chunk_index)
+                    .join(ImageSeed, ImageSeed.image_id == ImageChunk.image_id)
+                    .filter(
+                        ImageChunk.chunk_hash == chunk_hash,
+                        ImageSeed.last_seen > seen_after,
+                    )
+                    .all()
+                )
+        except Exception as ex:
+            self.logger.error(f"Error getting seeds of chunk {chunk_hash}: {ex}")
+            raise DatabaseException(f"Error getting seeds of chunk {chunk_hash}: {ex}")
 
     def assign_image_to_client(
         self, client_mac_address: str, image_name_version_combo: str
     ):
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope(write=True) as session:
                 client = (
                     session.query(Client)
                     .filter(Client.mac_address == client_mac_address)
@@ -253,20 +791,20 @@ class Database:
                     )
                     .first()
                 )
-                client.vm_list_on_machine.append(image)
+                if image not in client.vm_list_on_machine:
+                    client.vm_list_on_machine.append(image)
+                    self._record_client_changes(session, image.image_id, [client_mac_address], "assigned")
                 session.merge(client)
-                session.flush()
-                session.commit()
         except Exception as ex:
             self.logger.error(f"Couldn't add image to client list: {str(ex)}")
             raise DatabaseException(f"Couldn't add image to client list: {str(ex)}")
+        self._notify("assignment_changed", mac_addresses=[client_mac_address])
 
     def detach_image_from_client(
         self, client_mac_address: str, image_name_version_combo: str
     ):
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope(write=True) as session:
                 client = (
                     session.query(Client)
                     .filter(Client.mac_address == client_mac_address)
@@ -280,30 +818,754 @@ class Database:
                     .first()
                 )
                 client.vm_list_on_machine.remove(image)
+                self._record_client_changes(session, image.image_id, [client_mac_address], "detached")
                 session.merge(client)
-                session.flush()
-                session.commit()
         except Exception as ex:
             self.logger.error(f"Couldn't remove image from client list: {str(ex)}")
             raise DatabaseException(
                 f"Couldn't remove image from client list: {str(ex)}"
             )
+        self._notify("assignment_changed", mac_addresses=[client_mac_address])
+
+    def _get_image_and_client_macs(self, session, mac_addresses: list[str], image_name_version_combo: str):
+        """Image and the set of known clients among mac_addresses, raises
+        for an unknown image or client so that a batch is all or nothing."""
+        image = (
+            session.query(VMImage)
+            .filter(VMImage.image_name_version_combo == image_name_version_combo)
+            .first()
+        )
+        if image is None:
+            raise DatabaseException(f"Image {image_name_version_combo} not found")
+        known_mac_addresses = set()
+        for start in range(0, len(mac_addresses), MAC_ADDRESS_BATCH_SIZE):
+            known_mac_addresses.update(
+                row.mac_address for row in session.query(Client.mac_address).filter(
+                    Client.mac_address.in_(mac_addresses[start:start + MAC_ADDRESS_BATCH_SIZE]))
+            )
+        unknown_mac_addresses = [
+            mac_address for mac_address in mac_addresses if mac_address not in known_mac_addresses]
+        if unknown_mac_addresses:
+            raise DatabaseException(f"Unknown clients: {', '.join(unknown_mac_addresses)}")
+        return image
+
+    def _get_assigned_macs(self, session, image_id: int, mac_addresses: list[str]) -> set[str]:
+        assigned = set()
+        for start in range(0, len(mac_addresses), MAC_ADDRESS_BATCH_SIZE):
+            assigned.update(
+                row.client_mac for row in session.query(client_image_table.c.client_mac).filter(
+                    client_image_table.c.image_id == image_id,
+                    client_image_table.c.client_mac.in_(mac_addresses[start:start + MAC_ADDRESS_BATCH_SIZE]),
+                )
+            )
+        return assigned
+
+    def assign_image_to_clients(self, mac_addresses: list[str], image_name_version_combo: str) -> list[str]:
+        """assign_image_to_client for many clients in one transaction,
+        returns the clients that didn't have the image yet."""
+        mac_addresses = list(dict.fromkeys(mac_addresses))
+        try:
+            with self.session_scope(write=True) as session:
+                image = self._get_image_and_client_macs(session, mac_addresses, image_name_version_combo)
+                already_assigned = self._get_assigned_macs(session, image.image_id, mac_addresses)
+                assigned = [mac_address for mac_address in mac_addresses if mac_address not in already_assigned]
+                if assigned:
+                    session.execute(
+                        client_image_table.insert(),
+                        [{"client_mac": mac_address, "image_id": image.image_id} for mac_address in assigned],
+                    )
+                    self._record_client_changes(session, image.image_id, assigned, "assigned")
+        except Exception as ex:
+            self.logger.error(f"Couldn't add image to client lists: {str(ex)}")
+            raise DatabaseException(f"Couldn't add image to client lists: {str(ex)}")
+        self._notify("assignment_changed", mac_addresses=assigned)
+        return assigned
+
+    def detach_image_from_clients(self, mac_addresses: list[str], image_name_version_combo: str) -> list[str]:
+        """detach_image_from_client for many clients in one transaction,
+        returns the clients that had the image."""
+        mac_addresses = list(dict.fromkeys(mac_addresses))
+        try:
+            with self.session_scope(write=True) as session:
+                image = self._get_image_and_client_macs(session, mac_addresses, image_name_version_combo)
+                assigned = self._get_assigned_macs(session, image.image_id, mac_addresses)
+                detached = [mac_address for mac_address in mac_addresses if mac_address in assigned]
+                for start in range(0, len(detached), MAC_ADDRESS_BATCH_SIZE):
+                    session.execute(
+                        client_image_table.delete().where(
+                            client_image_table.c.image_id == image.image_id,
+                            client_image_table.c.client_mac.in_(detached[start:start + MAC_ADDRESS_BATCH_SIZE]),
+                        )
+                    )
+                self._record_client_changes(session, image.image_id, detached, "detached")
+        except Exception as ex:
+            self.logger.error(f"Couldn't remove image from client lists: {str(ex)}")
+            raise DatabaseException(f"Couldn't remove image from client lists: {str(ex)}")
+        self._notify("assignment_changed", mac_addresses=detached)
+        return detached
+
+    def _record_client_changes(self, session, image_id: int, mac_addresses: list[str], change: str):
+        """Append assignment changes to the change feed, in the caller's transaction."""
+        if not mac_addresses:
+            return
+        now = datetime.datetime.utcnow()
+        session.bulk_insert_mappings(
+            ClientChange,
+            [
+                {"client_mac": mac_address, "image_id": image_id, "change": change, "created_at": now}
+                for mac_address in mac_addresses
+            ],
+        )
+
+    def get_client_changes(self, mac_address: str, after_seq: int, limit: int = 1000) -> list[ClientChange]:
+        try:
+            with self.session_scope() as session:
+                return (
+                    session.query(ClientChange)
+                    .filter(ClientChange.client_mac == mac_address, ClientChange.seq > after_seq)
+                    .order_by(ClientChange.seq)
+                    .limit(limit)
+                    .all()
+                )
+        except Exception as ex:
+            self.logger.error(f"Error getting changes of client {mac_address}: {ex}")
+            raise DatabaseException(f"Error getting changes of client {mac_address}: {ex}")
+
+    def get_changed_clients(self, after_seq: int, limit: int = 10000) -> list[tuple[int, str]]:
+        """(seq, mac address) of every change after after_seq, oldest first."""
+        try:
+            with self.session_scope() as session:
+                return [
+                    (row.seq, row.client_mac)
+                    for row in session.query(ClientChange.seq, ClientChange.client_mac)
+                    .filter(ClientChange.seq > after_seq)
+                    .order_by(ClientChange.seq)
+                    .limit(limit)
+                ]
+        except Exception as ex:
+            self.logger.error(f"Error getting client changes: {ex}")
+            raise DatabaseException(f"Error getting client changes: {ex}")
+
+    def get_latest_client_change_seq(self) -> int:
+        try:
+            with self.session_scope() as session:
+                return session.query(func.max(ClientChange.seq)).scalar() or 0
+        except Exception as ex:
+            self.logger.error(f"Error getting latest client change: {ex}")
+            raise DatabaseException(f"Error getting latest client change: {ex}")
+
+    def delete_client_changes(self, older_than: datetime.datetime):
+        try:
+            with self.session_scope(write=True) as session:
+                session.query(ClientChange).filter(
+                    ClientChange.created_at < older_than
+                ).delete(synchronize_session=False)
+        except Exception as ex:
+            self.logger.error(f"Couldn't delete old client changes: {ex}")
+            raise DatabaseException(f"Couldn't delete old client changes: {ex}")
+
+    def _select_clients_query(self, session, client_version: str = None, hostname_pattern: str = None,
+                              mac_addresses: list[str] = None):
+        query = session.query(Client.mac_address)
+        if client_version is not None:
+            query = query.filter(Client.client_version == client_version)
+        if hostname_pattern is not None:
+            # shell style pattern, e.g. "rack1-*"
+            like_pattern = (
+                hostname_pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                .replace("*", "%").replace("?", "_")
+            )
+            # case-insensitive everywhere, like SQLite's LIKE
+            query = query.filter(Client.hostname.ilike(like_pattern, escape="\\"))
+        if mac_addresses is not None:
+            query = query.filter(Client.mac_address.in_(mac_addresses))
+        return query.order_by(Client.mac_address)
+
+    def _start_rollout_wave(self, session, rollout: Rollout, wave: int) -> list[str]:
+        """Assign the image to the clients of a wave, returns their mac addresses."""
+        wave_mac_addresses = [
+            row.client_mac for row in session.query(RolloutTarget.client_mac).filter(
+                RolloutTarget.rollout_id == rollout.rollout_id,
+                RolloutTarget.wave == wave,
+            )
+        ]
+        if not wave_mac_addresses:
+            rollout.status = "finished"
+            return []
+        already_assigned = {
+            row.client_mac for row in session.query(client_image_table.c.client_mac).filter(
+                client_image_table.c.image_id == rollout.image_id,
+                client_image_table.c.client_mac.in_(wave_mac_addresses),
+            )
+        }
+        self._record_client_changes(
+            session, rollout.image_id,
+            [mac_address for mac_address in wave_mac_addresses if mac_address not in already_assigned],
+            "assigned",
+        )
+        # assign the image to the whole wave with one statement
+        session.execute(
+            self._insert(client_image_table).on_conflict_do_nothing(),
+            [{"client_mac": mac_address, "image_id": rollout.image_id} for mac_address in wave_mac_addresses],
+        )
+        session.query(RolloutTarget).filter(
+            RolloutTarget.rollout_id == rollout.rollout_id,
+            RolloutTarget.wave == wave,
+        ).update(
+            {RolloutTarget.state: "assigned", RolloutTarget.updated_at: datetime.datetime.utcnow()},
+            synchronize_session=False,
+        )
+        rollout.current_wave = wave
+        return wave_mac_addresses
+
+    def _advance_rollout(self, session, rollout: Rollout) -> list[str]:
+        """Start the next wave once no client of the current one is still busy."""
+        if rollout.status != "running":
+            return []
+        busy_targets = (
+            session.query(func.count())
+            .select_from(RolloutTarget)
+            .filter(
+                RolloutTarget.rollout_id == rollout.rollout_id,
+                RolloutTarget.wave == rollout.current_wave,
+                RolloutTarget.state.in_(["assigned", "downloading"]),
+            )
+            .scalar()
+        )
+        if busy_targets == 0:
+            return self._start_rollout_wave(session, rollout, rollout.current_wave + 1)
+        return []
+
+    def expire_rollout_targets(self, download_timeout: int, wave_timeout: int) -> int:
+        """Fail the clients of running rollouts that stopped reporting.
+
+        Downloads started more than download_timeout seconds ago, and
+        clients that didn't start downloading within wave_timeout seconds of
+        their wave being assigned, are marked failed so that one offline
+        client can't hold up the rollout. Returns how many were failed.
+        """
+        now = datetime.datetime.utcnow()
+        expired_targets = 0
+        assigned_mac_addresses = []
+        try:
+            with self.session_scope(write=True) as session:
+                for rollout in (
+                    session.query(Rollout)
+                    .filter(Rollout.status == "running")
+                    .with_for_update()
+                    .all()
+                ):
+                    rollout_expired_targets = (
+                        session.query(RolloutTarget)
+                        .filter(
+                            RolloutTarget.rollout_id == rollout.rollout_id,
+                            RolloutTarget.wave == rollout.current_wave,
+                            or_(
+                                and_(
+                                    RolloutTarget.state == "downloading",
+                                    or_(
+                                        RolloutTarget.download_started_at == None,
+                                        RolloutTarget.download_started_at
+                                        < now - datetime.timedelta(seconds=download_timeout),
+                                    ),
+                                ),
+                                and_(
+                                    RolloutTarget.state == "assigned",
+                                    RolloutTarget.updated_at < now - datetime.timedelta(seconds=wave_timeout),
+                                ),
+                            ),
+                        )
+                        .update(
+                            {RolloutTarget.state: "failed", RolloutTarget.updated_at: now},
+                            synchronize_session=False,
+                        )
+                    )
+                    if rollout_expired_targets:
+                        expired_targets += rollout_expired_targets
+                        assigned_mac_addresses += self._advance_rollout(session, rollout)
+        except Exception as ex:
+            self.logger.error(f"Couldn't expire rollout targets: {ex}")
+            raise DatabaseException(f"Couldn't expire rollout targets: {ex}")
+        if assigned_mac_addresses:
+            self._notify("assignment_changed", mac_addresses=assigned_mac_addresses)
+        return expired_targets
+
+    def create_rollout(self, image_id: int, selector: dict, wave_size: int, max_in_flight: int,
+                       selected_mac_addresses: list[str] = None) -> Rollout:
+        """Create a rollout of an image to every client matching the selector.
+
+        The selector may contain client_version, hostname_pattern and
+        mac_addresses. Clients are split into waves of wave_size and the
+        first wave is assigned right away. Returns None when no client
+        matches the selector.
+
+        Callers that already matched the selector, e.g. against the fleet
+        index, pass the result as selected_mac_addresses; only clients that
+        still exist are taken from it.
+        """
+        try:
+            with self.session_scope(write=True) as session:
+                if selected_mac_addresses is None:
+                    mac_addresses = [row.mac_address for row in self._select_clients_query(session, **selector)]
+                else:
+                    mac_addresses = sorted(
+                        row.mac_address
+                        for start in range(0, len(selected_mac_addresses), MAC_ADDRESS_BATCH_SIZE)
+                        for row in session.query(Client.mac_address).filter(Client.mac_address.in_(
+                            selected_mac_addresses[start:start + MAC_ADDRESS_BATCH_SIZE]))
+                    )
+                if not mac_addresses:
+                    return None
+                rollout = Rollout(
+                    image_id=image_id,
+                    selector=json.dumps(selector),
+                    wave_size=wave_size,
+                    max_in_flight=max_in_flight,
+                    current_wave=0,
+                    status="running",
+                )
+                session.add(rollout)
+                session.flush()
+                now = datetime.datetime.utcnow()
+                session.bulk_insert_mappings(
+                    RolloutTarget,
+                    [
+                        {
+                            "rollout_id": rollout.rollout_id,
+                            "client_mac": mac_address,
+                            "wave": target_index // wave_size,
+                            "state": "pending",
+                            "updated_at": now,
+                        }
+                        for target_index, mac_address in enumerate(mac_addresses)
+                    ],
+                )
+                assigned_mac_addresses = self._start_rollout_wave(session, rollout, 0)
+        except Exception as ex:
+            self.logger.error(f"Couldn't create rollout: {ex}")
+            raise DatabaseException(f"Couldn't create rollout: {ex}")
+        self._notify("assignment_changed", mac_addresses=assigned_mac_addresses)
+        return rollout
+
+    def get_rollout(self, rollout_id: int) -> Rollout:
+        try:
+            with self.session_scope() as session:
+                return session.query(Rollout).filter(Rollout.rollout_id == rollout_id).first()
+        except Exception as ex:
+            self.logger.error(f"Error getting rollout from database: {ex}")
+            raise DatabaseException(f"Error getting rollout from database: {ex}")
+
+    def get_rollout_progress(self, rollout_id: int) -> dict:
+        """Number of clients per state, per wave."""
+        try:
+            with self.session_scope() as session:
+                progress = {}
+                for wave, state, count in (
+                    session.query(RolloutTarget.wave, RolloutTarget.state, func.count())
+                    .filter(RolloutTarget.rollout_id == rollout_id)
+                    .group_by(RolloutTarget.wave, RolloutTarget.state)
+                ):
+                    progress.setdefault(wave, {})[state] = count
+                return progress
+        except Exception as ex:
+            self.logger.error(f"Error getting rollout progress from database: {ex}")
+            raise DatabaseException(f"Error getting rollout progress from database: {ex}")
+
+    def update_rollout_target(self, rollout_id: int, client_mac_address: str, state: str) -> bool:
+        """Record a client's progress, returns False if it isn't part of the rollout."""
+        try:
+            with self.session_scope(write=True) as session:
+                target = (
+                    session.query(RolloutTarget)
+                    .filter(
+                        RolloutTarget.rollout_id == rollout_id,
+                        RolloutTarget.client_mac == client_mac_address,
+                    )
+                    .first()
+                )
+                if target is None:
+                    return False
+                now = datetime.datetime.utcnow()
+                # begin_rollout_download counts downloads in flight by when they started
+                if state == "downloading" and (target.state != "downloading" or target.download_started_at is None):
+                    target.download_started_at = now
+                target.state = state
+                target.updated_at = now
+                session.flush()
+                rollout = (
+                    session.query(Rollout)
+                    .filter(Rollout.rollout_id == rollout_id)
+                    .with_for_update()
+                    .first()
+                )
+                assigned_mac_addresses = self._advance_rollout(session, rollout)
+        except Exception as ex:
+            self.logger.error(f"Couldn't update rollout progress: {ex}")
+            raise DatabaseException(f"Couldn't update rollout progress: {ex}")
+        if assigned_mac_addresses:
+            self._notify("assignment_changed", mac_addresses=assigned_mac_addresses)
+        return True
+
+    def begin_rollout_download(self, image_id: int, client_mac_address: str, download_timeout: int) -> bool:
+        """Check whether a client may download an image now.
+
+        Clients that are not part of a running rollout of the image may always
+        download it. Clients of a rollout have to wait for their wave, and
+        at most max_in_flight of them download at the same time; downloads
+        older than download_timeout seconds no longer count as in flight.
+        """
+        target_filter = [
+            Rollout.image_id == image_id,
+            Rollout.status == "running",
+            RolloutTarget.client_mac == client_mac_address,
+        ]
+        now = datetime.datetime.utcnow()
+        try:
+            # most downloads aren't gated, find that out without a write lock
+            with self.session_scope() as session:
+                target = (
+                    session.query(RolloutTarget)
+                    .join(Rollout, Rollout.rollout_id == RolloutTarget.rollout_id)
+                    .filter(*target_filter)
+                    .first()
+                )
+            if target is None or target.state in ["done", "failed"]:
+                return True
+            if target.state == "pending":
+                return False
+            # a download without a start time counts as timed out
+            if target.state == "downloading" and target.download_started_at is not None and \
+                    target.download_started_at > now - datetime.timedelta(seconds=download_timeout / 2):
+                return True
+            with self.session_scope(write=True) as session:
+                row = (
+                    session.query(RolloutTarget, Rollout)
+                    .join(Rollout, Rollout.rollout_id == RolloutTarget.rollout_id)
+                    .filter(*target_filter)
+                    # counts the downloads in flight one client at a time
+                    .with_for_update(of=Rollout)
+                    .first()
+                )
+                if row is None:
+                    return True
+                target, rollout = row
+                if target.state == "pending":
+                    return False
+                if target.state == "assigned":
+                    in_flight = (
+                        session.query(func.count())
+                        .select_from(RolloutTarget)
+                        .filter(
+                            RolloutTarget.rollout_id == rollout.rollout_id,
+                            RolloutTarget.state == "downloading",
+                            RolloutTarget.download_started_at > now - datetime.timedelta(seconds=download_timeout),
+                        )
+                        .scalar()
+                    )
+                    if in_flight >= rollout.max_in_flight:
+                        return False
+                    target.state = "downloading"
+                target.download_started_at = now
+                target.updated_at = now
+                return True
+        except Exception as ex:
+            self.logger.error(f"Error checking rollout download slot: {ex}")
+            raise DatabaseException(f"Error checking rollout download slot: {ex}")
+
+    def add_upload_session(self, upload_session: UploadSession):
+        try:
+            with self.session_scope(write=True) as session:
+                session.add(upload_session)
+        except Exception as ex:
+            self.logger.error(f"Couldn't add upload session to the database: {ex}")
+            raise DatabaseException(f"Couldn't add upload session to the database: {ex}")
+
+    def get_upload_session(self, upload_id: str) -> UploadSession:
+        try:
+            with self.session_scope() as session:
+                return (
+                    session.query(UploadSession)
+                    .filter(UploadSession.upload_id == upload_id)
+                    .first()
+                )
+        except Exception as ex:
+            self.logger.error(f"Error getting upload session from database: {ex}")
+            raise DatabaseException(f"Error getting upload session from database: {ex}")
+
+    def update_upload_progress(self, upload_id: str, old_offset: int, new_offset: int, block_digests: str) -> bool:
+        """Advance an upload from old_offset to new_offset.
+
+        Returns False if the upload is not at old_offset anymore.
+        """
+        try:
+            with self.session_scope(write=True) as session:
+                updated_rows = (
+                    session.query(UploadSession)
+                    .filter(
+                        UploadSession.upload_id == upload_id,
+                        UploadSession.received_bytes == old_offset,
+                    )
+                    .update(
+                        {
+                            UploadSession.received_bytes: new_offset,
+                            UploadSession.block_digests: block_digests,
+                            UploadSession.updated_at: datetime.datetime.utcnow(),
+                        },
+                        synchronize_session=False,
+                    )
+                )
+                return updated_rows == 1
+        except Exception as ex:
+            self.logger.error(f"Couldn't update upload session {upload_id}: {ex}")
+            raise DatabaseException(f"Couldn't update upload session {upload_id}: {ex}")
+
+    def complete_upload_session(self, upload_id: str, image: VMImage):
+        """Register the uploaded image and drop its upload session at once."""
+        try:
+            with self.session_scope(write=True) as session:
+                session.add(image)
+                session.query(UploadSession).filter(
+                    UploadSession.upload_id == upload_id
+                ).delete(synchronize_session=False)
+        except Exception as ex:
+            self.logger.error(f"Couldn't complete upload session {upload_id}: {ex}")
+            raise DatabaseException(f"Couldn't complete upload session {upload_id}: {ex}")
+        self._notify("image_changed", image_id=image.image_id)
+
+    def delete_stale_upload_sessions(self, older_than: datetime.datetime) -> list[str]:
+        """Delete upload sessions not updated since `older_than`.
+
+        Returns the temporary files of the deleted sessions.
+        """
+        try:
+            with self.session_scope(write=True) as session:
+                stale_sessions = (
+                    session.query(UploadSession)
+                    .filter(UploadSession.updated_at < older_than)
+                    .all()
+                )
+                for stale_session in stale_sessions:
+                    session.delete(stale_session)
+                return [stale_session.temp_file for stale_session in stale_sessions]
+        except Exception as ex:
+            self.logger.error(f"Couldn't delete stale upload sessions: {ex}")
+            raise DatabaseException(f"Couldn't delete stale upload sessions: {ex}")
+
+    def add_job(self, kind: str, payload: dict, priority: int = 0, max_attempts: int = 3,
+                job_key: str = None) -> Job:
+        """Queue a job, or return the queued or running job with the same key."""
+        try:
+            with self.session_scope(write=True) as session:
+                if job_key is not None:
+                    if self.dialect == "postgresql":
+                        # there is no row to lock yet
+                        session.execute(select(func.pg_advisory_xact_lock(zlib.crc32(job_key.encode("utf-8")))))
+                    existing_job = session.query(Job).filter(
+                        Job.job_key == job_key,
+                        Job.status.in_(["queued", "running"]),
+                    ).first()
+                    if existing_job is not None:
+                        return existing_job
+                new_job = Job(
+                    kind=kind,
+                    job_key=job_key,
+                    payload=json.dumps(payload),
+                    priority=priority,
+                    max_attempts=max_attempts,
+                )
+                session.add(new_job)
+                session.flush()
+        except Exception as ex:
+            self.logger.error(f"Couldn't add job to the database: {ex}")
+            raise DatabaseException(f"Couldn't add job to the database: {ex}")
+        self._notify("job_added", job_id=new_job.job_id)
+        return new_job
+
+    def get_job(self, job_id: int) -> Job:
+        try:
+            with self.session_scope() as session:
+                return session.query(Job).filter(Job.job_id == job_id).first()
+        except Exception as ex:
+            self.logger.error(f"Error getting job from database: {ex}")
+            raise DatabaseException(f"Error getting job from database: {ex}")
+
+    def get_latest_job(self, kind: str, job_key: str = None) -> Job:
+        """The last job of a kind queued, of the given job key if there is one."""
+        try:
+            with self.session_scope() as session:
+                query = session.query(Job).filter(Job.kind == kind)
+                if job_key is not None:
+                    query = query.filter(Job.job_key == job_key)
+                return query.order_by(Job.job_id.desc()).first()
+        except Exception as ex:
+            self.logger.error(f"Error getting job from database: {ex}")
+            raise DatabaseException(f"Error getting job from database: {ex}")
+
+    def claim_job(self, kinds: list[str], lease: int) -> Job:
+        """Mark the most urgent runnable job of the given kinds as running
+        for `lease` seconds and return it, None if there is none.
+
+        Running jobs whose lease ran out lost their worker and are run again,
+        or failed if that was their last attempt.
+        """
+        now = datetime.datetime.utcnow()
+        try:
+            with self.session_scope(write=True) as session:
+                session.query(Job).filter(
+                    Job.status == "running",
+                    Job.locked_until < now,
+                    Job.attempts >= Job.max_attempts,
+                ).update(
+                    {Job.status: "failed", Job.error: "Job worker stopped", Job.finished_at: now},
+                    synchronize_session=False,
+                )
+                job = (
+                    session.query(Job)
+                    .filter(
+                        Job.kind.in_(kinds),
+                        or_(
+                            and_(Job.status == "queued", Job.run_after <= now),
+                            and_(Job.status == "running", Job.locked_until < now),
+                        ),
+                    )
+                    .order_by(Job.priority.desc(), Job.job_id)
+                    # other workers skip the job instead of waiting for it
+                    .with_for_update(skip_locked=True)
+                    .first()
+                )
+                if job is None:
+                    return None
+                job.status = "running"
+                job.attempts += 1
+                job.progress = 0.0
+                job.started_at = now
+                job.locked_until = now + datetime.timedelta(seconds=lease)
+                return job
+        except Exception as ex:
+            self.logger.error(f"Couldn't claim job: {ex}")
+            raise DatabaseException(f"Couldn't claim job: {ex}")
+
+    def _claimed_job_filter(self, job_id: int, attempt: int) -> list:
+        # a job whose lease ran out may have been claimed again by another
+        # worker; the worker of an earlier attempt must not touch it anymore
+        return [Job.job_id == job_id, Job.status == "running", Job.attempts == attempt]
+
+    def update_job_progress(self, job_id: int, attempt: int, progress: float, lease: int) -> bool:
+        """Store the progress of a running job and extend its lease. Returns
+        False if the job isn't running its attempt `attempt` anymore."""
+        try:
+            with self.session_scope(write=True) as session:
+                updated_rows = session.query(Job).filter(*self._claimed_job_filter(job_id, attempt)).update(
+                    {
+                        Job.progress: progress,
+                        Job.locked_until: datetime.datetime.utcnow() + datetime.timedelta(seconds=lease),
+                    },
+                    synchronize_session=False,
+                )
+                return updated_rows == 1
+        except Exception as ex:
+            self.logger.error(f"Couldn't update job progress: {ex}")
+            raise DatabaseException(f"Couldn't update job progress: {ex}")
+
+    def extend_job_lease(self, job_id: int, attempt: int, lease: int) -> bool:
+        """Keep a running job claimed for another `lease` seconds. Returns
+        False if the job isn't running its attempt `attempt` anymore."""
+        try:
+            with self.session_scope(write=True) as session:
+                updated_rows = session.query(Job).filter(*self._claimed_job_filter(job_id, attempt)).update(
+                    {Job.locked_until: datetime.datetime.utcnow() + datetime.timedelta(seconds=lease)},
+                    synchronize_session=False,
+                )
+                return updated_rows == 1
+        except Exception as ex:
+            self.logger.error(f"Couldn't extend job lease: {ex}")
+            raise DatabaseException(f"Couldn't extend job lease: {ex}")
+
+    def finish_job(self, job_id: int, attempt: int, result: dict) -> bool:
+        """Mark a job done with its result. Returns False if the job isn't
+        running its attempt `attempt` anymore, the result is dropped then."""
+        try:
+            with self.session_scope(write=True) as session:
+                updated_rows = session.query(Job).filter(*self._claimed_job_filter(job_id, attempt)).update(
+                    {
+                        Job.status: "done",
+                        Job.progress: 1.0,
+                        Job.result: json.dumps(result),
+                        Job.error: None,
+                        Job.locked_until: None,
+                        Job.finished_at: datetime.datetime.utcnow(),
+                    },
+                    synchronize_session=False,
+                )
+                return updated_rows == 1
+        except Exception as ex:
+            self.logger.error(f"Couldn't finish job: {ex}")
+            raise DatabaseException(f"Couldn't finish job: {ex}")
+
+    def fail_job(self, job_id: int, attempt: int, error: str, retry_delay: int) -> Job:
+        """Queue a failed job again after retry_delay seconds times the
+        attempts so far, or mark it failed after its last attempt.
+
+        Returns None if the job isn't running its attempt `attempt` anymore.
+        """
+        now = datetime.datetime.utcnow()
+        try:
+            with self.session_scope(write=True) as session:
+                job = (
+                    session.query(Job)
+                    .filter(*self._claimed_job_filter(job_id, attempt))
+                    .with_for_update()
+                    .first()
+                )
+                if job is None:
+                    return None
+                job.error = error
+                job.locked_until = None
+                if job.attempts < job.max_attempts:
+                    job.status = "queued"
+                    job.run_after = now + datetime.timedelta(seconds=retry_delay * job.attempts)
+                else:
+                    job.status = "failed"
+                    job.finished_at = now
+                return job
+        except Exception as ex:
+            self.logger.error(f"Couldn't update failed job: {ex}")
+            raise DatabaseException(f"Couldn't update failed job: {ex}")
+
+    def delete_jobs(self, older_than: datetime.datetime):
+        """Remove done and failed jobs that finished before older_than."""
+        try:
+            with self.session_scope(write=True) as session:
+                session.query(Job).filter(
+                    Job.status.in_(["done", "failed"]),
+                    Job.finished_at < older_than,
+                ).delete(synchronize_session=False)
+        except Exception as ex:
+            self.logger.error(f"Couldn't delete old jobs: {ex}")
+            raise DatabaseException(f"Couldn't delete old jobs: {ex}")
 
     def add_user(self, new_user: User):
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope(write=True) as session:
                 session.add(new_user)
-                session.flush()
-                session.commit()
         except Exception as ex:
             self.logger.error(f"Couldn't add user to the database: {ex}")
             raise DatabaseException(f"Couldn't add user to the database: {ex}")
+        self._notify("user_changed", username=new_user.username)
+
+    def update_user_password_hash(self, username: str, password_hash: bytes):
+        try:
+            with self.session_scope(write=True) as session:
+                session.query(User).filter(User.username == username).update(
+                    {User.password_hash: password_hash}, synchronize_session=False)
+        except Exception as ex:
+            self.logger.error(f"Couldn't update user in the database: {ex}")
+            raise DatabaseException(f"Couldn't update user in the database: {ex}")
+        self._notify("user_changed", username=username)
 
     def get_user_by_id(self, user_id: int) -> User:
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope() as session:
                 user = session.query(User).filter(User.user_id == user_id).first()
                 return user
         except Exception as ex:
@@ -312,10 +1574,35 @@ class Database:
 
     def get_user_by_name(self, username: str) -> User:
         try:
-            session = self.Session()
-            with session.begin():
+            with self.session_scope() as session:
                 user = session.query(User).filter(User.username == username).first()
                 return user
         except Exception as ex:
             self.logger.error(f"Error getting data from database: {ex}")
             raise DatabaseException(f"Error getting data from database: {ex}")
+
+
+def _timed_database_method(method_name: str, method):
+    histogram = DATABASE_CALL_SECONDS
+    errors = DATABASE_CALL_ERRORS
+
+    @wraps(method)
+    def timed(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            errors.inc(1, method_name)
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - started, method_name)
+    return timed
+
+
+# time every public query method; generators (iter_*) only return their
+# iterator here, the queries they run are timed as get_*_page calls
+for _method_name, _method in list(vars(Database).items()):
+    if not _method_name.startswith("_") and inspect.isfunction(_method) \
+            and not inspect.isgeneratorfunction(_method) \
+            and _method_name not in ["session_scope", "add_listener", "reconnect"]:
+        setattr(Database, _method_name, _timed_database_method(_method_name, _method))
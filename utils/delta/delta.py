@@ -0,0 +1,232 @@
+import hashlib
+import os
+import struct
+import tempfile
+import zlib
+from utils.storage.storage import open_image_stream
+
+
+DELTA_MAGIC = b"VDLT1"
+DEFAULT_BLOCK_SIZE = 64 * 1024
+# a copy of `length` bytes from `offset` of the old image
+COPY_OPERATION = 0
+# `length` literal bytes that follow the operation header
+DATA_OPERATION = 1
+
+_header_format = struct.Struct(">5sIQ")
+_copy_format = struct.Struct(">BQI")
+_data_format = struct.Struct(">BI")
+
+
+def _block_digest(block: bytes) -> bytes:
+    return hashlib.blake2b(block, digest_size=16).digest()
+
+
+def _read_blocks(stream, block_size: int):
+    while True:
+        block = stream.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+def create_delta(
+    old_stream,
+    new_stream,
+    delta_stream,
+    block_size: int = DEFAULT_BLOCK_SIZE,
+) -> int:
+    """Write a block level delta turning old_stream into new_stream.
+
+    The old image is indexed in `block_size` blocks (64 KiB by default, the
+    qcow2 cluster size). As in rsync, the new image is searched for those
+    blocks at every byte offset with a rolling adler32, so data shifted by
+    any number of bytes is still found; the strong hash is only computed
+    where the rolling checksum matches. Matches become copy operations, the
+    rest is stored literally. The rolling runs in Python, so data without
+    matches is scanned at a few MB/s; deltas are built in background jobs.
+    Returns the size of the delta in bytes.
+    """
+    old_blocks = {}
+    for block_index, block in enumerate(_read_blocks(old_stream, block_size)):
+        if len(block) == block_size:
+            old_blocks.setdefault(zlib.adler32(block), {}).setdefault(
+                _block_digest(block), block_index * block_size)
+
+    # consecutive operations of the same kind are merged before writing
+    pending_copy = None
+    pending_data = bytearray()
+    target_size = 0
+    delta_stream.write(_header_format.pack(DELTA_MAGIC, block_size, 0))
+    delta_size = _header_format.size
+
+    def flush_copy():
+        nonlocal pending_copy, delta_size
+        if pending_copy is not None:
+            delta_stream.write(_copy_format.pack(COPY_OPERATION, *pending_copy))
+            delta_size += _copy_format.size
+            pending_copy = None
+
+    def flush_data():
+        nonlocal delta_size
+        if pending_data:
+            delta_stream.write(_data_format.pack(DATA_OPERATION, len(pending_data)))
+            delta_stream.write(pending_data)
+            delta_size += _data_format.size + len(pending_data)
+            pending_data.clear()
+
+    window = bytearray()
+    position = 0
+    end_of_stream = False
+    # adler32 of window[position:position + block_size], None after a jump
+    checksum = None
+    while True:
+        if not end_of_stream and len(window) - position <= block_size:
+            # drop consumed bytes and refill the window, the rolling
+            # checksum stays valid as it doesn't depend on the position
+            del window[:position]
+            position = 0
+            data = new_stream.read(16 * 1024 * 1024)
+            if data:
+                window += data
+                continue
+            end_of_stream = True
+        if position >= len(window):
+            break
+        if len(window) - position < block_size:
+            # a tail shorter than a block can't match
+            flush_copy()
+            pending_data += window[position:]
+            target_size += len(window) - position
+            position = len(window)
+            continue
+        if checksum is None:
+            checksum = zlib.adler32(window[position:position + block_size])
+        old_offset = None
+        candidates = old_blocks.get(checksum)
+        if candidates is not None:
+            old_offset = candidates.get(_block_digest(window[position:position + block_size]))
+        if old_offset is not None:
+            flush_data()
+            if pending_copy is not None and pending_copy[0] + pending_copy[1] == old_offset:
+                pending_copy = (pending_copy[0], pending_copy[1] + block_size)
+            else:
+                flush_copy()
+                pending_copy = (old_offset, block_size)
+            position += block_size
+            target_size += block_size
+            checksum = None
+            continue
+        flush_copy()
+        # roll one byte at a time until the checksum hits an old block or
+        # the window needs refilling
+        literal_start = position
+        last_position = len(window) - block_size
+        if position == last_position:
+            # the last full block of the image, nothing left to roll in
+            position = len(window)
+        else:
+            low, high = checksum & 0xffff, checksum >> 16
+            while position < last_position:
+                outgoing = window[position]
+                low = (low - outgoing + window[position + block_size]) % 65521
+                high = (high - block_size * outgoing + low - 1) % 65521
+                position += 1
+                if (high << 16 | low) in old_blocks:
+                    break
+            checksum = high << 16 | low
+        pending_data += window[literal_start:position]
+        target_size += position - literal_start
+        if len(pending_data) >= 16 * block_size:
+            flush_data()
+    flush_copy()
+    flush_data()
+    # the target size is only known at the end, patch it into the header
+    delta_stream.seek(0)
+    delta_stream.write(_header_format.pack(DELTA_MAGIC, block_size, target_size))
+    return delta_size
+
+
+def apply_delta(old_stream, delta_stream, new_stream) -> int:
+    """Rebuild the new image from the old one and a delta, return its size."""
+    magic, block_size, target_size = _header_format.unpack(delta_stream.read(_header_format.size))
+    if magic != DELTA_MAGIC:
+        raise ValueError("Not an image delta")
+    written_bytes = 0
+    while True:
+        operation = delta_stream.read(1)
+        if not operation:
+            break
+        if operation[0] == COPY_OPERATION:
+            offset, length = struct.unpack(">QI", delta_stream.read(_copy_format.size - 1))
+            old_stream.seek(offset)
+            while length:
+                data = old_stream.read(min(length, 1024 * 1024))
+                if not data:
+                    raise ValueError("Delta refers past the end of the old image")
+                new_stream.write(data)
+                length -= len(data)
+                written_bytes += len(data)
+        elif operation[0] == DATA_OPERATION:
+            (length,) = struct.unpack(">I", delta_stream.read(_data_format.size - 1))
+            new_stream.write(delta_stream.read(length))
+            written_bytes += length
+        else:
+            raise ValueError(f"Unknown delta operation {operation[0]}")
+    if written_bytes != target_size:
+        raise ValueError("Delta is truncated")
+    return written_bytes
+
+
+def delta_path(delta_directory: str, old_image_id: int, new_image_id: int) -> str:
+    return os.path.join(delta_directory, f"{old_image_id}-{new_image_id}.vdelta")
+
+
+def build_image_delta(old_stream, new_stream, target_path: str) -> bool:
+    """Create the delta file at target_path if it is smaller than the new image.
+
+    Returns whether a delta was written.
+    """
+    os.makedirs(os.path.dirname(target_path) or ".", exist_ok=True)
+    file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(target_path) or ".")
+    try:
+        with os.fdopen(file_descriptor, "w+b") as temp_file:
+            delta_size = create_delta(old_stream, new_stream, temp_file)
+        if delta_size >= new_stream.size:
+            os.unlink(temp_path)
+            return False
+        os.replace(temp_path, target_path)
+        return True
+    except Exception:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+
+def build_delta_from_previous_version(database, new_image, delta_directory: str, chunk_store=None) -> bool:
+    """Precompute the delta from the previous version of an image, if any."""
+    # built right after the new image was added, don't read a lagging replica
+    old_image = database.get_previous_image_version(new_image, replica=False)
+    if old_image is None:
+        return False
+    old_stream = open_image_stream(old_image, database, chunk_store, replica=False)
+    new_stream = open_image_stream(new_image, database, chunk_store, replica=False)
+    try:
+        if old_stream is None or new_stream is None:
+            return False
+        return build_image_delta(
+            old_stream, new_stream, delta_path(delta_directory, old_image.image_id, new_image.image_id))
+    finally:
+        for stream in (old_stream, new_stream):
+            if stream is not None:
+                stream.close()
+
+
+def remove_image_deltas(delta_directory: str, image_id: int):
+    """Remove every cached delta from or to the given image."""
+    if not os.path.isdir(delta_directory):
+        return
+    for file_name in os.listdir(delta_directory):
+        image_ids = file_name.rsplit(".", 1)[0].split("-")
+        if file_name.endswith(".vdelta") and str(image_id) in image_ids:
+            os.unlink(os.path.join(delta_directory, file_name))
@@ -0,0 +1 @@
+from . import encoding
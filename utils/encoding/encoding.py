@@ -0,0 +1,103 @@
+import gzip
+import json
+import os
+import tempfile
+from utils.storage.storage import open_image_stream
+
+try:
+    # optional, pip install zstandard
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# preferred first when a client accepts several with the same quality
+SUPPORTED_ENCODINGS = ["zstd", "gzip"] if zstandard is not None else ["gzip"]
+FILE_EXTENSIONS = {"zstd": "zst", "gzip": "gz"}
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+# variants saving less than this fraction of the image size aren't kept
+MIN_SAVING = 0.1
+_block_size = 1024 * 1024
+
+
+def variant_path(variant_directory: str, image_id: int, encoding: str) -> str:
+    return os.path.join(variant_directory, f"{image_id}.{FILE_EXTENSIONS[encoding]}")
+
+
+def manifest_path(variant_directory: str, image_id: int) -> str:
+    return os.path.join(variant_directory, f"{image_id}.json")
+
+
+def _compress(source_stream, target_stream, encoding: str):
+    if encoding == "zstd":
+        zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1).copy_stream(
+            source_stream, target_stream, size=source_stream.size)
+        return
+    # mtime=0 so that rebuilding a variant gives the same bytes
+    with gzip.GzipFile(fileobj=target_stream, mode="wb", compresslevel=GZIP_LEVEL, mtime=0) as gzip_stream:
+        while True:
+            block = source_stream.read(_block_size)
+            if not block:
+                break
+            gzip_stream.write(block)
+
+
+def build_image_variants(database, image, variant_directory: str, encodings: list[str], chunk_store=None) -> dict:
+    """Write the compressed variants of an image and their manifest.
+
+    Variants that don't save at least MIN_SAVING of the image size are
+    dropped. The manifest records the image hash the variants were built
+    from, so variants of a changed image are ignored. Returns the sizes of
+    the kept variants by encoding.
+    """
+    os.makedirs(variant_directory, exist_ok=True)
+    variant_sizes = {}
+    for encoding in encodings:
+        # built right after the image was added, don't read a lagging replica
+        source_stream = open_image_stream(image, database, chunk_store, replica=False)
+        if source_stream is None:
+            return {}
+        target_path = variant_path(variant_directory, image.image_id, encoding)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=variant_directory)
+        try:
+            with os.fdopen(file_descriptor, "w+b") as temp_file:
+                _compress(source_stream, temp_file, encoding)
+                variant_size = temp_file.tell()
+            if variant_size > source_stream.size * (1 - MIN_SAVING):
+                os.unlink(temp_path)
+                continue
+            os.replace(temp_path, target_path)
+            variant_sizes[encoding] = variant_size
+        except Exception:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        finally:
+            source_stream.close()
+    file_descriptor, temp_path = tempfile.mkstemp(dir=variant_directory)
+    with os.fdopen(file_descriptor, "w") as temp_file:
+        json.dump({"image_hash": image.image_hash, "variants": variant_sizes}, temp_file)
+    os.replace(temp_path, manifest_path(variant_directory, image.image_id))
+    return variant_sizes
+
+
+def load_image_variants(variant_directory: str, image) -> dict:
+    """Sizes of the variants built for the current version of an image, by
+    encoding, or None if they weren't built yet."""
+    try:
+        with open(manifest_path(variant_directory, image.image_id), "r") as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get("image_hash") != image.image_hash:
+        return None
+    return manifest["variants"]
+
+
+def remove_image_variants(variant_directory: str, image_id: int):
+    """Remove the compressed variants and the manifest of an image."""
+    for path in [manifest_path(variant_directory, image_id)] + [
+            variant_path(variant_directory, image_id, encoding) for encoding in FILE_EXTENSIONS]:
+        if os.path.exists(path):
+            os.unlink(path)
@@ -0,0 +1,484 @@
+from array import array
+import datetime
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from utils.models.models import VMImage
+
+IMAGE_FIELDS = [column.name for column in VMImage.__table__.columns]
+_no_images = ()
+
+
+class ImageRecord:
+    """An image row, without the per instance dict of an ORM object."""
+    __slots__ = IMAGE_FIELDS
+
+    def __init__(self, row: tuple):
+        for field, value in zip(IMAGE_FIELDS, row):
+            setattr(self, field, value)
+
+    def as_dict(self) -> dict:
+        # the same strings as VMImage.as_dict
+        return {field: str(getattr(self, field)) for field in IMAGE_FIELDS}
+
+
+def _slots(bitmap: int):
+    """Positions of the bits set in a bitmap, in ascending order."""
+    bits = bin(bitmap)[:1:-1]
+    slot = bits.find("1")
+    while slot != -1:
+        yield slot
+        slot = bits.find("1", slot + 1)
+
+
+def _bitmap(slots) -> int:
+    bitmap = bytearray()
+    for slot in slots:
+        if slot >> 3 >= len(bitmap):
+            bitmap.extend(bytes((slot >> 3) - len(bitmap) + 1))
+        bitmap[slot >> 3] |= 1 << (slot & 7)
+    return int.from_bytes(bitmap, "little")
+
+
+def _hostname_regex(hostname_pattern: str):
+    # the same shell style pattern create_rollout turns into a LIKE, which
+    # SQLite compares case-insensitively for ASCII letters
+    return re.compile(
+        "".join(".*" if char == "*" else "." if char == "?" else re.escape(char) for char in hostname_pattern),
+        re.IGNORECASE | re.ASCII | re.DOTALL,
+    )
+
+
+class _FleetState:
+    """Clients stored column-wise, one slot per client.
+
+    Deleted clients leave their slot empty for the next new client. The
+    clients of an image or client version are bitmaps over the slots.
+    """
+    __slots__ = ("slot_by_mac", "mac_addresses", "ip_addresses", "hostnames", "version_ids", "image_ids",
+                 "free_slots", "versions", "version_id_by_name", "version_bitmaps", "image_bitmaps", "images")
+
+    def __init__(self):
+        self.slot_by_mac = {}
+        self.mac_addresses = []
+        self.ip_addresses = []
+        self.hostnames = []
+        # index into versions, so every version string is stored once
+        self.version_ids = array("I")
+        # sorted tuple of the image ids assigned to the client
+        self.image_ids = []
+        self.free_slots = []
+        self.versions = []
+        self.version_id_by_name = {}
+        self.version_bitmaps = {}
+        self.image_bitmaps = {}
+        self.images = {}
+
+    def load(self, client_rows, assignment_rows):
+        """Fill an empty state, building every bitmap once instead of bit by bit."""
+        slots_by_version = {}
+        for slot, (mac_address, ip_address, hostname, client_version) in enumerate(client_rows):
+            version_id = self._version_id(client_version)
+            self.slot_by_mac[mac_address] = slot
+            self.mac_addresses.append(mac_address)
+            self.ip_addresses.append(ip_address)
+            self.hostnames.append(hostname)
+            self.version_ids.append(version_id)
+            slots_by_version.setdefault(version_id, []).append(slot)
+        self.image_ids = [[] for _ in self.mac_addresses]
+        slots_by_image = {}
+        for mac_address, image_id in assignment_rows:
+            slot = self.slot_by_mac.get(mac_address)
+            if slot is not None:
+                self.image_ids[slot].append(image_id)
+                slots_by_image.setdefault(image_id, []).append(slot)
+        self.image_ids = [tuple(sorted(image_ids)) or _no_images for image_ids in self.image_ids]
+        self.version_bitmaps = {version_id: _bitmap(slots) for version_id, slots in slots_by_version.items()}
+        self.image_bitmaps = {image_id: _bitmap(slots) for image_id, slots in slots_by_image.items()}
+
+    def plan_clients(self, mac_addresses, client_rows, image_ids_by_mac: dict = None) -> "_ClientChanges":
+        """Work out how to bring the given clients in line with their rows.
+
+        Mac addresses without a row are removed. Assignments only change if
+        image_ids_by_mac is given. Clients already holding the values of
+        their row are skipped, so repeated heartbeats cost no bitmap work.
+        Only reads the state; the index lets one writer at a time plan and
+        apply, so the plan still holds when it is applied.
+        """
+        changes = _ClientChanges()
+        rows_by_mac = {client_row[0]: client_row for client_row in client_rows}
+        free_slots = len(self.free_slots)
+        next_slot = len(self.mac_addresses)
+        set_versions, clear_versions, set_images, clear_images = {}, {}, {}, {}
+        for mac_address in set(mac_addresses) - rows_by_mac.keys():
+            slot = self.slot_by_mac.get(mac_address)
+            if slot is None:
+                continue
+            changes.removed_slots[mac_address] = slot
+            clear_versions.setdefault(self.versions[self.version_ids[slot]], []).append(slot)
+            for image_id in self.image_ids[slot]:
+                clear_images.setdefault(image_id, []).append(slot)
+        for mac_address, client_row in rows_by_mac.items():
+            image_ids = None
+            if image_ids_by_mac is not None:
+                image_ids = tuple(sorted(image_ids_by_mac.get(mac_address, ()))) or _no_images
+            slot = self.slot_by_mac.get(mac_address)
+            if slot is None:
+                if free_slots:
+                    free_slots -= 1
+                    slot = self.free_slots[free_slots]
+                    changes.reused_slots += 1
+                else:
+                    slot = next_slot
+                    next_slot += 1
+                set_versions.setdefault(client_row[3], []).append(slot)
+                old_image_ids = _no_images
+            else:
+                old_version = self.versions[self.version_ids[slot]]
+                old_image_ids = self.image_ids[slot]
+                if (self.ip_addresses[slot], self.hostnames[slot], old_version) == tuple(client_row[1:]) and (
+                        image_ids is None or image_ids == old_image_ids):
+                    continue
+                if client_row[3] != old_version:
+                    clear_versions.setdefault(old_version, []).append(slot)
+                    set_versions.setdefault(client_row[3], []).append(slot)
+            if image_ids is None:
+                image_ids = old_image_ids
+            changes.rows_by_slot[slot] = tuple(client_row), image_ids
+            for image_id in set(old_image_ids) - set(image_ids):
+                clear_images.setdefault(image_id, []).append(slot)
+            for image_id in set(image_ids) - set(old_image_ids):
+                set_images.setdefault(image_id, []).append(slot)
+        changes.new_slots = next_slot - len(self.mac_addresses)
+        changes.set_version_masks = {version: _bitmap(slots) for version, slots in set_versions.items()}
+        changes.clear_version_masks = {version: _bitmap(slots) for version, slots in clear_versions.items()}
+        changes.set_image_masks = {image_id: _bitmap(slots) for image_id, slots in set_images.items()}
+        changes.clear_image_masks = {image_id: _bitmap(slots) for image_id, slots in clear_images.items()}
+        return changes
+
+    def apply_clients(self, changes: "_ClientChanges"):
+        """Write planned changes, one AND or OR per touched bitmap."""
+        for mac_address, slot in changes.removed_slots.items():
+            del self.slot_by_mac[mac_address]
+            self.mac_addresses[slot] = None
+            self.ip_addresses[slot] = None
+            self.hostnames[slot] = None
+            self.image_ids[slot] = _no_images
+        if changes.reused_slots:
+            del self.free_slots[-changes.reused_slots:]
+        self.free_slots.extend(changes.removed_slots.values())
+        for _ in range(changes.new_slots):
+            self.mac_addresses.append(None)
+            self.ip_addresses.append(None)
+            self.hostnames.append(None)
+            self.version_ids.append(0)
+            self.image_ids.append(_no_images)
+        for slot, ((mac_address, ip_address, hostname, client_version), image_ids) in changes.rows_by_slot.items():
+            self.slot_by_mac[mac_address] = slot
+            self.mac_addresses[slot] = mac_address
+            self.ip_addresses[slot] = ip_address
+            self.hostnames[slot] = hostname
+            self.version_ids[slot] = self._version_id(client_version)
+            self.image_ids[slot] = image_ids
+        for client_version, mask in changes.clear_version_masks.items():
+            self._clear_bits(self.version_bitmaps, self.version_id_by_name[client_version], mask)
+        for client_version, mask in changes.set_version_masks.items():
+            version_id = self.version_id_by_name[client_version]
+            self.version_bitmaps[version_id] = self.version_bitmaps.get(version_id, 0) | mask
+        for image_id, mask in changes.clear_image_masks.items():
+            self._clear_bits(self.image_bitmaps, image_id, mask)
+        for image_id, mask in changes.set_image_masks.items():
+            self.image_bitmaps[image_id] = self.image_bitmaps.get(image_id, 0) | mask
+
+    def _version_id(self, client_version: str) -> int:
+        version_id = self.version_id_by_name.get(client_version)
+        if version_id is None:
+            version_id = len(self.versions)
+            self.versions.append(client_version)
+            self.version_id_by_name[client_version] = version_id
+        return version_id
+
+    def remove_image(self, image_id: int):
+        self.images.pop(image_id, None)
+        for slot in _slots(self.image_bitmaps.pop(image_id, 0)):
+            self.image_ids[slot] = tuple(
+                assigned_image_id for assigned_image_id in self.image_ids[slot]
+                if assigned_image_id != image_id) or _no_images
+
+    def client_dict(self, slot: int) -> dict:
+        # the same strings as Client.as_dict
+        return {
+            "mac_address": str(self.mac_addresses[slot]),
+            "ip_address": str(self.ip_addresses[slot]),
+            "hostname": str(self.hostnames[slot]),
+            "client_version": str(self.versions[self.version_ids[slot]]),
+        }
+
+    @staticmethod
+    def _clear_bits(bitmaps: dict, key, mask: int):
+        bitmap = bitmaps.get(key, 0) & ~mask
+        if bitmap:
+            bitmaps[key] = bitmap
+        else:
+            bitmaps.pop(key, None)
+
+
+class _ClientChanges:
+    """Client changes planned against a _FleetState, bitmap masks included."""
+    __slots__ = ("removed_slots", "rows_by_slot", "reused_slots", "new_slots", "set_version_masks",
+                 "clear_version_masks", "set_image_masks", "clear_image_masks")
+
+    def __init__(self):
+        self.removed_slots = {}
+        # slot -> (client row, image ids)
+        self.rows_by_slot = {}
+        # taken from the end of the free slots
+        self.reused_slots = 0
+        # appended to the columns
+        self.new_slots = 0
+        self.set_version_masks = {}
+        self.clear_version_masks = {}
+        self.set_image_masks = {}
+        self.clear_image_masks = {}
+
+
+class FleetIndex:
+    """In-memory copy of clients, images and assignments, so that hot
+    lookups don't build ORM objects or touch SQLite.
+
+    Writes of this process are applied right after they are committed,
+    through database events. Of writes of other processes (other gunicorn
+    workers, fleetcontrol), image assignments are applied when the change
+    feed picks them up, and clients and images the index doesn't know are
+    looked up in the database when asked for. Everything else, e.g. a
+    changed hostname or clients a rollout selector matches, shows up with
+    the next full reload, every refresh_interval seconds. Every server
+    process holds its own copy.
+    """
+
+    def __init__(self, database, refresh_interval: float = 60, change_feed=None):
+        self.database = database
+        self.refresh_interval = refresh_interval
+        self.change_feed = change_feed
+        if change_feed is not None:
+            change_feed.add_listener(self.handle_client_changes)
+        self.logger = logging.getLogger(__name__)
+        self.loaded_at = None
+        self._state = _FleetState()
+        self._lock = threading.RLock()
+        # held by whoever changes the state, for all of planning and applying
+        self._update_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        # the process the index was loaded in, and the one loading it; events
+        # are applied from the start of the load on
+        self._pid = None
+        self._loading_pid = None
+        # clients and images changed while a full reload runs, applied to
+        # the reloaded state again in case the reload read them before
+        self._pending_mac_addresses = None
+        self._pending_image_ids = None
+
+    def start(self):
+        """Load the index and keep reloading it, once per process."""
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            self._loading_pid = pid
+            if self.change_feed is not None:
+                self.change_feed.start()
+            self.reload()
+            self._pid = pid
+        threading.Thread(target=self._refresh, name="fleet-index", daemon=True).start()
+
+    def _refresh(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.reload()
+            except Exception as ex:
+                self.logger.error(f"Error reloading the fleet index: {ex}")
+
+    def reload(self):
+        with self._lock:
+            self._pending_mac_addresses = set()
+            self._pending_image_ids = set()
+        try:
+            state = _FleetState()
+            for row in self.database.get_image_rows():
+                image = ImageRecord(row)
+                state.images[image.image_id] = image
+            state.load(*self.database.get_fleet_rows())
+        finally:
+            with self._lock:
+                pending_mac_addresses = self._pending_mac_addresses
+                pending_image_ids = self._pending_image_ids
+                self._pending_mac_addresses = None
+                self._pending_image_ids = None
+        with self._update_lock, self._lock:
+            self._state = state
+            self.loaded_at = datetime.datetime.utcnow()
+        for image_id in pending_image_ids:
+            self._reload_image(image_id)
+        if pending_mac_addresses:
+            self._reload_clients(list(pending_mac_addresses))
+
+    def handle_database_event(self, event: str, payload: dict):
+        if self._loading_pid != os.getpid():
+            return
+        if event == "client_changed" and "clients" in payload:
+            self._put_clients(payload["mac_addresses"], payload["clients"])
+        elif event in ["client_changed", "assignment_changed"]:
+            self._reload_clients(payload["mac_addresses"])
+        elif event == "image_changed":
+            self._reload_image(payload["image_id"])
+
+    def handle_client_changes(self, mac_addresses: list[str]):
+        if self._loading_pid != os.getpid():
+            return
+        self._reload_clients(mac_addresses)
+
+    def _reload_clients(self, mac_addresses: list[str]):
+        if not mac_addresses:
+            return
+        client_rows, assignment_rows = self.database.get_fleet_rows(mac_addresses)
+        image_ids_by_mac = {}
+        for mac_address, image_id in assignment_rows:
+            image_ids_by_mac.setdefault(mac_address, []).append(image_id)
+        self._apply_clients(mac_addresses, client_rows, image_ids_by_mac)
+
+    def _put_clients(self, mac_addresses: list[str], client_rows: list[tuple]):
+        """Apply the client rows of a client_changed event without asking
+        the database. Changing a client doesn't change its assignments,
+        except that a client the index doesn't know yet may have been
+        assigned images by another process, so those are read instead."""
+        slot_by_mac = self._state.slot_by_mac
+        unknown_mac_addresses = {client_row[0] for client_row in client_rows if client_row[0] not in slot_by_mac}
+        self._apply_clients(
+            [mac_address for mac_address in mac_addresses if mac_address not in unknown_mac_addresses],
+            [client_row for client_row in client_rows if client_row[0] not in unknown_mac_addresses],
+        )
+        self._reload_clients(list(unknown_mac_addresses))
+
+    def _apply_clients(self, mac_addresses: list[str], client_rows: list[tuple], image_ids_by_mac: dict = None):
+        if not mac_addresses:
+            return
+        # readers only wait for the column writes and one AND or OR per
+        # touched bitmap; the masks are built before taking their lock
+        with self._update_lock:
+            state = self._state
+            changes = state.plan_clients(mac_addresses, client_rows, image_ids_by_mac)
+            with self._lock:
+                state.apply_clients(changes)
+                if self._pending_mac_addresses is not None:
+                    self._pending_mac_addresses.update(mac_addresses)
+
+    def _reload_image(self, image_id: int):
+        image_rows = self.database.get_image_rows([image_id])
+        with self._update_lock, self._lock:
+            if image_rows:
+                self._state.images[image_id] = ImageRecord(image_rows[0])
+            else:
+                self._state.remove_image(image_id)
+            if self._pending_image_ids is not None:
+                self._pending_image_ids.add(image_id)
+
+    def _load_missing_client(self, mac_address: str):
+        # the client may have just been added by another process
+        self.start()
+        if mac_address not in self._state.slot_by_mac:
+            self._reload_clients([mac_address])
+
+    def has_client(self, mac_address: str) -> bool:
+        self._load_missing_client(mac_address)
+        return mac_address in self._state.slot_by_mac
+
+    def get_client(self, mac_address: str) -> dict:
+        self._load_missing_client(mac_address)
+        with self._lock:
+            slot = self._state.slot_by_mac.get(mac_address)
+            return self._state.client_dict(slot) if slot is not None else None
+
+    def get_client_image_ids(self, mac_address: str) -> list[int]:
+        """Ids of the images assigned to a client, empty for unknown clients."""
+        self._load_missing_client(mac_address)
+        with self._lock:
+            slot = self._state.slot_by_mac.get(mac_address)
+            return list(self._state.image_ids[slot]) if slot is not None else []
+
+    def get_image(self, image_id: int) -> dict:
+        self.start()
+        image = self._state.images.get(image_id)
+        if image is None:
+            self._reload_image(image_id)
+            image = self._state.images.get(image_id)
+        return image.as_dict() if image is not None else None
+
+    def get_image_clients(self, image_id: int) -> list[dict]:
+        self.start()
+        with self._lock:
+            state = self._state
+            return [state.client_dict(slot) for slot in _slots(state.image_bitmaps.get(image_id, 0))]
+
+    def select_clients(self, client_version: str = None, hostname_pattern: str = None,
+                       mac_addresses: list[str] = None) -> list[str]:
+        """Sorted mac addresses of the clients matching a rollout selector."""
+        self.start()
+        with self._lock:
+            state = self._state
+            version_id = state.version_id_by_name.get(client_version) if client_version is not None else None
+            if client_version is not None and version_id is None:
+                return []
+            if mac_addresses is not None:
+                slots = [state.slot_by_mac[mac_address] for mac_address in set(mac_addresses)
+                         if mac_address in state.slot_by_mac]
+                if version_id is not None:
+                    slots = [slot for slot in slots if state.version_ids[slot] == version_id]
+            elif version_id is not None:
+                slots = _slots(state.version_bitmaps.get(version_id, 0))
+            else:
+                slots = state.slot_by_mac.values()
+            if hostname_pattern is not None:
+                hostname_regex = _hostname_regex(hostname_pattern)
+                slots = [slot for slot in slots if hostname_regex.fullmatch(state.hostnames[slot])]
+            return sorted(state.mac_addresses[slot] for slot in slots)
+
+    def memory_usage(self) -> dict:
+        """Approximate bytes held by the index, per structure."""
+        with self._lock:
+            state = self._state
+            client_strings = [
+                value for column in (state.mac_addresses, state.ip_addresses, state.hostnames)
+                for value in column if value is not None
+            ]
+            usage = {
+                "client_columns": sum(sys.getsizeof(column) for column in (
+                    state.mac_addresses, state.ip_addresses, state.hostnames, state.version_ids, state.image_ids)),
+                "client_strings": sum(sys.getsizeof(value) for value in client_strings),
+                "client_image_ids": sum(
+                    sys.getsizeof(image_ids) for image_ids in state.image_ids if image_ids is not _no_images),
+                "mac_lookup": sys.getsizeof(state.slot_by_mac) + sum(
+                    sys.getsizeof(slot) for slot in state.slot_by_mac.values()),
+                "bitmaps": sum(sys.getsizeof(bitmap) for bitmaps in (state.version_bitmaps, state.image_bitmaps)
+                               for bitmap in bitmaps.values()),
+                "images": sys.getsizeof(state.images) + sum(
+                    sys.getsizeof(image) + sum(sys.getsizeof(getattr(image, field)) for field in IMAGE_FIELDS)
+                    for image in state.images.values()),
+            }
+        usage["total"] = sum(usage.values())
+        return usage
+
+    def stats(self) -> dict:
+        state = self._state
+        return {
+            "clients": len(state.slot_by_mac),
+            "images": len(state.images),
+            "client_versions": len(state.version_bitmaps),
+            "loaded_at": self.loaded_at.isoformat() if self.loaded_at else None,
+            "memory_bytes": self.memory_usage(),
+        }
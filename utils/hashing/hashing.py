@@ -0,0 +1,170 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import re
+import threading
+
+
+SUPPORTED_ALGORITHMS = ["md5", "sha256", "blake2b"]
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def format_tree_hash(algorithm: str, root_digest: str) -> str:
+    return f"{algorithm}-tree:{root_digest}"
+
+
+def tree_root(algorithm: str, block_digests: list[str]) -> str:
+    """Root of a one level hash tree: the hash of all block digests."""
+    root = hashlib.new(algorithm)
+    for block_digest in block_digests:
+        root.update(bytes.fromhex(block_digest))
+    return root.hexdigest()
+
+
+class TreeHasher:
+    """Incremental tree hash, fed with consecutive pieces of a file.
+
+    The file is split into `block_size` blocks which are hashed on their own;
+    the result is the hash of the concatenated block digests. Completed block
+    digests can be saved and passed back in to resume hashing later.
+    """
+
+    def __init__(self, algorithm: str = "sha256", block_size: int = DEFAULT_BLOCK_SIZE, block_digests: list[str] = None):
+        if algorithm not in SUPPORTED_ALGORITHMS:
+            raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self.block_digests = list(block_digests or [])
+        self.current_block = hashlib.new(algorithm)
+        self.current_block_size = 0
+
+    def update(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            take = min(self.block_size - self.current_block_size, len(view))
+            self.current_block.update(view[:take])
+            self.current_block_size += take
+            view = view[take:]
+            if self.current_block_size == self.block_size:
+                self.block_digests.append(self.current_block.hexdigest())
+                self.current_block = hashlib.new(self.algorithm)
+                self.current_block_size = 0
+
+    def hexdigest(self) -> str:
+        block_digests = list(self.block_digests)
+        if self.current_block_size or not block_digests:
+            block_digests.append(self.current_block.hexdigest())
+        return format_tree_hash(self.algorithm, tree_root(self.algorithm, block_digests))
+
+
+class BlockHashCache:
+    """Block digests of hashed files, kept in a JSON file between runs."""
+
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file, "r") as stream:
+                    self._entries = json.load(stream)
+            except ValueError:
+                # a corrupted cache only costs a rehash
+                self._entries = {}
+
+    def _key(self, path: str, algorithm: str, block_size: int) -> str:
+        return f"{os.path.abspath(path)}|{algorithm}|{block_size}"
+
+    def get(self, path: str, algorithm: str, block_size: int):
+        with self._lock:
+            return self._entries.get(self._key(path, algorithm, block_size))
+
+    def set(self, path: str, algorithm: str, block_size: int, entry: dict):
+        with self._lock:
+            self._entries[self._key(path, algorithm, block_size)] = entry
+            temp_file = f"{self.cache_file}.tmp"
+            with open(temp_file, "w") as stream:
+                json.dump(self._entries, stream)
+            os.replace(temp_file, self.cache_file)
+
+
+def _hash_block(file_descriptor: int, algorithm: str, offset: int, length: int) -> str:
+    # os.pread and hashlib both release the GIL, so blocks hash in parallel
+    data = os.pread(file_descriptor, length, offset)
+    return hashlib.new(algorithm, data).hexdigest()
+
+
+def hash_file(
+    path: str,
+    algorithm: str = "sha256",
+    block_size: int = DEFAULT_BLOCK_SIZE,
+    workers: int = None,
+    cache: BlockHashCache = None,
+    append_only: bool = False,
+    progress=None,
+) -> str:
+    """Tree hash of a file, with blocks hashed on a thread pool.
+
+    With a cache, an unchanged file (same size and mtime) is not read at
+    all. If the caller knows the file only ever grows at the end
+    (`append_only`), blocks cached for the old size are reused and only the
+    new blocks are hashed. That is not the default because formats like
+    qcow2 also rewrite their metadata at the start of the file when they grow.
+    `progress` is called with the fraction of blocks hashed so far.
+    """
+    if algorithm not in SUPPORTED_ALGORITHMS:
+        raise ValueError(f"Unsupported hash algorithm: {algorithm}")
+    file_stat = os.stat(path)
+    file_size = file_stat.st_size
+    file_descriptor = os.open(path, os.O_RDONLY)
+    try:
+        block_digests = []
+        cached_entry = cache.get(path, algorithm, block_size) if cache is not None else None
+        if cached_entry is not None:
+            if cached_entry["size"] == file_size and cached_entry["mtime_ns"] == file_stat.st_mtime_ns:
+                return format_tree_hash(algorithm, tree_root(algorithm, cached_entry["blocks"]))
+            if append_only and cached_entry["size"] < file_size:
+                # only full blocks can be reused; the first and last of them
+                # are hashed again as a sanity check
+                reusable_blocks = cached_entry["blocks"][:cached_entry["size"] // block_size]
+                if reusable_blocks and all(
+                    _hash_block(file_descriptor, algorithm, block * block_size, block_size) == reusable_blocks[block]
+                    for block in {0, len(reusable_blocks) - 1}
+                ):
+                    block_digests = reusable_blocks
+        first_block = len(block_digests)
+        block_count = max(1, -(-file_size // block_size))
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            for block_digest in executor.map(
+                lambda block: _hash_block(file_descriptor, algorithm, block * block_size, block_size),
+                range(first_block, block_count),
+            ):
+                block_digests.append(block_digest)
+                if progress is not None:
+                    progress(len(block_digests) / block_count)
+    finally:
+        os.close(file_descriptor)
+    if cache is not None:
+        cache.set(path, algorithm, block_size, {
+            "size": file_size,
+            "mtime_ns": file_stat.st_mtime_ns,
+            "blocks": block_digests,
+        })
+    return format_tree_hash(algorithm, tree_root(algorithm, block_digests))
+
+
+def rehash_file(path: str, image_hash: str, workers: int = None, progress=None) -> str:
+    """Hash a file the same way `image_hash` was computed, to check whether
+    it still matches. Returns None for hashes of an unknown format."""
+    tree_hash_match = re.fullmatch(r"([a-z0-9]+)-tree:[0-9a-f]+", image_hash)
+    if tree_hash_match and tree_hash_match.group(1) in SUPPORTED_ALGORITHMS:
+        return hash_file(path, algorithm=tree_hash_match.group(1), workers=workers, progress=progress)
+    if re.fullmatch(r"[0-9a-f]{32}", image_hash):
+        # plain md5 of images added by older versions
+        file_hash = hashlib.md5()
+        with open(path, "rb") as image_file:
+            for block in iter(lambda: image_file.read(DEFAULT_BLOCK_SIZE), b""):
+                file_hash.update(block)
+        return file_hash.hexdigest()
+    return None
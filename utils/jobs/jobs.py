@@ -0,0 +1,168 @@
+import datetime
+import logging
+import os
+import threading
+import time
+
+
+class JobQueue:
+    """Runs queued jobs of the jobs table on a pool of worker threads.
+
+    Handlers are registered per job kind, together with the payload fields
+    they take, and called with the job payload and a progress callback
+    taking a fraction between 0 and 1; what they return is stored as the
+    job result. A handler that raises is retried up to the
+    job's max_attempts, waiting retry_delay seconds longer every time.
+
+    Every server process runs its own workers, under gunicorn they are
+    started in each worker after the fork. Jobs are claimed in a write
+    transaction, so a job only ever runs in one of them; while it runs, its
+    lease is extended every lease / 3 seconds. Jobs queued by this
+    process wake a worker right away, jobs queued elsewhere (fleetcontrol)
+    are picked up within poll_interval seconds. Periodic jobs are queued
+    with a job key, so several processes don't queue them twice.
+    """
+
+    def __init__(self, database, workers: int = 2, poll_interval: float = 1.0, lease: int = 300,
+                 retry_delay: int = 60, retention: int = 604800):
+        self.database = database
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.retry_delay = retry_delay
+        self.retention = retention
+        self.logger = logging.getLogger(__name__)
+        self.handlers = {}
+        # kind -> ({required field: type}, {optional field: type})
+        self.payload_fields = {}
+        # kind -> (interval in seconds, payload, priority)
+        self.periodic_jobs = {}
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._wakeup = None
+
+    def register(self, kind: str, handler, required_fields: dict = None, optional_fields: dict = None):
+        self.handlers[kind] = handler
+        self.payload_fields[kind] = (required_fields or {}, optional_fields or {})
+
+    def check_payload(self, kind: str, payload):
+        """Raise ValueError unless the payload has the fields the kind was
+        registered with, of their types, and no others."""
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        if not isinstance(payload, dict):
+            raise ValueError("payload has to be an object")
+        required_fields, optional_fields = self.payload_fields[kind]
+        for field in required_fields:
+            if field not in payload:
+                raise ValueError(f"payload of {kind} jobs needs {field}")
+        for field, value in payload.items():
+            field_type = required_fields.get(field, optional_fields.get(field))
+            if field_type is None:
+                raise ValueError(f"payload of {kind} jobs can't have {field}")
+            # bool is an int, but not a valid one
+            if not isinstance(value, field_type) or (isinstance(value, bool) and field_type is not bool):
+                raise ValueError(f"{field} of {kind} jobs has to be a {field_type.__name__}")
+
+    def schedule(self, kind: str, interval: int, payload: dict = None, priority: int = -10):
+        """Queue a job of this kind every `interval` seconds."""
+        self.periodic_jobs[kind] = (interval, payload or {}, priority)
+
+    def submit(self, kind: str, payload: dict, priority: int = 0, max_attempts: int = 3, job_key: str = None):
+        self.check_payload(kind, payload)
+        return self.database.add_job(kind, payload, priority=priority, max_attempts=max_attempts, job_key=job_key)
+
+    def handle_database_event(self, event: str, payload: dict):
+        if event == "job_added" and self._pid == os.getpid():
+            self._wakeup.set()
+
+    def start(self):
+        pid = os.getpid()
+        if self.workers <= 0 or self._pid == pid:
+            return
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            self._wakeup = threading.Event()
+            self._pid = pid
+        for worker in range(self.workers):
+            threading.Thread(target=self._work, name=f"job-worker-{worker}", daemon=True).start()
+        threading.Thread(target=self._schedule_periodic_jobs, name="job-scheduler", daemon=True).start()
+
+    def _work(self):
+        while True:
+            try:
+                job = self.database.claim_job(list(self.handlers), self.lease)
+            except Exception as ex:
+                self.logger.error(f"Error claiming job: {ex}")
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._run(job)
+
+    def _run(self, job):
+        last_report = 0
+        finished = threading.Event()
+
+        def report_progress(progress: float):
+            # at most one write per second, each one also extends the lease
+            nonlocal last_report
+            if time.monotonic() - last_report >= 1:
+                last_report = time.monotonic()
+                try:
+                    self.database.update_job_progress(
+                        job.job_id, job.attempts, min(max(progress, 0.0), 1.0), self.lease)
+                except Exception as ex:
+                    self.logger.error(f"Error updating progress of job {job.job_id}: {ex}")
+
+        def extend_lease():
+            # handlers don't have to report progress for their job to stay claimed
+            while not finished.wait(self.lease / 3):
+                try:
+                    if not self.database.extend_job_lease(job.job_id, job.attempts, self.lease):
+                        self.logger.warning(f"Job {job.job_id} ({job.kind}) was claimed by another worker")
+                        return
+                except Exception as ex:
+                    self.logger.error(f"Error extending lease of job {job.job_id}: {ex}")
+
+        threading.Thread(target=extend_lease, name=f"job-lease-{job.job_id}", daemon=True).start()
+        try:
+            result = self.handlers[job.kind](job.as_dict()["payload"], report_progress)
+        except Exception as ex:
+            self.logger.error(f"Job {job.job_id} ({job.kind}) failed: {ex}")
+            try:
+                self.database.fail_job(job.job_id, job.attempts, str(ex), self.retry_delay)
+            except Exception as fail_ex:
+                self.logger.error(f"Error updating failed job {job.job_id}: {fail_ex}")
+            return
+        finally:
+            finished.set()
+        try:
+            if not self.database.finish_job(job.job_id, job.attempts, result if result is not None else {}):
+                self.logger.warning(f"Result of job {job.job_id} ({job.kind}) dropped, it was claimed by another worker")
+        except Exception as ex:
+            self.logger.error(f"Error finishing job {job.job_id}: {ex}")
+
+    def _schedule_periodic_jobs(self):
+        last_cleanup = 0
+        while True:
+            for kind, (interval, payload, priority) in self.periodic_jobs.items():
+                try:
+                    # the jobs table remembers when it last ran, across
+                    # restarts and worker processes
+                    latest_job = self.database.get_latest_job(kind)
+                    if latest_job is None or latest_job.created_at < \
+                            datetime.datetime.utcnow() - datetime.timedelta(seconds=interval):
+                        self.database.add_job(kind, payload, priority=priority, max_attempts=1, job_key=kind)
+                except Exception as ex:
+                    self.logger.error(f"Error queueing periodic job {kind}: {ex}")
+            if time.monotonic() - last_cleanup > 3600:
+                last_cleanup = time.monotonic()
+                try:
+                    self.database.delete_jobs(
+                        datetime.datetime.utcnow() - datetime.timedelta(seconds=self.retention))
+                except Exception as ex:
+                    self.logger.error(f"Error deleting old jobs: {ex}")
+            time.sleep(min([60] + [interval for interval, _, _ in self.periodic_jobs.values()]))
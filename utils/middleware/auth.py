@@ -1,47 +1,194 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from functools import wraps
+import bcrypt
+import hashlib
 import jwt
+import os
+import threading
+import time
+import uuid
 from flask import request, abort
 from flask import current_app
+from utils.cache.cache import LRUCache
 from utils.models.models import User
-from utils.database.database import Database
-from utils.config.config import ServerConfig
 
 # Inspired by: https://blog.loginradius.com/engineering/guest-post/securing-flask-api-with-jwt/ [access: 16.11.2022, 18:33 CET]
 
 
-def require_auth(f):
-    @wraps(f)
-    def decorated(*args, **kwargs):
-        token = None
-        if "Authorization" in request.headers:
-            token = request.headers["Authorization"].split(" ")[1]
-        if not token:
-            return {
-                "message": "Missing auth token",
-                "data": None,
-                "error": "Unauthorized"
-            }, 401
+class AuthCache(LRUCache):
+    """Verified JWT -> User cache shared by all requests of a server process."""
+
+    def invalidate_user(self, username: str):
+        self.invalidate_where(lambda token, user: user.username == username)
+
+    def handle_database_event(self, event: str, payload: dict):
+        if event == "user_changed":
+            self.invalidate_user(payload["username"])
+
+
+class PasswordVerifierBusy(Exception):
+    pass
+
+
+class PasswordVerifier:
+    """Runs bcrypt on a small per-process thread pool.
+
+    bcrypt is deliberately slow, so at most max_workers checks run at once
+    and at most max_pending wait for a slot. Logins past that, and logins
+    whose check doesn't finish within timeout seconds, are turned away
+    with PasswordVerifierBusy instead of tying up request threads.
+    """
+
+    def __init__(self, rounds: int = 12, max_workers: int = 2, max_pending: int = 16, timeout: float = 10):
+        self.rounds = rounds
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_workers + max_pending)
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # pool threads don't survive a fork, every gunicorn worker gets its own
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="bcrypt")
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(blocking=False):
+            raise PasswordVerifierBusy("Too many logins in progress")
+        try:
+            future = self._get_executor().submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # a check that timed out still holds its slot until it has run
+        future.add_done_callback(lambda future: self._slots.release())
         try:
-            config = ServerConfig()
-            database = Database(
-                database_file=config.database_file, logging_level=config.server_loglevel)
-            user_data_from_request = jwt.decode(
-                token, config.jwt_secret, algorithms=["HS256"])
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            raise PasswordVerifierBusy("Login check timed out")
+
+    def hash(self, password: str) -> bytes:
+        return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds=self.rounds))
+
+    def verify(self, password: str, password_hash: bytes) -> bool:
+        return self._run(bcrypt.checkpw, password.encode("utf-8"), password_hash)
+
+    def needs_rehash(self, password_hash: bytes) -> bool:
+        """Whether a hash was made with a different work factor than the
+        configured one, e.g. after bcrypt_rounds was changed."""
+        # bcrypt hashes look like $2b$12$<salt and digest>
+        try:
+            return int(password_hash.split(b"$")[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
+
+    def rehash(self, password: str) -> bytes:
+        return self._run(self.hash, password)
+
+
+def password_fingerprint(password_hash: bytes) -> str:
+    """Short digest of a user's password hash, stored in refresh tokens so
+    that changing the password invalidates them."""
+    return hashlib.sha256(password_hash).hexdigest()[:16]
+
+
+def issue_tokens(user: User, secret_key: str, access_token_ttl: int, refresh_token_ttl: int) -> dict:
+    now = int(time.time())
+    access_token = jwt.encode({
+        "username": user.username,
+        "type": "access",
+        "iat": now,
+        "exp": now + access_token_ttl,
+    }, secret_key, algorithm="HS256")
+    refresh_token = jwt.encode({
+        "username": user.username,
+        "type": "refresh",
+        "pwd": password_fingerprint(user.password_hash),
+        "jti": uuid.uuid4().hex,
+        "iat": now,
+        "exp": now + refresh_token_ttl,
+    }, secret_key, algorithm="HS256")
+    return {
+        "token": access_token,
+        "expires_in": access_token_ttl,
+        "refresh_token": refresh_token,
+        "refresh_expires_in": refresh_token_ttl,
+    }
+
+
+def decode_token(token: str, secret_key: str, token_type: str) -> dict:
+    """Verified claims of a token, raises jwt.InvalidTokenError for bad,
+    expired or wrong type tokens."""
+    claims = jwt.decode(token, secret_key, algorithms=["HS256"], options={"require": ["exp"]})
+    if claims.get("type") != token_type:
+        raise jwt.InvalidTokenError(f"Not an {token_type} token")
+    return claims
+
+
+def authenticate(authorization_header: str, secret_key: str, auth_cache: AuthCache, database):
+    """Check a request's Authorization header.
+
+    Returns (user, None, None) for a valid token, otherwise (None, error
+    body, status code). Shared by require_auth and the asyncio server.
+    """
+    token = None
+    if authorization_header:
+        token = authorization_header.split(" ")[1]
+    if not token:
+        return None, {
+            "message": "Missing auth token",
+            "data": None,
+            "error": "Unauthorized"
+        }, 401
+    try:
+        # the signature is checked on every request, the cache only
+        # saves the user lookup for tokens that were already verified
+        user_data_from_request = decode_token(token, secret_key, "access")
+        request_user = auth_cache.get(token)
+        if request_user is None:
             request_user = database.get_user_by_name(
                 username=user_data_from_request["username"])
-            if request_user is None:
-                return {
-                    "message": "Invalid auth token",
-                    "data": None,
-                    "error": "Unauthorized"
-                }, 403
-        except Exception as ex:
-            return {
-                "message": "Internal server error",
+            if request_user is not None:
+                # never keep a token around past its expiry
+                auth_cache.set(token, request_user, ttl=min(
+                    auth_cache.ttl or float("inf"), user_data_from_request["exp"] - time.time()))
+        if request_user is None:
+            return None, {
+                "message": "Invalid auth token",
                 "data": None,
-                "error": str(ex)
-            }, 500
+                "error": "Unauthorized"
+            }, 403
+    except jwt.InvalidTokenError as ex:
+        return None, {
+            "message": "Invalid auth token",
+            "data": None,
+            "error": str(ex)
+        }, 401
+    except Exception as ex:
+        return None, {
+            "message": "Internal server error",
+            "data": None,
+            "error": str(ex)
+        }, 500
+    return request_user, None, None
 
+
+def require_auth(f):
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        request_user, error, status_code = authenticate(
+            request.headers.get("Authorization"),
+            current_app.config["SECRET_KEY"],
+            current_app.config["AUTH_CACHE"],
+            current_app.config["DATABASE"],
+        )
+        if request_user is None:
+            return error, status_code
         return f(request_user, *args, **kwargs)
 
     return decorated
@@ -0,0 +1,131 @@
+import datetime
+import logging
+from sqlalchemy import func, inspect, select
+from sqlalchemy.exc import DBAPIError
+from utils.exceptions.DatabaseException import DatabaseException
+from utils.models.models import Base, Client, ClientChange, ImageSeed, Job, Rollout, SchemaMigration, UploadSession, User, VMImage, client_image_table
+
+# any constant works, all nodes of a deployment have to use the same one
+_POSTGRESQL_LOCK_ID = 0x76616c68
+
+
+def _index(table, name: str):
+    return next(index for index in table.indexes if index.name == name)
+
+
+def _create_tables(connection):
+    # create_all skips tables that exist, and with them indexes that were
+    # added to the models later; those are created by later migrations
+    Base.metadata.create_all(bind=connection)
+    _index(client_image_table, "ix_client_image_image_id").create(bind=connection, checkfirst=True)
+
+
+def _index_lookup_columns(connection):
+    for index in [
+        _index(Client.__table__, "ix_clients_client_version"),
+        _index(VMImage.__table__, "ix_vm_images_image_name"),
+        _index(VMImage.__table__, "ix_vm_images_image_hash"),
+    ]:
+        index.create(bind=connection, checkfirst=True)
+
+
+def _make_usernames_unique(connection):
+    duplicates = [
+        row.username for row in connection.execute(
+            select(User.username).group_by(User.username).having(func.count() > 1))
+    ]
+    if duplicates:
+        raise DatabaseException(
+            f"Usernames used by more than one user, rename or delete them first: {', '.join(duplicates)}")
+    _index(User.__table__, "ix_users_username").create(bind=connection, checkfirst=True)
+
+
+def _index_job_kinds_and_cleanup_columns(connection):
+    for index in [
+        _index(Job.__table__, "ix_jobs_kind_job_id"),
+        _index(ClientChange.__table__, "ix_client_changes_created_at"),
+        _index(UploadSession.__table__, "ix_upload_sessions_updated_at"),
+    ]:
+        index.create(bind=connection, checkfirst=True)
+
+
+def _never_reuse_client_change_seqs(connection):
+    # PostgreSQL sequences never go back; SQLite reuses the highest rowid
+    # after deleting rows unless the table is created with AUTOINCREMENT
+    if connection.dialect.name != "sqlite":
+        return
+    table_sql = connection.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'client_changes'").scalar()
+    if "AUTOINCREMENT" in table_sql.upper():
+        return
+    connection.exec_driver_sql("ALTER TABLE client_changes RENAME TO client_changes_old")
+    for index in ClientChange.__table__.indexes:
+        connection.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+    ClientChange.__table__.create(bind=connection)
+    connection.exec_driver_sql(
+        "INSERT INTO client_changes (seq, client_mac, image_id, change, created_at) "
+        "SELECT seq, client_mac, image_id, change, created_at FROM client_changes_old")
+    connection.exec_driver_sql("DROP TABLE client_changes_old")
+
+
+def _index_image_seeds_by_last_seen(connection):
+    _index(ImageSeed.__table__, "ix_image_seeds_image_id_last_seen").create(bind=connection, checkfirst=True)
+
+
+def _index_rollout_status(connection):
+    _index(Rollout.__table__, "ix_rollouts_status").create(bind=connection, checkfirst=True)
+
+
+# (version, description, upgrade) in the order they are applied; upgrades
+# run in a transaction together with recording their version and never
+# change once released, a schema change is a new migration at the end.
+# Migration 1 creates tables from the current models, so every later
+# migration has to be a no-op on a database it created (checkfirst).
+MIGRATIONS = [
+    (1, "Create tables", _create_tables),
+    (2, "Index client versions, image names and image hashes", _index_lookup_columns),
+    (3, "Make usernames unique", _make_usernames_unique),
+    (4, "Index job kinds and the columns old rows are deleted by", _index_job_kinds_and_cleanup_columns),
+    (5, "Never reuse client change seqs", _never_reuse_client_change_seqs),
+    (6, "Index image seeds by image and last announcement", _index_image_seeds_by_last_seen),
+    (7, "Index rollout status", _index_rollout_status),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+logger = logging.getLogger(__name__)
+
+
+def schema_version(engine) -> int:
+    """Version of the last migration applied to the database, 0 for a
+    database created before migrations existed, None for an empty one."""
+    try:
+        with engine.connect() as connection:
+            return connection.execute(select(func.max(SchemaMigration.version))).scalar() or 0
+    except DBAPIError:
+        # no schema_migrations table
+        return 0 if inspect(engine).get_table_names() else None
+
+
+def migrate(engine) -> list[tuple[int, str]]:
+    """Apply the migrations the database is missing, returns them.
+
+    Every migration runs in its own write transaction, so several
+    processes starting at once apply each of them only once.
+    """
+    applied = []
+    for version, description, upgrade in MIGRATIONS:
+        with engine.connect() as connection:
+            connection = connection.execution_options(sqlite_write=True)
+            with connection.begin():
+                if engine.dialect.name == "postgresql":
+                    connection.execute(select(func.pg_advisory_xact_lock(_POSTGRESQL_LOCK_ID)))
+                SchemaMigration.__table__.create(bind=connection, checkfirst=True)
+                if connection.execute(
+                        select(SchemaMigration.version).where(SchemaMigration.version == version)).first():
+                    continue
+                logger.info(f"Applying migration {version}: {description}")
+                upgrade(connection)
+                connection.execute(SchemaMigration.__table__.insert().values(
+                    version=version, description=description, applied_at=datetime.datetime.utcnow()))
+        applied.append((version, description))
+    return applied
@@ -1,14 +1,36 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Table
+from sqlalchemy import Column, Integer, BigInteger, Boolean, Float, String, Text, DateTime, ForeignKey, Table, Index
 from sqlalchemy.orm import relationship, backref
+from sqlalchemy.types import TypeDecorator
 from sqlalchemy.ext.declarative import declarative_base
+import base64
+import datetime
+import json
 
 Base = declarative_base()
 
+
+class PasswordHash(TypeDecorator):
+    """bcrypt hash, bytes in Python and text in the database.
+
+    SQLite stored the bytes as they were, PostgreSQL refuses bytes for a
+    text column; rows written as bytes before are still read as bytes.
+    """
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return value.decode("ascii") if isinstance(value, bytes) else value
+
+    def process_result_value(self, value, dialect):
+        return value.encode("ascii") if isinstance(value, str) else value
+
 client_image_table = Table(
     "client_image",
     Base.metadata,
-    Column("client_mac", String, ForeignKey("clients.mac_address")),
-    Column("image_id", Integer, ForeignKey("vm_images.image_id"))
+    Column("client_mac", String, ForeignKey("clients.mac_address"), primary_key=True),
+    Column("image_id", Integer, ForeignKey("vm_images.image_id"), primary_key=True),
+    # the primary key covers lookups by client, this one covers lookups by image
+    Index("ix_client_image_image_id", "image_id"),
 )
 
 
@@ -17,7 +39,7 @@ class Client(Base):
     mac_address = Column(String, primary_key=True)
     ip_address = Column(String(16), nullable=False)
     hostname = Column(String(100), nullable=False)
-    client_version = Column(String(100), nullable=False)
+    client_version = Column(String(100), nullable=False, index=True)
     vm_list_on_machine = relationship(
         "VMImage",
         secondary=client_image_table,
@@ -37,10 +59,10 @@ class Client(Base):
 class VMImage(Base):
     __tablename__ = "vm_images"
     image_id = Column(Integer, primary_key=True)
-    image_name = Column(String(100), unique=False, nullable=False)
+    image_name = Column(String(100), unique=False, nullable=False, index=True)
     image_file = Column(String(500), unique=False, nullable=False)
     image_version = Column(String(100), nullable=False)
-    image_hash = Column(String(500), nullable=False)
+    image_hash = Column(String(500), nullable=False, index=True)
     image_name_version_combo = Column(String(600), nullable=False, unique=True)
     clients = relationship(
         "Client",
@@ -52,11 +74,219 @@ class VMImage(Base):
         return {c.name: str(getattr(self, c.name)) for c in self.__table__.columns}
 
 
+class ImageChunk(Base):
+    """One entry of an image manifest in the content-addressed chunk store."""
+    __tablename__ = "image_chunks"
+    image_id = Column(Integer, ForeignKey("vm_images.image_id"), primary_key=True)
+    chunk_index = Column(Integer, primary_key=True)
+    chunk_hash = Column(String(64), nullable=False, index=True)
+    chunk_offset = Column(BigInteger, nullable=False)
+    chunk_size = Column(Integer, nullable=False)
+
+    def as_dict(self):
+        return {
+            "index": self.chunk_index,
+            "hash": self.chunk_hash,
+            "offset": self.chunk_offset,
+            "size": self.chunk_size,
+        }
+
+
+class ImageSeed(Base):
+    """Chunks of an image a client announced it can serve to its peers."""
+    __tablename__ = "image_seeds"
+    client_mac = Column(String, ForeignKey("clients.mac_address"), primary_key=True)
+    image_id = Column(Integer, ForeignKey("vm_images.image_id"), primary_key=True, index=True)
+    peer_port = Column(Integer, nullable=True)
+    complete = Column(Boolean, nullable=False, default=False)
+    # base64 bitmap of held chunk indexes, unused once complete
+    chunk_bitmap = Column(Text, nullable=True)
+    last_seen = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    __table_args__ = (
+        Index("ix_image_seeds_image_id_last_seen", "image_id", "last_seen"),
+    )
+
+    def has_chunk(self, chunk_index: int) -> bool:
+        if self.complete:
+            return True
+        bitmap = base64.b64decode(self.chunk_bitmap or "")
+        return chunk_index < len(bitmap) * 8 and bool(bitmap[chunk_index // 8] & (0x80 >> chunk_index % 8))
+
+    def chunk_indexes(self, chunk_count: int) -> set[int]:
+        if self.complete:
+            return set(range(chunk_count))
+        bitmap = base64.b64decode(self.chunk_bitmap or "")
+        return {
+            chunk_index for chunk_index in range(min(chunk_count, len(bitmap) * 8))
+            if bitmap[chunk_index // 8] & (0x80 >> chunk_index % 8)
+        }
+
+    @staticmethod
+    def encode_chunk_bitmap(chunk_indexes: list[int]) -> str:
+        bitmap = bytearray((max(chunk_indexes, default=-1) + 8) // 8)
+        for chunk_index in chunk_indexes:
+            bitmap[chunk_index // 8] |= 0x80 >> chunk_index % 8
+        return base64.b64encode(bytes(bitmap)).decode("ascii")
+
+
+class Rollout(Base):
+    """Assignment of an image to a selection of clients in waves."""
+    __tablename__ = "rollouts"
+    rollout_id = Column(Integer, primary_key=True, autoincrement=True)
+    image_id = Column(Integer, ForeignKey("vm_images.image_id"), nullable=False)
+    # JSON of the client_version / hostname_pattern / mac_addresses selector
+    selector = Column(Text, nullable=False)
+    wave_size = Column(Integer, nullable=False)
+    max_in_flight = Column(Integer, nullable=False)
+    current_wave = Column(Integer, nullable=False, default=0)
+    status = Column(String(20), nullable=False, default="running", index=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+    def as_dict(self):
+        return {
+            "rollout_id": self.rollout_id,
+            "image_id": self.image_id,
+            "selector": json.loads(self.selector),
+            "wave_size": self.wave_size,
+            "max_in_flight": self.max_in_flight,
+            "current_wave": self.current_wave,
+            "status": self.status,
+            "created_at": self.created_at.isoformat(),
+        }
+
+
+class RolloutTarget(Base):
+    """Progress of one client in a rollout.
+
+    state is one of: pending (wave not started yet), assigned, downloading,
+    done or failed.
+    """
+    __tablename__ = "rollout_targets"
+    rollout_id = Column(Integer, ForeignKey("rollouts.rollout_id"), primary_key=True)
+    client_mac = Column(String, ForeignKey("clients.mac_address"), primary_key=True, index=True)
+    wave = Column(Integer, nullable=False)
+    state = Column(String(20), nullable=False, default="pending")
+    download_started_at = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    __table_args__ = (
+        Index("ix_rollout_targets_rollout_state", "rollout_id", "state"),
+    )
+
+
+class ClientChange(Base):
+    """An image assigned to or detached from a client.
+
+    seq orders all changes; clients pass the last seq they saw as the cursor
+    of GET /clients/<mac>/changes. It is never reused, also not after old
+    changes were deleted, which is why SQLite needs AUTOINCREMENT for it.
+    """
+    __tablename__ = "client_changes"
+    seq = Column(Integer, primary_key=True, autoincrement=True)
+    client_mac = Column(String, nullable=False)
+    image_id = Column(Integer, nullable=False)
+    change = Column(String(20), nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
+    __table_args__ = (
+        Index("ix_client_changes_client_mac_seq", "client_mac", "seq"),
+        {"sqlite_autoincrement": True},
+    )
+
+    def as_dict(self):
+        return {
+            "seq": self.seq,
+            "image_id": self.image_id,
+            "change": self.change,
+            "created_at": self.created_at.isoformat(),
+        }
+
+
+class Job(Base):
+    """Slow work run by the job workers of the server processes.
+
+    status is one of: queued, running, done or failed. Jobs with the same
+    job_key aren't queued twice while one of them is queued or running.
+    """
+    __tablename__ = "jobs"
+    job_id = Column(Integer, primary_key=True, autoincrement=True)
+    kind = Column(String(50), nullable=False)
+    job_key = Column(String(200), nullable=True)
+    # JSON arguments of the job handler and JSON result it returned
+    payload = Column(Text, nullable=False, default="{}")
+    result = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+    priority = Column(Integer, nullable=False, default=0)
+    status = Column(String(20), nullable=False, default="queued")
+    progress = Column(Float, nullable=False, default=0.0)
+    attempts = Column(Integer, nullable=False, default=0)
+    max_attempts = Column(Integer, nullable=False, default=3)
+    # not picked up before run_after, e.g. after a failed attempt
+    run_after = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    # a running job whose worker stopped extending this is picked up again
+    locked_until = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
+    started_at = Column(DateTime, nullable=True)
+    finished_at = Column(DateTime, nullable=True)
+    __table_args__ = (
+        Index("ix_jobs_status_priority", "status", "priority", "job_id"),
+        Index("ix_jobs_job_key", "job_key"),
+        Index("ix_jobs_kind_job_id", "kind", "job_id"),
+    )
+
+    def as_dict(self):
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "payload": json.loads(self.payload),
+            "result": json.loads(self.result) if self.result is not None else None,
+            "error": self.error,
+            "priority": self.priority,
+            "status": self.status,
+            "progress": self.progress,
+            "attempts": self.attempts,
+            "max_attempts": self.max_attempts,
+            "created_at": self.created_at.isoformat(),
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+
+class UploadSession(Base):
+    """Resumable image upload; the data lives in temp_file until completed."""
+    __tablename__ = "upload_sessions"
+    upload_id = Column(String(32), primary_key=True)
+    image_name = Column(String(100), nullable=False)
+    image_version = Column(String(100), nullable=False)
+    temp_file = Column(String(500), nullable=False)
+    hash_algorithm = Column(String(20), nullable=False)
+    received_bytes = Column(BigInteger, nullable=False, default=0)
+    total_size = Column(BigInteger, nullable=True)
+    # JSON list of digests of the completed hash blocks, see TreeHasher
+    block_digests = Column(Text, nullable=False, default="[]")
+    updated_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow, index=True)
+
+    def as_dict(self):
+        return {
+            "upload_id": self.upload_id,
+            "image_name": self.image_name,
+            "image_version": self.image_version,
+            "offset": self.received_bytes,
+            "size": self.total_size,
+        }
+
+
 class User(Base):
     __tablename__ = "users"
     user_id = Column(Integer, primary_key=True, autoincrement=True)
-    username = Column(String)
-    password_hash = Column(String)
+    username = Column(String, unique=True, index=True)
+    password_hash = Column(PasswordHash)
 
     def as_dict(self):
         return {c.name: str(getattr(self, c.name)) for c in self.__table__.columns}
+
+
+class SchemaMigration(Base):
+    """A migration of utils.migrations that was applied to the database."""
+    __tablename__ = "schema_migrations"
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(200), nullable=False)
+    applied_at = Column(DateTime, nullable=False, default=datetime.datetime.utcnow)
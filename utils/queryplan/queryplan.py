@@ -0,0 +1,178 @@
+import datetime
+import inspect
+import os
+from sqlalchemy import event
+from utils.models.models import Client, User, VMImage, UploadSession
+
+# Database methods that don't query tables
+NOT_QUERY_METHODS = {"add_listener", "reconnect", "session_scope", "migrate", "get_schema_version"}
+
+
+class _Recorder:
+    """Calls Database methods and records the statements each one runs."""
+
+    def __init__(self, database):
+        self.database = database
+        self.called_methods = set()
+        # (method, full table read allowed, statement, parameters)
+        self.statements = []
+        self._method = None
+        self._full_scan = False
+        event.listen(database.engine, "before_cursor_execute", self._record)
+
+    def _record(self, connection, cursor, statement, parameters, context, executemany):
+        if self._method is not None:
+            self.statements.append(
+                (self._method, self._full_scan, statement, parameters[0] if executemany else parameters))
+
+    def call(self, method: str, *args, full_scan: bool = False, **kwargs):
+        self.called_methods.add(method)
+        self._method = method
+        self._full_scan = full_scan
+        try:
+            return getattr(self.database, method)(*args, **kwargs)
+        finally:
+            self._method = None
+
+
+def _run_sample_calls(recorder: _Recorder):
+    """Every query method, called on a few rows so that it runs all of its
+    statements. Reads of whole tables are marked with full_scan."""
+    call = recorder.call
+    now = datetime.datetime.utcnow()
+    image = VMImage(image_name="plan", image_file="/nonexistent/plan-1.qcow2", image_version="1",
+                    image_hash="plan-1", image_name_version_combo="plan@1")
+    call("add_image", image)
+    next_image = VMImage(image_name="plan", image_file="/nonexistent/plan-2.qcow2", image_version="2",
+                         image_hash="plan-2", image_name_version_combo="plan@2")
+    call("add_image", next_image)
+    call("add_client", Client(mac_address="plan-0", ip_address="127.0.0.1", hostname="plan-0", client_version="1"))
+    call("modify_client", Client(mac_address="plan-0", ip_address="127.0.0.2", hostname="plan-0", client_version="1"))
+    call("upsert_clients", [
+        {"mac_address": f"plan-{index}", "ip_address": "127.0.0.1", "hostname": f"plan-{index}", "client_version": "1"}
+        for index in range(1, 4)
+    ])
+    call("get_clients", full_scan=True)
+    call("get_clients_page", limit=2)
+    call("get_clients_page", after="plan-1", client_version="1", hostname_prefix="plan")
+    call("get_images_page", after=0, image_name="plan")
+    list(call("iter_clients", page_size=2))
+    list(call("iter_images", page_size=1))
+    call("get_client_by_mac_address", "plan-0")
+    call("get_fleet_rows", full_scan=True)
+    call("get_fleet_rows", ["plan-0", "plan-1"])
+    call("get_image_rows", full_scan=True)
+    call("get_image_rows", [image.image_id])
+    call("get_clients_by_client_version", "1")
+    call("get_image_by_id", image.image_id)
+    call("get_images", full_scan=True)
+    call("get_image_by_name", "plan")
+    call("get_previous_image_version", next_image)
+    call("get_image_by_name_version_string", "plan@1")
+    call("get_image_by_hash", "plan-1")
+    call("modify_image", image)
+    call("set_image_manifest", image.image_id, [("0" * 64, 0, 1024), ("1" * 64, 1024, 1024)])
+    call("get_image_manifest", image.image_id)
+    call("get_referenced_chunk_hashes", full_scan=True)
+    call("announce_image_seed", "plan-0", image.image_id, 6881, [0])
+    call("get_image_seeds", image.image_id, now - datetime.timedelta(hours=1))
+    call("get_chunk_seeds", "0" * 64, now - datetime.timedelta(hours=1))
+
+    call("assign_image_to_client", "plan-0", "plan@1")
+    call("get_client_vm_list_by_mac_address", "plan-0")
+    call("get_clients_by_vm_image", image)
+    call("get_clients_by_image_id", image.image_id)
+    call("get_images_by_client", "plan-0")
+    call("detach_image_from_client", "plan-0", "plan@1")
+    call("assign_image_to_clients", ["plan-0", "plan-1"], "plan@1")
+    call("detach_image_from_clients", ["plan-0", "plan-1"], "plan@1")
+    call("get_client_changes", "plan-0", 0)
+    call("get_changed_clients", 0)
+    call("get_latest_client_change_seq")
+    call("delete_client_changes", now - datetime.timedelta(days=1))
+
+    rollout = call("create_rollout", next_image.image_id, {"client_version": "1", "hostname_pattern": "plan-*"}, 2, 1)
+    call("create_rollout", next_image.image_id, {"mac_addresses": ["plan-2"]}, 2, 1,
+         selected_mac_addresses=["plan-2"])
+    call("get_rollout", rollout.rollout_id)
+    call("begin_rollout_download", next_image.image_id, "plan-0", 3600)
+    call("expire_rollout_targets", 3600, 86400)
+    call("update_rollout_target", rollout.rollout_id, "plan-0", "done")
+    call("update_rollout_target", rollout.rollout_id, "plan-1", "done")
+    call("get_rollout_progress", rollout.rollout_id)
+
+    call("add_upload_session", UploadSession(upload_id="plan", image_name="plan", image_version="3",
+                                             temp_file="/nonexistent/plan-3.part", hash_algorithm="sha256"))
+    call("get_upload_session", "plan")
+    call("update_upload_progress", "plan", 0, 1024, "[]")
+    call("complete_upload_session", "plan", VMImage(
+        image_name="plan", image_file="/nonexistent/plan-3.qcow2", image_version="3",
+        image_hash="plan-3", image_name_version_combo="plan@3"))
+    call("delete_stale_upload_sessions", now - datetime.timedelta(days=1))
+
+    job = call("add_job", "plan", {}, job_key="plan")
+    call("get_job", job.job_id)
+    call("get_latest_job", "plan")
+    call("get_latest_job", "plan", job_key="plan:1")
+    call("claim_job", ["plan"], 60)
+    call("update_job_progress", job.job_id, 1, 0.5, 60)
+    call("extend_job_lease", job.job_id, 1, 60)
+    call("fail_job", job.job_id, 1, "planned failure", 0)
+    call("claim_job", ["plan"], 60)
+    call("finish_job", job.job_id, 2, {})
+    call("delete_jobs", now - datetime.timedelta(days=1))
+
+    call("add_user", User(username="plan", password_hash=b"$2b$04$plan"))
+    user = call("get_user_by_name", "plan")
+    call("get_user_by_id", user.user_id)
+    call("update_user_password_hash", "plan", b"$2b$04$plan-2")
+
+    call("delete_client", recorder.database.get_client_by_mac_address("plan-3"))
+    call("delete_image", recorder.database.get_image_by_id(image.image_id))
+
+
+def _plan_problem(plan_details: list[str]) -> str:
+    """The step of a query plan that reads a whole table, None if there is none.
+    Scans in the order of an index, e.g. for pages with a LIMIT, are fine."""
+    for detail in plan_details:
+        # SQLite indexes a table on the fly when a join or lookup needs one
+        if "AUTOMATIC" in detail:
+            return detail
+        if detail.startswith("SCAN ") and "INDEX" not in detail and "CONSTANT ROW" not in detail:
+            return detail
+    return None
+
+
+def check_query_plans(database_class, work_directory: str) -> tuple[list[str], list[dict]]:
+    """Run every query method of Database against a fresh SQLite database and
+    check with EXPLAIN QUERY PLAN that their statements use indexes.
+
+    Returns the checked methods and the problems found: statements reading
+    a whole table in methods that aren't meant to, and query methods this
+    check doesn't call yet, so that new ones can't be added unchecked.
+    """
+    database = database_class(os.path.join(work_directory, "query_plans.db"), "ERROR")
+    recorder = _Recorder(database)
+    _run_sample_calls(recorder)
+    problems = []
+    query_methods = {
+        name for name, member in inspect.getmembers(database_class, inspect.isfunction)
+        if not name.startswith("_") and name not in NOT_QUERY_METHODS
+    }
+    for method in sorted(query_methods - recorder.called_methods):
+        problems.append({"method": method, "statement": None, "plan": "not covered by the query plan check"})
+    checked = set()
+    with database.engine.connect() as connection:
+        for method, full_scan, statement, parameters in recorder.statements:
+            if full_scan or not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE")):
+                continue
+            if (method, statement) in checked:
+                continue
+            checked.add((method, statement))
+            plan_details = [row[3] for row in connection.exec_driver_sql(
+                f"EXPLAIN QUERY PLAN {statement}", parameters)]
+            plan_problem = _plan_problem(plan_details)
+            if plan_problem is not None:
+                problems.append({"method": method, "statement": " ".join(statement.split()), "plan": plan_problem})
+    database.engine.dispose()
+    return sorted(recorder.called_methods), problems
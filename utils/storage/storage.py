@@ -0,0 +1,192 @@
+from bisect import bisect_right
+import hashlib
+import io
+import os
+import tempfile
+import zlib
+
+
+class ChunkStore:
+    """Content-addressed store of image chunks, keyed by their sha256.
+
+    Images are split into content-defined chunks: a chunk ends after a
+    `block_size` aligned block whose checksum matches a mask, so identical
+    regions of two image versions produce identical chunks even when whole
+    blocks in between were inserted or removed. Disk images are
+    block-aligned, which is why boundaries are only considered at block
+    edges; it keeps the boundary search in C (crc32) instead of a per-byte
+    rolling hash. After an insertion or removal that isn't a multiple of
+    `block_size`, the chunks that follow it don't match the old ones.
+    """
+
+    def __init__(
+        self,
+        store_path: str,
+        block_size: int = 4096,
+        min_chunk_size: int = 256 * 1024,
+        avg_chunk_size: int = 1024 * 1024,
+        max_chunk_size: int = 4 * 1024 * 1024,
+    ):
+        self.store_path = store_path
+        self.block_size = block_size
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        # the mask is matched on average once every avg_chunk_size bytes
+        # past the minimum chunk size
+        blocks_per_chunk = max(1, (avg_chunk_size - min_chunk_size) // block_size)
+        self.boundary_mask = (1 << max(0, blocks_per_chunk.bit_length() - 1)) - 1
+        os.makedirs(os.path.join(store_path, "chunks"), exist_ok=True)
+
+    def chunk_path(self, chunk_hash: str) -> str:
+        return os.path.join(self.store_path, "chunks", chunk_hash[:2], chunk_hash)
+
+    def has_chunk(self, chunk_hash: str) -> bool:
+        return os.path.exists(self.chunk_path(chunk_hash))
+
+    def split(self, stream, read_size: int = 16 * 1024 * 1024):
+        """Yield the content-defined chunks of a binary stream."""
+        chunk = bytearray()
+        while True:
+            data = stream.read(read_size)
+            if not data:
+                break
+            view = memoryview(data)
+            position = 0
+            while position < len(view):
+                # no boundary can fall before the minimum chunk size
+                if len(chunk) < self.min_chunk_size:
+                    take = min(self.min_chunk_size - len(chunk), len(view) - position)
+                    chunk += view[position:position + take]
+                    position += take
+                    continue
+                block = view[position:position + self.block_size]
+                chunk += block
+                position += len(block)
+                if (
+                    len(chunk) >= self.max_chunk_size
+                    or zlib.crc32(block) & self.boundary_mask == 0
+                ):
+                    yield bytes(chunk)
+                    chunk = bytearray()
+        if chunk:
+            yield bytes(chunk)
+
+    def store_file(self, file_path: str) -> list[tuple[str, int, int]]:
+        """Split a file into the store and return its manifest.
+
+        The manifest is a list of (chunk hash, offset, size) tuples; chunks
+        already present in the store are not written again.
+        """
+        manifest = []
+        offset = 0
+        with open(file_path, "rb") as image_file:
+            for chunk in self.split(image_file):
+                chunk_hash = hashlib.sha256(chunk).hexdigest()
+                self.write_chunk(chunk_hash, chunk)
+                manifest.append((chunk_hash, offset, len(chunk)))
+                offset += len(chunk)
+        return manifest
+
+    def write_chunk(self, chunk_hash: str, data: bytes):
+        target_path = self.chunk_path(chunk_hash)
+        if os.path.exists(target_path):
+            return
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        # write under a temporary name so readers never see partial chunks
+        file_descriptor, temp_path = tempfile.mkstemp(dir=os.path.dirname(target_path))
+        try:
+            with os.fdopen(file_descriptor, "wb") as temp_file:
+                temp_file.write(data)
+            os.replace(temp_path, target_path)
+        except Exception:
+            os.unlink(temp_path)
+            raise
+
+    def open_image(self, manifest: list[tuple[str, int, int]]) -> "ChunkedImageReader":
+        return ChunkedImageReader(self, manifest)
+
+    def collect_garbage(self, referenced_hashes: set[str]) -> int:
+        """Remove chunks no manifest refers to, return how many were removed."""
+        removed_chunks = 0
+        chunks_path = os.path.join(self.store_path, "chunks")
+        for directory, _, file_names in os.walk(chunks_path):
+            for file_name in file_names:
+                if file_name not in referenced_hashes:
+                    os.unlink(os.path.join(directory, file_name))
+                    removed_chunks += 1
+        return removed_chunks
+
+
+def open_image_stream(vm_image, database, chunk_store: ChunkStore = None, replica: bool = True):
+    """Open an image for reading, from its file or else from the chunk store.
+
+    Returns a seekable binary file object with a `size` attribute, or None
+    if the image data is not available. Pass replica=False for an image
+    stored moments ago.
+    """
+    if os.path.exists(vm_image.image_file):
+        image_file = open(vm_image.image_file, "rb")
+        image_file.size = os.fstat(image_file.fileno()).st_size
+        return image_file
+    if chunk_store is None:
+        return None
+    manifest = database.get_image_manifest(vm_image.image_id, replica=replica)
+    if not manifest:
+        return None
+    return chunk_store.open_image(
+        [(chunk.chunk_hash, chunk.chunk_offset, chunk.chunk_size) for chunk in manifest])
+
+
+class ChunkedImageReader(io.RawIOBase):
+    """Seekable read-only file object reassembling an image from its chunks."""
+
+    def __init__(self, chunk_store: ChunkStore, manifest: list[tuple[str, int, int]]):
+        self.chunk_store = chunk_store
+        self.manifest = manifest
+        self.offsets = [offset for _, offset, _ in manifest]
+        self.size = sum(size for _, _, size in manifest)
+        self.position = 0
+        self.current_index = None
+        self.current_file = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("negative seek position")
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        if self.position >= self.size:
+            return 0
+        index = bisect_right(self.offsets, self.position) - 1
+        chunk_hash, chunk_offset, chunk_size = self.manifest[index]
+        if index != self.current_index:
+            if self.current_file is not None:
+                self.current_file.close()
+            self.current_file = open(self.chunk_store.chunk_path(chunk_hash), "rb")
+            self.current_index = index
+        # reads never cross a chunk boundary, callers loop until EOF
+        self.current_file.seek(self.position - chunk_offset)
+        length = min(len(buffer), chunk_offset + chunk_size - self.position)
+        read_bytes = self.current_file.readinto(memoryview(buffer)[:length])
+        self.position += read_bytes
+        return read_bytes
+
+    def close(self):
+        if self.current_file is not None:
+            self.current_file.close()
+            self.current_file = None
+        super().close()